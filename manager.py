@@ -19,6 +19,57 @@ TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR TH
 SOFTWARE.
 """
 
+import json
+
+import click
 from flask_migrate import Migrate, MigrateCommand, Manager
 
 migrate = Migrate()
+
+
+@click.group()
+def cli():
+    """PAPAYA platform management commands"""
+    pass
+
+
+@cli.command('batch')
+@click.argument('action', type=click.Choice(['activate', 'terminate']))
+@click.option('--ids', help='Comma separated application ids')
+@click.option('--user', help='Username of the applications owner')
+@click.option('--service-id', type=int, help='Service id of the applications')
+@click.option('--concurrency', type=int, help='Number of applications deployed or deleted at the same time')
+def batch(action, ids, user, service_id, concurrency):
+    """Activate or terminate several applications at once"""
+    from papaya_server import create_app
+
+    app = create_app()
+    with app.app_context():
+        from papaya_server.applications import get_batch_applications, load_used_ports, run_batch
+
+        # the request hooks don't run in the CLI, the allocator should know the ports in use before allocating
+        load_used_ports()
+        ids = [int(i) for i in ids.split(',') if i.strip()] if ids else None
+        apps = get_batch_applications(ids=ids, username=user, service_id=service_id)
+        click.echo(json.dumps(run_batch(apps, action, concurrency), indent=2))
+
+
+@cli.command('teardown')
+@click.option('--user', help='Username of the applications owner')
+@click.option('--all', 'everything', is_flag=True, help='Delete the applications of all the users')
+def teardown(user, everything):
+    """Delete the applications of a user or of the whole platform"""
+    if not user and not everything:
+        raise click.UsageError("Either --user or --all should be provided")
+
+    from papaya_server import create_app
+
+    app = create_app()
+    with app.app_context():
+        from papaya_server.applications import teardown_applications
+
+        click.echo(json.dumps(teardown_applications(username=user), indent=2))
+
+
+if __name__ == "__main__":
+    cli()
@@ -46,6 +46,8 @@ def create_app(test_config=None):
     configure_blueprints(app)
     # set error handler
     configure_http_error_handler(app)
+    # background jobs executor
+    configure_jobs(app)
 
     return app
 
@@ -124,6 +126,16 @@ def configure_http_error_handler(app):
         return response
 
 
+def configure_jobs(app):
+    """
+    :param app: flask app context
+    :return:
+    """
+    from papaya_server.jobs import executor
+    executor.init_app(app, max_workers=Config.jobs['workers'], stale_after=Config.jobs['stale_after'],
+                      heartbeat_interval=Config.jobs['heartbeat_interval'])
+
+
 def configure_blueprints(app):
     """
     :param app: flask app context
@@ -144,6 +156,9 @@ def configure_blueprints(app):
     from . import k8s_logging
     app.register_blueprint(k8s_logging.bp)
 
+    from . import metrics
+    app.register_blueprint(metrics.bp)
+
     # print(url_for('auth.index'))
     app.add_url_rule('/', view_func=services.index)
 
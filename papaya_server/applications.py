@@ -21,43 +21,183 @@ SOFTWARE.
 
 import os
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from functools import partial
 
 import stringcase
-from flask import (Blueprint, current_app, flash, g, redirect, render_template, request, send_from_directory, url_for)
+from sqlalchemy import func, or_
+from flask import (Blueprint, current_app, flash, g, jsonify, redirect, render_template, request, send_from_directory,
+                   url_for)
 from werkzeug.exceptions import abort
 from werkzeug.utils import secure_filename
 
 import papaya_server.services as service
 from papaya_server import db
 from papaya_server.config import Config
-from papaya_server.exceptions import K8sError
-from papaya_server.k8s_client import K8s
-from papaya_server.models import Application, User
+from papaya_server import jobs
+from papaya_server.exceptions import BadRequest, Conflict, K8sError, NotFound
+from papaya_server.jobs import job_to_dict
+from papaya_server.k8s_client import K8s, owner_labels, owner_selector
+from papaya_server.k8s_resilience import ApiGuard
+from papaya_server.models import Application, Job, Service, User
 from papaya_server.validator import StrValidator
 from papaya_server.auth import login_required
-from papaya_server.constants import AppStatus as AppStatus
+from papaya_server.constants import AppStatus as AppStatus, DEPLOYED_APP_STATUSES, JobAction, JobStatus
+from papaya_server.readiness import ReadinessTracker
+from papaya_server.reconciler import Reconciler
+from papaya_server.idle_monitor import IdleMonitor
+from papaya_server.warm_pool import WarmPool
 
 
 bp = Blueprint('application', __name__, url_prefix='/applications')
 
 
+def _create_port_allocator(cfg):
+    """
+    :param cfg: k8s configuration
+    :return: database allocator if configured, otherwise None and K8s keeps the ports in memory
+    """
+    if cfg['port_allocator'] == 'db':
+        from papaya_server.port_leases import PortLeases
+        return PortLeases(cfg['open_ports_range']['start'], cfg['open_ports_range']['end'],
+                          ttl=cfg['port_lease_ttl'])
+
+    return None
+
+
+def _api_pool_size(cfg):
+    """
+    :param cfg: k8s configuration
+    :return: configured pool size, or the number of K8s calls that may run at the same time:
+            deployment steps, background jobs, batch operations and the three watches of the cluster state cache
+    """
+    return cfg['api_pool_size'] or cfg['deploy_workers'] + Config.jobs['workers'] + cfg['batch_concurrency'] + 3
+
+
 if os.getenv('NOT_BUILDING', False):
-    kubernetes = K8s(os.getenv('INCLUSTER_K8S_CONFIG', False), ports_range=Config.k8s['open_ports_range'])
+    kubernetes = K8s(os.getenv('INCLUSTER_K8S_CONFIG', False), ports_range=Config.k8s['open_ports_range'],
+                     port_allocator=_create_port_allocator(Config.k8s),
+                     deploy_workers=Config.k8s['deploy_workers'], pool_size=_api_pool_size(Config.k8s),
+                     connect_timeout=Config.k8s['api_connect_timeout'], read_timeout=Config.k8s['api_read_timeout'],
+                     api_guard=ApiGuard(rate=Config.k8s['api_qps'], burst=Config.k8s['api_burst'],
+                                        max_retries=Config.k8s['api_max_retries'],
+                                        backoff_base=Config.k8s['api_backoff_base'],
+                                        backoff_max=Config.k8s['api_backoff_max'],
+                                        failure_threshold=Config.k8s['api_circuit_failures'],
+                                        reset_timeout=Config.k8s['api_circuit_reset']),
+                     ingress_shards=Config.k8s['ingress_shards'] if Config.k8s['ingress_mode'] == 'shared' else 0,
+                     ingress_batch_window=Config.k8s['ingress_batch_window'],
+                     ingress_controller=Config.k8s['ingress_controller'], iam_mode=Config.k8s['iam_mode'],
+                     iam_auth_url=Config.k8s['iam_auth_url'], iam_signin_url=Config.k8s['iam_signin_url'])
+    cluster_state = kubernetes.watch_cluster(Config.k8s['namespace'], Config.k8s['watch_label_selector'])
+    readiness_tracker = ReadinessTracker(cluster_state, lambda name, username: get_app_name(name, username))
+    reconciler = Reconciler(kubernetes, Config.k8s['namespace'], lambda: get_deployed_specs(), Config.k8s['host'],
+                            interval=Config.k8s['reconcile_interval'],
+                            grace_period=Config.k8s['reconcile_grace_period'],
+                            batch_size=Config.k8s['reconcile_batch_size'])
+    idle_monitor = IdleMonitor(kubernetes, cluster_state, Config.k8s['namespace'],
+                               lambda name, username: get_app_name(name, username), lambda a: suspend_idle(a),
+                               idle_after=Config.k8s['idle_suspend_after'],
+                               interval=Config.k8s['idle_check_interval'])
+    warm_pool = WarmPool(kubernetes, Config.k8s['namespace'], interval=Config.k8s['warm_pool_interval'],
+                         prepull_fn=(lambda s: prepull_service(s)) if Config.k8s['prepull_images'] else None)
+
+
+def prepull_service(s: Service):
+    """
+    Pull the service's server image on all the nodes, see K8s.prepull_image
+    :param s: service
+    :return:
+    """
+    kubernetes.prepull_image(s.id, s.server_container, Config.k8s['namespace'],
+                             pause_image=Config.k8s['prepull_pause_image'],
+                             tools_image=Config.k8s['prepull_tools_image'])
+
+
+@bp.before_app_first_request
+def load_used_ports():
+    """
+    Load the ports used by the applications once, afterwards the allocator keeps track of them,
+    the CLI commands which allocate ports call it explicitly
+    """
+    if os.getenv('NOT_BUILDING', False):
+        kubernetes.open_ports.init(get_used_node_ports())
+
+
+@bp.before_app_first_request
+def start_cluster_state():
+    """Start following the cluster state, the pages read it from memory and the statuses follow its events"""
+    if os.getenv('NOT_BUILDING', False):
+        readiness_tracker.init_app(current_app._get_current_object())
+        cluster_state.start()
+
+
+@bp.before_app_first_request
+def resume_jobs():
+    """Enqueue the jobs left by a previous process"""
+    if os.getenv('NOT_BUILDING', False):
+        jobs.executor.resume()
+
+
+@bp.before_app_first_request
+def start_reconciler():
+    """Periodically fix the drift between the applications table and the cluster"""
+    if os.getenv('NOT_BUILDING', False):
+        reconciler.init_app(current_app._get_current_object())
+        reconciler.start()
+
+
+@bp.before_app_first_request
+def start_idle_monitor():
+    """Periodically scale the idle applications to zero"""
+    if os.getenv('NOT_BUILDING', False):
+        idle_monitor.init_app(current_app._get_current_object())
+        idle_monitor.start()
+
+
+@bp.before_app_first_request
+def start_warm_pool():
+    """Keep the services' standby deployments topped up"""
+    if os.getenv('NOT_BUILDING', False):
+        warm_pool.init_app(current_app._get_current_object())
+        warm_pool.start()
 
 
 @bp.route('/', methods=('GET',))
 @login_required
 def index():
-    node_ports = []
-    all_apps = Application.query.all()
-    # retrieve all used ports
-    for a in all_apps:
-        if a.node_port:
-            node_ports.append(a.node_port)
-
-    kubernetes.open_ports.init(node_ports)
     apps = Application.query.filter_by(user_id=g.user['id']).order_by(Application.creation_date).all()
-    return render_template('application/index.html', applications=apps)
+    readiness = {a.id: get_readiness(a, g.user['username']) for a in apps if a.status in DEPLOYED_APP_STATUSES}
+    return render_template('application/index.html', applications=apps, jobs=get_latest_jobs(g.user['id']),
+                           readiness=readiness)
+
+
+@bp.route('/<int:id>/status', methods=('GET',))
+@login_required
+def status(id):
+    """
+    Application's status and readiness, served from the cluster state cache without calling K8s.
+    While the application is provisioning the Retry-After header suggests when to poll again
+    """
+    a = get_application(id, g.user['id'])
+    response = jsonify({
+        'id': a.id,
+        'name': a.name,
+        'status': AppStatus(a.status).name,
+        'ready': a.status in (AppStatus.ACTIVE.value, AppStatus.READY.value),
+        'server_url': a.server_url,
+        'node_port': a.node_port,
+        'activation_date': a.activation_date.isoformat() if a.activation_date else None,
+        'ready_date': a.ready_date.isoformat() if a.ready_date else None,
+        'time_to_ready': a.time_to_ready,
+        'readiness': get_readiness(a, g.user['username']) if a.status in DEPLOYED_APP_STATUSES else None
+    })
+
+    if a.status == AppStatus.PROVISIONING.value:
+        response.headers['Retry-After'] = str(get_retry_after(a))
+
+    return response
 
 
 @bp.route('/<int:id>/create', methods=('GET', 'POST'))
@@ -102,7 +242,7 @@ def update(id):
 
     if a is None:
         flash('Application not found')
-    elif a.status == AppStatus.ACTIVE.value:
+    elif a.status in DEPLOYED_APP_STATUSES:
         flash('Can not edit Active application')
 
     elif request.method == 'POST':
@@ -144,9 +284,12 @@ def delete(id):
 
     a = get_app_by_user(id, g.user['id'])
 
-    if a.status == AppStatus.ACTIVE.value:
+    if a.status in DEPLOYED_APP_STATUSES:
         flash("Can not delete ACTIVE application. The application should be terminated")
 
+    elif jobs.executor.active_job(a.id) is not None:
+        flash("Can not delete application {0} while it's being activated or terminated".format(a.name))
+
     else:
 
         try:
@@ -181,145 +324,686 @@ def delete(id):
 @login_required
 def activate(id):
 
+    a = get_application(id, g.user['id'])
+    # allow running only for created or terminated applications
+    if a.status in DEPLOYED_APP_STATUSES:
+        return reject_request('The application is already active')
+
+    return submit_job(a, JobAction.ACTIVATE, 'Activation of application {0} has started')
+
+
+@bp.route('/<int:id>/terminate', methods=('POST',))
+@login_required
+def terminate(id):
+
+    a = get_application(id, g.user['id'])
+    if a.status not in DEPLOYED_APP_STATUSES:
+        return reject_request("Can not terminate not ACTIVE application {0}".format(a.name))
+
+    return submit_job(a, JobAction.TERMINATE, 'Termination of application {0} has started')
+
+
+@bp.route('/<int:id>/suspend', methods=('POST',))
+@login_required
+def suspend(id):
+
+    a = get_application(id, g.user['id'])
+    if a.status not in DEPLOYED_APP_STATUSES or a.status == AppStatus.SUSPENDED.value:
+        return reject_request("Can not suspend not ACTIVE application {0}".format(a.name))
+
+    return submit_job(a, JobAction.SUSPEND, 'Suspension of application {0} has started')
+
+
+@bp.route('/<int:id>/resume', methods=('POST',))
+@login_required
+def resume(id):
+
+    a = get_application(id, g.user['id'])
+    if a.status != AppStatus.SUSPENDED.value:
+        return reject_request("Can not resume not SUSPENDED application {0}".format(a.name))
+
+    return submit_job(a, JobAction.RESUME, 'Resuming of application {0} has started')
+
+
+@bp.route('/batch', methods=('POST',))
+@login_required
+def batch():
+    """
+    Activate or terminate several applications at once, expects a json body
+    {"action": "activate"|"terminate", "ids": [...], "user": username, "service_id": id, "concurrency": number}
+    where at least one of ids, user or service_id should be provided.
+    Non admin users can act only on their own applications
+    """
+    body = request.get_json(force=True, silent=True) or {}
+    action = body.get('action')
+    if action not in (JobAction.ACTIVATE.value, JobAction.TERMINATE.value):
+        raise BadRequest("Invalid action [{}]".format(action))
+
     try:
-        cfg = Config.k8s
-        namespace = cfg['namespace']
-
-        a = get_application(id, g.user['id'])
-        # allow running only for created or terminated applications
-        if a.status != AppStatus.ACTIVE.value:
-
-            url = '-'
-            service_id = a.service_id
-            s = service.get_service(service_id)
-
-            user = User.query.filter_by(id=g.user['id']).first()
-            env_dict = dict()
-
-            # generate app name
-            app_name = get_app_name(a.name, user.username)
-            app_unique = uuid.uuid4().hex[:6]
-            n_port = None
-
-            # it won't be used if it's not an http service
-            ports = {
-                'tcp': {'source': s.server_tcp_port, 'target': None},
-                'http': {'source': s.server_http_port, 'target': None}
-            }
-
-            if s.server_http_port:
-
-                url = "https://" + app_unique + "." + cfg['host']
-                if s.server_tcp_port:
-                    n_port = kubernetes.deploy_dual_port_application(app_name=app_name, uuid=app_unique,
-                                                                     image=s.server_container, namespace=namespace,
-                                                                     ports=ports, host=cfg['host'], iam=a.iam, url=url)
-                    env_dict['SERVER_URL'] = url
-                    env_dict['SERVER_IP'] = cfg['cluster_ip']
-                    env_dict['SERVER_TCP_PORT'] = n_port
-
-                else:
-                    kubernetes.deploy_http_application(app_name=app_name, uuid=app_unique, image=s.server_container,
-                                                       namespace=namespace, ports=ports, host=cfg['host'],
-                                                       iam=a.iam, url=url)
-                    env_dict['SERVER_URL'] = url
+        ids = [int(i) for i in body.get('ids') or []]
+        service_id = int(body['service_id']) if body.get('service_id') is not None else None
+        concurrency = int(body['concurrency']) if body.get('concurrency') else None
+    except (TypeError, ValueError):
+        raise BadRequest("ids, service_id and concurrency should be integers")
+
+    owner_id = None if g.user['admin'] else g.user['id']
+    apps = get_batch_applications(ids=ids, username=body.get('user'), service_id=service_id, owner_id=owner_id)
+
+    return jsonify({'action': action, 'results': run_batch(apps, action, concurrency, user_id=g.user['id'])})
+
+
+@bp.route('/jobs/<int:id>', methods=('GET',))
+@login_required
+def job_status(id):
+
+    job = Job.query.filter_by(id=id, user_id=g.user['id']).first()
+    if job is None:
+        raise NotFound("Job id {0} doesn't exist.".format(id))
+
+    return jsonify(job_to_dict(job))
+
+
+def activate_application(job: Job):
+    """
+    Deploy the application on the cluster, runs in the background by the jobs executor
+    :param job: activation job
+    :return:
+    """
+    a = get_app(job.application_id)
+    if a.status in DEPLOYED_APP_STATUSES:
+        raise Conflict('The application is already active')
+
+    spec = get_deploy_spec(a)
+    result = deploy_application(spec)
+    mark_active(a, result)
+
+    return partial(readiness_tracker.track, spec['app_name'], a.id)
+
+
+def terminate_application(job: Job):
+    """
+    Delete the application from the cluster, runs in the background by the jobs executor
+    :param job: termination job
+    :return:
+    """
+    a = get_app(job.application_id)
+    if a.status not in DEPLOYED_APP_STATUSES:
+        raise Conflict("Can not terminate not ACTIVE application {0}".format(a.name))
+
+    undeploy_application(get_deploy_spec(a))
+    # committed together with the job's status
+    mark_terminated(a)
+
+
+def suspend_application(job: Job):
+    """
+    Scale the application's deployment to zero, runs in the background by the jobs executor
+    :param job: suspension job
+    :return:
+    """
+    a = get_app(job.application_id)
+    if a.status not in DEPLOYED_APP_STATUSES or a.status == AppStatus.SUSPENDED.value:
+        raise Conflict("Can not suspend not ACTIVE application {0}".format(a.name))
+
+    spec = get_deploy_spec(a)
+    kubernetes.scale_deployment(spec['app_name'], Config.k8s['namespace'], 0, deployment_name=spec['workload_name'])
+    a.status = AppStatus.SUSPENDED.value
+
+
+def resume_application(job: Job):
+    """
+    Scale the suspended application's deployment back, its host, port and agent configuration stay the same
+    :param job: resume job
+    :return: callable run after the job's commit, the readiness tracker moves the application to READY
+    """
+    a = get_app(job.application_id)
+    if a.status != AppStatus.SUSPENDED.value:
+        raise Conflict("Can not resume not SUSPENDED application {0}".format(a.name))
+
+    spec = get_deploy_spec(a)
+    kubernetes.scale_deployment(spec['app_name'], Config.k8s['namespace'], spec['profile']['min_replicas'],
+                                deployment_name=spec['workload_name'])
+    a.status = AppStatus.PROVISIONING.value
+    a.resume_date = datetime.utcnow()
+
+    return partial(readiness_tracker.track, spec['app_name'], a.id)
+
+
+def suspend_idle(a: Application):
+    """
+    Enqueue suspension of an idle application, skipped if another operation is in progress
+    :param a: application
+    :return:
+    """
+    try:
+        jobs.executor.submit(a.id, a.user_id, JobAction.SUSPEND.value)
+    except Conflict as e:
+        current_app.logger.info("Idle application [{}] wasn't suspended: {}".format(a.id, e.message))
 
-            elif s.server_tcp_port:
-                if a.iam:
-                    raise AttributeError("Can't deploy socket application with IAM")
 
-                n_port = kubernetes.deploy_tcp_application(app_name=app_name, uuid=app_unique, image=s.server_container,
-                                                           namespace=namespace, ports=ports, host=cfg['host'])
+def get_iam_mode(a: Application):
+    """
+    :param a: application
+    :return: IAM mode the application was activated with, applications activated before the mode was stored
+            run the gatekeeper sidecar, the others are activated with the configured mode
+    """
+    if a.iam_mode:
+        return a.iam_mode
+    return 'sidecar' if a.status in DEPLOYED_APP_STATUSES else Config.k8s['iam_mode']
+
+
+def get_deploy_spec(a: Application):
+    """
+    Collect everything needed to deploy or delete the application, so it can be done outside of the DB session
+    :param a: application
+    :return: deployment specification dictionary
+    """
+    s = service.get_service(a.service_id)
+    user = User.query.filter_by(id=a.user_id).first()
+
+    return {
+        'id': a.id,
+        'name': a.name,
+        'user_id': a.user_id,
+        'username': user.username,
+        'app_name': get_app_name(a.name, user.username),
+        'iam': a.iam,
+        'iam_mode': get_iam_mode(a),
+        'service_id': a.service_id,
+        'image': s.server_container,
+        'http_port': s.server_http_port,
+        'tcp_port': s.server_tcp_port,
+        'warm_pool_size': s.warm_pool_size,
+        'profile': service.get_resource_profile(s),
+        'ingress_profile': service.get_ingress_profile(s),
+        'server_url': a.server_url,
+        'node_port': a.node_port,
+        'workload_name': a.workload_name
+    }
+
+
+def get_deployed_specs():
+    """
+    Collect the deployment specifications of the deployed applications and of the applications
+    with a pending or running job with a single query, the latter are marked as busy
+    :return: list of deployment specifications, see get_deploy_spec
+    """
+    busy = {r.application_id for r in db.session.query(Job.application_id)
+            .filter(Job.status.in_((JobStatus.PENDING.value, JobStatus.RUNNING.value))).distinct()}
+    rows = db.session.query(Application, User.username, Service) \
+        .join(User, User.id == Application.user_id) \
+        .join(Service, Service.id == Application.service_id) \
+        .filter(or_(Application.status.in_(DEPLOYED_APP_STATUSES), Application.id.in_(busy))).all()
+
+    return [{
+        'id': a.id,
+        'name': a.name,
+        'user_id': a.user_id,
+        'username': username,
+        'app_name': get_app_name(a.name, username),
+        'iam': a.iam,
+        'iam_mode': get_iam_mode(a),
+        'service_id': a.service_id,
+        'image': s.server_container,
+        'http_port': s.server_http_port,
+        'tcp_port': s.server_tcp_port,
+        'warm_pool_size': s.warm_pool_size,
+        'profile': service.get_resource_profile(s),
+        'ingress_profile': service.get_ingress_profile(s),
+        'server_url': a.server_url,
+        'node_port': a.node_port,
+        'workload_name': a.workload_name,
+        'activation_date': a.activation_date,
+        'suspended': a.status == AppStatus.SUSPENDED.value,
+        'busy': a.id in busy
+    } for a, username, s in rows]
+
+
+def deploy_application(spec: dict, node_port: int = None):
+    """
+    Deploy the application on the cluster and store its agent configuration file
+    :param spec: deployment specification, see get_deploy_spec
+    :param node_port: pre-allocated NodePort, owned by the caller, otherwise a port is allocated
+            for the applications with a tcp port and released if the deployment fails
+    :return: dictionary with the application's server_url, node_port and agent_cfg_filename
+    """
+    cfg = Config.k8s
+    namespace = cfg['namespace']
+
+    activation_date = datetime.utcnow()
+    url = '-'
+    env_dict = dict()
+    app_name = spec['app_name']
+    app_unique = uuid.uuid4().hex[:6]
+    n_port = None
+    labels = owner_labels(app_name, user_id=spec['user_id'], application_id=spec['id'])
+
+    # it won't be used if it's not an http service
+    ports = {
+        'tcp': {'source': spec['tcp_port'], 'target': None},
+        'http': {'source': spec['http_port'], 'target': None}
+    }
+
+    # the port lease is confirmed before any object is created, an expired lease can't orphan the objects
+    own_port = node_port is None and bool(spec['tcp_port'])
+    if own_port:
+        node_port = kubernetes.open_ports.get_available_port()
+    try:
+        if node_port is not None:
+            kubernetes.open_ports.confirm_port(node_port, spec['id'])
+    except Exception:
+        if own_port:
+            kubernetes.open_ports.release_port(node_port)
+        raise
+
+    # the application runs on a standby deployment of the service's warm pool if one is available
+    workload = claim_standby(spec, labels)
+
+    try:
+        if spec['http_port']:
+
+            url = "https://" + app_unique + "." + cfg['host']
+            if spec['tcp_port']:
+                n_port = kubernetes.deploy_dual_port_application(app_name=app_name, uuid=app_unique,
+                                                                 image=spec['image'], namespace=namespace, ports=ports,
+                                                                 host=cfg['host'], iam=spec['iam'], url=url,
+                                                                 node_port=node_port, labels=labels, workload=workload,
+                                                                 profile=spec['profile'],
+                                                                 ingress_profile=spec['ingress_profile'],
+                                                                 iam_mode=spec['iam_mode'])
+                env_dict['SERVER_URL'] = url
                 env_dict['SERVER_IP'] = cfg['cluster_ip']
                 env_dict['SERVER_TCP_PORT'] = n_port
 
             else:
-                msg = "Unknown application type"
-                current_app.logger.error(msg)
-                current_app.logger.error("Error occurred in application.activate function")
-                raise K8sError(msg)
+                kubernetes.deploy_http_application(app_name=app_name, uuid=app_unique, image=spec['image'],
+                                                   namespace=namespace, ports=ports, host=cfg['host'],
+                                                   iam=spec['iam'], url=url, labels=labels,
+                                                   workload=workload, profile=spec['profile'],
+                                                   ingress_profile=spec['ingress_profile'],
+                                                   iam_mode=spec['iam_mode'])
+                env_dict['SERVER_URL'] = url
+
+        elif spec['tcp_port']:
+            if spec['iam']:
+                raise BadRequest("Can't deploy socket application with IAM")
+
+            n_port = kubernetes.deploy_tcp_application(app_name=app_name, uuid=app_unique, image=spec['image'],
+                                                       namespace=namespace, ports=ports, host=cfg['host'],
+                                                       node_port=node_port, labels=labels, workload=workload,
+                                                       profile=spec['profile'])
+            env_dict['SERVER_IP'] = cfg['cluster_ip']
+            env_dict['SERVER_TCP_PORT'] = n_port
 
-            # save env list file
-            create_agent_cfg_file(app_name=a.name, usr=user.username, env_dict=env_dict)
-            a.agent_cfg_filename = cfg['agent']['cfg_file']
+        else:
+            msg = "Unknown application type"
+            current_app.logger.error(msg)
+            current_app.logger.error("Error occurred in application.activate function")
+            raise K8sError(msg)
 
-            # update application's data in the DB
-            a.node_port = n_port
-            a.status = AppStatus.ACTIVE.value
-            a.server_url = url
+    except Exception:
+        if workload:
+            discard_standby(workload)
+        if own_port:
+            kubernetes.open_ports.release_port(node_port)
+        raise
 
-            db.session.commit()
+    # save env list file
+    create_agent_cfg_file(app_name=spec['name'], usr=spec['username'], env_dict=env_dict)
 
-        else:
-            flash('The application is already active')
+    return {'server_url': url, 'node_port': n_port, 'agent_cfg_filename': cfg['agent']['cfg_file'],
+            'activation_date': activation_date, 'workload_name': workload + '-deployment' if workload else None,
+            'iam_mode': spec['iam_mode']}
 
-    except K8sError as e:
-        current_app.logger.error("Error occurred in application.activate K8s side")
-        current_app.logger.exception(e)
-        flash('Error occurred in application activation')
 
+def claim_standby(spec: dict, labels: dict):
+    """
+    Claim a standby deployment from the service's warm pool, IAM applications with a gatekeeper sidecar
+    configured with their url always get a deployment of their own
+    :param spec: deployment specification, see get_deploy_spec
+    :param labels: application's ownership labels
+    :return: claimed instance name or None
+    """
+    if kubernetes.gatekeeper(spec['iam'], spec['iam_mode']) or not spec['warm_pool_size'] or warm_pool.interval <= 0:
+        return None
+
+    try:
+        workload = kubernetes.claim_standby(spec['service_id'], spec['image'], Config.k8s['namespace'], labels,
+                                            replicas=spec['profile']['min_replicas'])
     except Exception as e:
-        current_app.logger.error("Error occurred in application.activate function")
+        current_app.logger.error("Error occurred in claim of a standby deployment, deploying from scratch")
         current_app.logger.exception(e)
+        return None
 
-    finally:
-        response = redirect(url_for('application.index'))
-        response.autocorrect_location_header = False
-        return response
+    if workload:
+        warm_pool.wake()
+    return workload
 
 
-@bp.route('/<int:id>/terminate', methods=('POST',))
-@login_required
-def terminate(id):
+def discard_standby(workload: str):
+    """
+    Delete a claimed standby deployment after a failed activation, it carries the application's labels already
+    :param workload: instance name
+    :return:
+    """
+    try:
+        kubernetes.delete_object('deployment', workload + '-deployment', Config.k8s['namespace'])
+    except K8sError:
+        current_app.logger.error("Claimed standby deployment [{}] wasn't deleted".format(workload))
+
+
+def undeploy_application(spec: dict, release_port: bool = True):
+    """
+    Delete the application from the cluster, its objects are selected by the application id label
+    :param spec: deployment specification, see get_deploy_spec
+    :param release_port: whether to return the application's NodePort to the pool
+    :return:
+    """
+    namespace = Config.k8s['namespace']
+    app_name = spec['app_name']
+
+    if kubernetes.delete_collection(namespace, owner_selector(application_id=spec['id'])):
+        if release_port and spec['node_port']:
+            kubernetes.open_ports.release_port(spec['node_port'])
+        return
+
+    # the application was deployed before its objects were labelled, delete them by their names
+    node_port = spec['node_port'] if release_port else None
+
+    if spec['server_url'] and spec['node_port']:
+        kubernetes.terminate_service(name=app_name, namespace=namespace, type='dual', node_port=node_port,
+                                     iam=spec['iam'], iam_mode=spec['iam_mode'])
+
+    elif spec['server_url']:
+        kubernetes.terminate_service(name=app_name, namespace=namespace, type='http', iam=spec['iam'],
+                                     iam_mode=spec['iam_mode'])
+
+    elif spec['node_port']:
+        kubernetes.terminate_service(name=app_name, namespace=namespace, type='tcp', node_port=node_port)
 
+    else:
+        msg = "Unknown application type"
+        current_app.logger.error(msg)
+        current_app.logger.error("Error occurred in application.terminate function")
+        raise K8sError(msg)
+
+
+def teardown_applications(username: str = None):
+    """
+    Delete the applications of a user or of the whole platform with a few label selected calls,
+    applications deployed before their objects were labelled are deleted one by one
+    :param username: applications' owner name, if not provided all the applications are deleted
+    :return: list of the terminated applications' names
+    """
+    query = Application.query.filter(Application.status.in_(DEPLOYED_APP_STATUSES))
+    if username is not None:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise NotFound("User {} doesn't exist".format(username))
+        query = query.filter(Application.user_id == user.id)
+        selector = owner_selector(user_id=user.id)
+    else:
+        selector = owner_selector()
+
+    apps = query.all()
+    deleted = kubernetes.delete_collection(Config.k8s['namespace'], selector)
+
+    terminated = []
+    for a in apps:
+        spec = get_deploy_spec(a)
+        try:
+            if spec['app_name'] not in deleted:
+                undeploy_application(spec)
+            elif a.node_port:
+                kubernetes.open_ports.release_port(a.node_port)
+        except Exception as e:
+            current_app.logger.error("Error occurred in teardown of application [{}]".format(a.id))
+            current_app.logger.exception(e)
+            continue
+        mark_terminated(a)
+        terminated.append(spec['app_name'])
+
+    db.session.commit()
+    return terminated
+
+
+def mark_active(a: Application, result: dict):
+    """
+    Update application's data in the session after a successful deployment, the caller commits
+    :param a: application
+    :param result: deploy_application result
+    :return:
+    """
+    a.agent_cfg_filename = result['agent_cfg_filename']
+    a.node_port = result['node_port']
+    # the readiness tracker moves the application to READY once its deployment is available
+    a.status = AppStatus.PROVISIONING.value
+    a.server_url = result['server_url']
+    a.activation_date = result['activation_date']
+    a.ready_date = None
+    a.time_to_ready = None
+    a.workload_name = result['workload_name']
+    a.iam_mode = result['iam_mode']
+
+
+def mark_terminated(a: Application):
+    """
+    Update application's data in the session after it was deleted from the cluster, the caller commits
+    :param a: application
+    :return:
+    """
+    a.status = AppStatus.TERMINATED.value
+    a.server_url = None
+    a.node_port = None
+    a.agent_cfg_filename = None
+    a.workload_name = None
+    a.iam_mode = None
+
+
+def get_batch_applications(ids: list = None, username: str = None, service_id: int = None, owner_id: int = None):
+    """
+    Retrieve applications by ids and/or filters, at least one of ids, username or service_id should be provided
+    :param ids: application ids
+    :param username: applications' owner name
+    :param service_id: applications' service id
+    :param owner_id: if provided, only the applications of this user are retrieved
+    :return: list of applications
+    """
+    if not ids and username is None and service_id is None:
+        raise BadRequest("Application ids or a filter should be provided")
+
+    query = Application.query
+    if ids:
+        query = query.filter(Application.id.in_(ids))
+    if username is not None:
+        query = query.join(User, Application.user_id == User.id).filter(User.username == username)
+    if service_id is not None:
+        query = query.filter(Application.service_id == service_id)
+    if owner_id is not None:
+        query = query.filter(Application.user_id == owner_id)
+
+    return query.order_by(Application.id).all()
+
+
+def run_batch(apps: list, action: str, concurrency: int = None, user_id: int = None):
+    """
+    Activate or terminate several applications, the K8s operations run concurrently
+    while the ports are allocated at once and all the DB updates are committed in a single transaction.
+    Every application gets a running job for the duration of the batch, so the batch doesn't overlap
+    with the other operations on the application
+    :param apps: list of applications
+    :param action: one of JobAction values
+    :param concurrency: maximal number of applications deployed or deleted at the same time
+    :param user_id: id of the user who runs the batch, the applications' owners if not provided
+    :return: list of per application results
+    """
+    batch_jobs = {}
     try:
-        cfg = Config.k8s
-        namespace = cfg['namespace']
-        a = get_application(id, g.user['id'])
+        return _run_batch(apps, action, concurrency, user_id, batch_jobs)
+
+    except Exception:
+        # the batch's jobs don't stay running after an unexpected error
+        db.session.rollback()
+        for job in Job.query.filter(Job.id.in_([j.id for j in batch_jobs.values()]),
+                                    Job.active_application_id.isnot(None)):
+            jobs.executor.finish(job, error='Interrupted')
+        db.session.commit()
+        raise
 
-        if a.status != AppStatus.ACTIVE.value:
-            flash("Can not terminate not ACTIVE application {0}".format(a.name))
 
+def _run_batch(apps: list, action: str, concurrency: int, user_id: int, batch_jobs: dict):
+    """
+    see run_batch
+    :param batch_jobs: filled with the jobs started for the applications by their ids
+    """
+    activate = action == JobAction.ACTIVATE.value
+    concurrency = concurrency or Config.k8s['batch_concurrency']
+    results = {}
+    specs = {}
+
+    for a in apps:
+        results[a.id] = {'id': a.id, 'name': a.name, 'status': 'skipped', 'error': None}
+        if activate and a.status in DEPLOYED_APP_STATUSES:
+            results[a.id]['error'] = 'The application is already active'
+        elif not activate and a.status not in DEPLOYED_APP_STATUSES:
+            results[a.id]['error'] = 'The application is not active'
         else:
-            app_name = get_app_name(a.name, g.user['username'])
+            try:
+                batch_jobs[a.id] = jobs.executor.begin(a.id, user_id or a.user_id, action)
+            except Conflict:
+                results[a.id]['error'] = 'Another operation is in progress'
+                continue
+            specs[a.id] = get_deploy_spec(a)
+
+    node_ports = {}
+    if activate:
+        with_tcp = [i for i, sp in specs.items() if sp['tcp_port']]
+        node_ports = dict(zip(with_tcp, allocate_ports(len(with_tcp))))
+        # the applications left without a port fail, the others are deployed
+        for i in with_tcp[len(node_ports):]:
+            del specs[i]
+            results[i]['status'] = 'failed'
+            results[i]['error'] = 'No available ports'
+
+    app = current_app._get_current_object()
+
+    def run(spec):
+        with app.app_context():
+            if activate:
+                return deploy_application(spec, node_port=node_ports.get(spec['id']))
+            return undeploy_application(spec, release_port=False)
+
+    done = {}
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {pool.submit(run, sp): i for i, sp in specs.items()}
+        for f in as_completed(futures):
+            i = futures[f]
+            try:
+                done[i] = f.result()
+                results[i]['status'] = 'succeeded'
+            except Exception as e:
+                current_app.logger.error("Error occurred in batch {} of application [{}]".format(action, i))
+                current_app.logger.exception(e)
+                results[i]['status'] = 'failed'
+                results[i]['error'] = getattr(e, 'message', None) or str(e)
+
+    if activate:
+        kubernetes.open_ports.release_ports([p for i, p in node_ports.items() if i not in done])
+
+    released = []
+    for a in apps:
+        if a.id in batch_jobs:
+            failed = results[a.id]['status'] != 'succeeded'
+            jobs.executor.finish(batch_jobs[a.id], error=(results[a.id]['error'] or 'Failed') if failed else None)
+        if a.id not in done:
+            continue
+        if activate:
+            mark_active(a, done[a.id])
+            results[a.id].update(server_url=a.server_url, node_port=a.node_port)
+        else:
+            if a.node_port:
+                released.append(a.node_port)
+            mark_terminated(a)
 
-            if a.server_url and a.node_port:
-                kubernetes.terminate_service(name=app_name, namespace=namespace, type='dual', node_port=a.node_port,
-                                             iam=a.iam)
+    db.session.commit()
+    kubernetes.open_ports.release_ports(released)
+    if activate:
+        for i in done:
+            readiness_tracker.track(specs[i]['app_name'], i)
+    current_app.logger.info("Batch {} of {} applications finished".format(action, len(apps)))
 
-            elif a.server_url:
-                kubernetes.terminate_service(name=app_name, namespace=namespace, type='http', iam=a.iam)
+    return [results[a.id] for a in apps]
 
-            elif a.node_port:
-                kubernetes.terminate_service(name=app_name, namespace=namespace, type='tcp', node_port=a.node_port)
 
-            else:
-                msg = "Unknown application type"
-                current_app.logger.error(msg)
-                current_app.logger.error("Error occurred in application.activate function")
-                raise K8sError(msg)
+def allocate_ports(count: int):
+    """
+    Allocate as many of the ports as available
+    :param count: number of requested ports
+    :return: list of allocated ports, shorter than count if the pool ran out
+    """
+    if not count:
+        return []
 
+    try:
+        return kubernetes.open_ports.get_available_ports(count)
     except K8sError:
-        current_app.logger.info("Wasn't able to terminate the application")
-        flash("Wasn't able to terminate the application")
+        current_app.logger.warning("Less than {} ports are available, allocating them one by one".format(count))
 
-    except Exception as e:
-        current_app.logger.error('Error occurred in terminate application [{}]'.format(a.id))
-        current_app.logger.exception(e)
+    ports = []
+    while len(ports) < count:
+        try:
+            ports.append(kubernetes.open_ports.get_available_port())
+        except K8sError:
+            break
+    return ports
 
-    else:
-        # update application's data in the DB
-        a.status = AppStatus.TERMINATED.value
-        a.server_url = None
-        a.node_port = None
-        a.agent_cfg_filename = None
-        db.session.commit()
 
-    finally:
-        response = redirect(url_for('application.index'))
+def submit_job(a: Application, action: JobAction, msg: str):
+    """
+    Enqueue a background job for the application,
+    json clients get 202 with the job status location, others are redirected to the applications page
+    :param a: application
+    :param action: job action
+    :param msg: message to flash, formatted with the application name
+    :return: response
+    """
+    try:
+        job = jobs.executor.submit(a.id, g.user['id'], action.value)
+
+    except Conflict as e:
+        return reject_request(e.message)
+
+    if wants_json():
+        response = jsonify(job_to_dict(job))
+        response.status_code = 202
+        response.headers['Location'] = url_for('application.job_status', id=job.id)
         response.autocorrect_location_header = False
         return response
 
+    flash(msg.format(a.name))
+    response = redirect(url_for('application.index'))
+    response.autocorrect_location_header = False
+    return response
+
+
+def reject_request(msg: str):
+    """
+    :param msg: reason
+    :return: redirect to the applications page with flashed message, json clients get 409
+    """
+    if wants_json():
+        raise Conflict(msg)
+
+    flash(msg)
+    response = redirect(url_for('application.index'))
+    response.autocorrect_location_header = False
+    return response
+
+
+def wants_json():
+    """:return: whether the client prefers json response over html page"""
+    return request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'application/json'
+
 
 @bp.route('/<int:id>/<string:cfg_filename>/download_cfg/', methods=('GET', 'POST'))
 @login_required
@@ -327,6 +1011,13 @@ def download_cfg(id, cfg_filename):
 
     app = get_application(id, g.user['id'])
 
+    if app.agent_cfg_filename == cfg_filename and app.status == AppStatus.PROVISIONING.value:
+        # agents should not connect before the server is reachable
+        response = jsonify({'message': 'The application is provisioning', 'status': AppStatus(app.status).name})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(get_retry_after(app))
+        return response
+
     if app.server_cfg_filename == cfg_filename or app.agent_cfg_filename == cfg_filename:
 
         uploads = build_path(app.name, g.user['username'])
@@ -388,6 +1079,48 @@ def get_app_by_user(id: int, user_id: int):
     return Application.query.filter_by(id=id, user_id=user_id).first()
 
 
+def get_readiness(a: Application, username: str):
+    """
+    :param a: application
+    :param username: application's owner name
+    :return: readiness summary from the cluster state cache, None if the cache isn't synced yet
+    """
+    return cluster_state.readiness(get_app_name(a.name, username))
+
+
+def get_retry_after(a: Application):
+    """
+    Estimate when a provisioning application becomes ready from the previous activations of its service
+    :param a: application
+    :return: seconds, between 1 and 60
+    """
+    expected = db.session.query(func.avg(Application.time_to_ready)) \
+        .filter(Application.service_id == a.service_id, Application.time_to_ready.isnot(None)).scalar()
+    elapsed = (datetime.utcnow() - a.activation_date).total_seconds() if a.activation_date else 0
+    remaining = (expected or 10) - elapsed
+
+    return int(min(60, max(1, remaining)))
+
+
+def get_latest_jobs(user_id: int):
+    """
+    Retrieve the latest job of each of the user's applications
+    :param user_id: user id
+    :return: dictionary of application id to job
+    """
+    latest = db.session.query(func.max(Job.id)).filter(Job.user_id == user_id).group_by(Job.application_id)
+    return {j.application_id: j for j in Job.query.filter(Job.id.in_(latest)).all()}
+
+
+def get_used_node_ports():
+    """
+    Retrieve the node ports of all the applications
+    :return: list of ports
+    """
+    rows = db.session.query(Application.node_port).filter(Application.node_port.isnot(None)).distinct().all()
+    return [r.node_port for r in rows]
+
+
 def get_app(id: int):
     """
     Retrieve application by application id
@@ -456,3 +1189,9 @@ def create_agent_cfg_file(app_name, usr, env_dict):
             f.write(line)
         f.write("\n")
         return config_path
+
+
+jobs.executor.register(JobAction.ACTIVATE.value, activate_application)
+jobs.executor.register(JobAction.TERMINATE.value, terminate_application)
+jobs.executor.register(JobAction.SUSPEND.value, suspend_application)
+jobs.executor.register(JobAction.RESUME.value, resume_application)
@@ -61,10 +61,88 @@ class Config(object):
         'open_ports_range': {
             'start': 32000,
             'end': 32050
-        }
+        },
+        # 'memory' keeps the ports in the process, 'db' leases them in the database,
+        # which is required when the dashboard runs with several workers or replicas
+        'port_allocator': os.getenv('PORT_ALLOCATOR', 'memory'),
+        # seconds after which a port that was leased but not confirmed by an activation is reclaimed
+        'port_lease_ttl': int(os.getenv('PORT_LEASE_TTL', 300)),
+        # number of threads that create the application's K8s objects concurrently
+        'deploy_workers': int(os.getenv('K8S_DEPLOY_WORKERS', 8)),
+        # default number of applications activated/terminated concurrently by a batch request
+        'batch_concurrency': int(os.getenv('K8S_BATCH_CONCURRENCY', 4)),
+        # optional label selector of the deployments, pods and services kept in the cluster state cache
+        'watch_label_selector': os.getenv('K8S_WATCH_LABEL_SELECTOR', None),
+        # connections kept open to the API server, 0 sizes the pool to the deploy, job, batch and watch concurrency
+        'api_pool_size': int(os.getenv('K8S_API_POOL_SIZE', 0)),
+        # seconds to wait for establishing a connection and for a response of the API server
+        'api_connect_timeout': float(os.getenv('K8S_API_CONNECT_TIMEOUT', 5)),
+        'api_read_timeout': float(os.getenv('K8S_API_READ_TIMEOUT', 30)),
+        # client side rate limit of the API server calls, calls per second and burst
+        'api_qps': float(os.getenv('K8S_API_QPS', 20)),
+        'api_burst': int(os.getenv('K8S_API_BURST', 40)),
+        # retries of throttled (429), failed (5xx) and conflicting calls, with jittered exponential backoff
+        'api_max_retries': int(os.getenv('K8S_API_MAX_RETRIES', 4)),
+        'api_backoff_base': float(os.getenv('K8S_API_BACKOFF_BASE', 0.5)),
+        'api_backoff_max': float(os.getenv('K8S_API_BACKOFF_MAX', 30)),
+        # consecutive API server failures after which the calls fail fast for api_circuit_reset seconds
+        'api_circuit_failures': int(os.getenv('K8S_API_CIRCUIT_FAILURES', 5)),
+        'api_circuit_reset': float(os.getenv('K8S_API_CIRCUIT_RESET', 30)),
+        # seconds between reconciliations of the applications table with the cluster, 0 disables it
+        'reconcile_interval': int(os.getenv('RECONCILE_INTERVAL', 60)),
+        # seconds during which new objects and applications are left alone by the reconciliation
+        'reconcile_grace_period': int(os.getenv('RECONCILE_GRACE_PERIOD', 300)),
+        # maximal number of objects deleted or recreated by a single reconciliation
+        'reconcile_batch_size': int(os.getenv('RECONCILE_BATCH_SIZE', 20)),
+        # seconds without any request logged by the gatekeeper sidecar after which an IAM application is scaled
+        # to zero, 0 disables it, the applications with a NodePort or without the sidecar are never suspended
+        'idle_suspend_after': int(os.getenv('IDLE_SUSPEND_AFTER', 0)),
+        # seconds between the checks of the applications' activity
+        'idle_check_interval': int(os.getenv('IDLE_CHECK_INTERVAL', 300)),
+        # seconds between the refills of the services' warm pools of standby deployments, 0 disables them
+        'warm_pool_interval': int(os.getenv('WARM_POOL_INTERVAL', 30)),
+        # pull the services' server images on all the nodes when they're registered or changed
+        'prepull_images': os.getenv('PREPULL_IMAGES', 'true').lower() == 'true',
+        'prepull_pause_image': os.getenv('PREPULL_PAUSE_IMAGE', 'k8s.gcr.io/pause:3.2'),
+        # image with a static busybox, its binary runs in the server image which might have no shell
+        'prepull_tools_image': os.getenv('PREPULL_TOOLS_IMAGE', 'busybox:1.33.1-musl'),
+        # 'dedicated' creates an ingress per application, 'shared' adds the applications' host rules to a few
+        # shared ingresses, which spares the ingress controller a reload per activation
+        'ingress_mode': os.getenv('INGRESS_MODE', 'dedicated'),
+        # number of shared ingresses per annotation set
+        'ingress_shards': int(os.getenv('INGRESS_SHARDS', 4)),
+        # seconds during which the rule changes are collected and applied as a single update per shared ingress
+        'ingress_batch_window': float(os.getenv('INGRESS_BATCH_WINDOW', 0.5)),
+        # ingress controller whose annotations render the services' ingress profiles, 'bluemix' or 'nginx'
+        'ingress_controller': os.getenv('INGRESS_CONTROLLER', 'bluemix'),
+        # 'sidecar' runs a gatekeeper in each IAM application's pods, 'ingress' authenticates the requests
+        # with the shared auth proxy of k8s/oauth2-proxy.yaml through the ingress, which requires the nginx controller
+        # the applications keep the mode they were activated with until they're terminated
+        'iam_mode': os.getenv('IAM_MODE', 'sidecar'),
+        'iam_auth_url': os.getenv('IAM_AUTH_URL', 'http://oauth2-proxy.papaya.svc.cluster.local/oauth2/auth'),
+        # the auth proxy's sign in page, the users are redirected back to the requested url afterwards
+        'iam_signin_url': os.getenv('IAM_SIGNIN_URL', 'https://auth.<Ingress Subdomain>/oauth2/start'
+                                                      '?rd=$scheme://$host$escaped_request_uri')
+    }
+
+    jobs = {
+        # number of activations/terminations that run concurrently in the background
+        'workers': int(os.getenv('JOB_WORKERS', 4)),
+        # seconds without a heartbeat after which a running job is marked as failed, its process is gone
+        'stale_after': int(os.getenv('JOB_STALE_AFTER', 120)),
+        # seconds between the heartbeats of the running jobs, the stale jobs are looked for at the same interval
+        'heartbeat_interval': int(os.getenv('JOB_HEARTBEAT_INTERVAL', 30))
+    }
+
+    metrics = {
+        # bearer token of the Prometheus scrapes of /metrics, without it only the logged in users can read them
+        'token': os.getenv('METRICS_TOKEN')
     }
 
     logging = {
+        # 'es' reads the logs from Elasticsearch, 'pods' from the running pods, 'auto' reads the newest logs
+        # and the live tail from the pods, which have them without the ingestion lag, and the history from ES
+        'source': os.getenv('LOG_SOURCE', 'auto'),
         'kibana': {
             'host': 'kibana.kube-logging.svc',
             'port': 5601
@@ -72,6 +150,39 @@ class Config(object):
         'es': {
             'host': 'elasticsearch.kube-logging.svc',
             'port': 9200,
-            'index': "filebeat*"
+            'index': "filebeat*",
+            # keyword fields of filebeat's kubernetes metadata, the logs are looked up by exact terms
+            'fields': {
+                'namespace': os.getenv('ES_NAMESPACE_FIELD', 'kubernetes.namespace'),
+                'app': os.getenv('ES_APP_FIELD', 'kubernetes.labels.app'),
+                'container': os.getenv('ES_CONTAINER_FIELD', 'kubernetes.container.name')
+            },
+            # look the logs up by their file path when no log carries the kubernetes metadata
+            'path_fallback': os.getenv('ES_PATH_FALLBACK', 'true').lower() == 'true',
+            # keyword field unique per line which breaks the ties of the sort, e.g. a keyword copy of _id
+            # set by an ingest pipeline, the file path is unique per pod and container
+            'tiebreaker': os.getenv('ES_TIEBREAKER_FIELD', 'log.file.path'),
+            # page through a point in time of the index, so the pages stay the same while logs are indexed,
+            # requires ES 7.12, the point in time is kept alive for point_in_time_keep_alive between the pages
+            'point_in_time': os.getenv('ES_POINT_IN_TIME', 'false').lower() == 'true',
+            'point_in_time_keep_alive': os.getenv('ES_POINT_IN_TIME_KEEP_ALIVE', '5m')
+        },
+        'cache': {
+            # number of cached log pages per worker, 0 disables the cache
+            'size': int(os.getenv('LOG_CACHE_SIZE', 512)),
+            # seconds the newest page is cached for, it changes with every new line
+            'head_ttl': float(os.getenv('LOG_CACHE_HEAD_TTL', 5)),
+            # seconds the pages with newer lines after them are cached for, their lines don't change
+            'page_ttl': float(os.getenv('LOG_CACHE_PAGE_TTL', 300)),
+            # seconds a line may take to be indexed, the pages with newer lines are cached for head_ttl only
+            'ingestion_lag': float(os.getenv('LOG_CACHE_INGESTION_LAG', 60))
+        },
+        'tail': {
+            # seconds between the polls of the followed logs, a full batch is followed by the next one immediately
+            'interval': float(os.getenv('LOG_TAIL_INTERVAL', 2)),
+            # maximal number of lines sent as a single event
+            'batch_size': int(os.getenv('LOG_TAIL_BATCH_SIZE', 200)),
+            # seconds after which the stream is closed, the browser reconnects and resumes after the last event
+            'max_seconds': int(os.getenv('LOG_TAIL_MAX_SECONDS', 600))
         }
     }
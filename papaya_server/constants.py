@@ -29,8 +29,32 @@ class ServiceStatus(Enum):
 
 class AppStatus(Enum):
     CREATED = 0
+    # deployed before the readiness tracking, treated as ready
     ACTIVE = 1
     TERMINATED = 2
+    # the K8s objects were created and the deployment isn't available yet
+    PROVISIONING = 3
+    READY = 4
+    # the deployment won't become available without an intervention, e.g. image pull errors or crash loops
+    FAILED = 5
+    # the deployment is scaled to zero, the service, ingress, configuration map and NodePort are kept
+    SUSPENDED = 6
 
 
+# statuses of applications which have objects on the cluster
+DEPLOYED_APP_STATUSES = (AppStatus.ACTIVE.value, AppStatus.PROVISIONING.value, AppStatus.READY.value,
+                         AppStatus.FAILED.value, AppStatus.SUSPENDED.value)
 
+
+class JobStatus(Enum):
+    PENDING = 0
+    RUNNING = 1
+    SUCCEEDED = 2
+    FAILED = 3
+
+
+class JobAction(Enum):
+    ACTIVATE = 'activate'
+    TERMINATE = 'terminate'
+    SUSPEND = 'suspend'
+    RESUME = 'resume'
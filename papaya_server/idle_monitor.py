@@ -0,0 +1,141 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+This package suspends idle applications: an application whose IAM gatekeeper didn't log any request for idle_after
+seconds is scaled to zero, its service, ingress and configuration map are kept so it resumes on the same host.
+The applications without a request logging container, the ones with a NodePort or authenticated by the ingress,
+have no activity signal and are never suspended.
+"""
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable
+
+from sqlalchemy import or_
+
+from papaya_server.constants import AppStatus
+from papaya_server.k8s_client import GATEKEEPER_CONTAINER
+from papaya_server.models import Application, User
+
+logger = logging.getLogger(__name__)
+
+# applications which serve traffic and can be suspended
+RUNNING_STATUSES = (AppStatus.ACTIVE.value, AppStatus.READY.value)
+
+
+class IdleMonitor:
+    """Checks the running applications' activity every interval seconds in a background thread"""
+
+    def __init__(self, k8s, cache, namespace: str, name_fn: Callable[[str, str], str],
+                 suspend_fn: Callable[[Application], None], idle_after: int = 0, interval: int = 300):
+        """
+        :param k8s: K8s client
+        :param cache: cluster state cache, the applications' pods are taken from it
+        :param namespace: applications namespace
+        :param name_fn: maps application name and username to the K8s application name
+        :param suspend_fn: suspends the application
+        :param idle_after: seconds without activity after which an application is suspended, 0 disables it
+        :param interval: seconds between the checks
+        """
+        self._k8s = k8s
+        self._cache = cache
+        self._namespace = namespace
+        self._name_fn = name_fn
+        self._suspend_fn = suspend_fn
+        self.idle_after = idle_after
+        self.interval = interval
+        self._app = None
+        self._stop = threading.Event()
+        # application id to the date it logged last, an application isn't checked again before it may be idle
+        self._last_active = {}
+
+
+    def init_app(self, app):
+        self._app = app
+
+
+    def start(self):
+        if self.idle_after <= 0:
+            logger.info("Suspension of idle applications is disabled")
+            return
+
+        threading.Thread(target=self._run, name='idle-monitor', daemon=True).start()
+
+
+    def stop(self):
+        self._stop.set()
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with self._app.app_context():
+                    self.check()
+            except Exception as e:
+                logger.error("Error occurred in idle applications check")
+                logger.exception(e)
+
+
+    def check(self):
+        """
+        Suspend the running applications which were idle for idle_after seconds, should run within app context
+        :return: list of the suspended applications' ids
+        """
+        if not self._cache.synced:
+            return []
+
+        threshold = datetime.utcnow() - timedelta(seconds=self.idle_after)
+        # the applications activated or resumed recently are left alone
+        # the agents of a NodePort application may be connected without any request being logged
+        rows = Application.query.join(User, User.id == Application.user_id) \
+            .filter(Application.status.in_(RUNNING_STATUSES)) \
+            .filter(Application.iam, Application.node_port.is_(None)) \
+            .filter(Application.activation_date < threshold) \
+            .filter(or_(Application.resume_date.is_(None), Application.resume_date < threshold)) \
+            .with_entities(Application, User.username).all()
+        # only the gatekeeper sidecar logs the requests, the running applications activated before
+        # the IAM mode was stored run it
+        rows = [(a, username) for a, username in rows if self._k8s.gatekeeper(a.iam, a.iam_mode or 'sidecar')]
+        self._last_active = {i: d for i, d in self._last_active.items() if i in {a.id for a, _ in rows}}
+
+        suspended = []
+        for a, username in rows:
+            if self._last_active.get(a.id, threshold) > threshold:
+                # it served a request within the period, it can't be idle yet
+                continue
+            pods = self._cache.pods.by_label(self._name_fn(a.name, username))
+            if not pods:
+                continue
+            try:
+                last = self._k8s.last_log_date(pods, self._namespace, self.idle_after,
+                                               containers=[GATEKEEPER_CONTAINER])
+                if last is not None:
+                    self._last_active[a.id] = last
+                    continue
+                logger.info("{} was idle for {}s, suspending it".format(a, self.idle_after))
+                self._suspend_fn(a)
+                suspended.append(a.id)
+            except Exception as e:
+                logger.error("Error occurred in idle check of {}".format(a))
+                logger.exception(e)
+
+        return suspended
@@ -0,0 +1,177 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+This package renders the services' ingress profiles as the annotations of the cluster's ingress controller.
+A profile tunes the transport of the server's http endpoint: the request body size, the timeouts, the keep-alive,
+the proxy buffering and the backend protocol, e.g. gRPC streams or multi GB model updates.
+The renderers also delegate the authentication of the IAM applications to a shared auth proxy, see K8s.iam_mode.
+"""
+from abc import ABC, abstractmethod
+from urllib.parse import urlencode
+
+# the values used before the profiles were introduced
+DEFAULT_PROFILE = {
+    'body_size': '300m',
+    'connect_timeout': 600,
+    'read_timeout': 600,
+    'keepalive_timeout': None,
+    'buffering': True,
+    'backend_protocol': 'HTTP'
+}
+
+
+class AnnotationRenderer(ABC):
+    """Common interface of the ingress controllers' annotation renderers"""
+
+    # backend protocols supported by the controller
+    protocols = ('HTTP',)
+    # whether the controller can authenticate the requests with an auth proxy, see render_auth
+    external_auth = False
+
+
+    @abstractmethod
+    def render(self, profile: dict, service_name: str) -> dict:
+        """
+        :param profile: complete ingress profile, see DEFAULT_PROFILE
+        :param service_name: backend service name
+        :return: ingress annotations
+        """
+        pass
+
+
+    def render_auth(self, auth: dict) -> dict:
+        """
+        :param auth: external authentication, see K8s.ingress_auth
+        :return: ingress annotations which authenticate the requests with the auth proxy
+        """
+        raise ValueError("{} doesn't support external authentication".format(self.__class__.__name__))
+
+
+class BluemixRenderer(AnnotationRenderer):
+    """IBM Cloud Kubernetes Service ALB"""
+
+    protocols = ('HTTP', 'HTTPS')
+
+
+    def render(self, profile: dict, service_name: str) -> dict:
+        annotations = {
+            # require https connection
+            "ingress.bluemix.net/redirect-to-https": "true",
+            # maximal package size between the server side component and the client
+            "ingress.bluemix.net/client-max-body-size": profile['body_size'],
+            "ingress.bluemix.net/proxy-connect-timeout": "timeout={}s".format(profile['connect_timeout']),
+            "ingress.bluemix.net/proxy-read-timeout": "timeout={}s".format(profile['read_timeout'])
+        }
+        if profile['keepalive_timeout']:
+            annotations["ingress.bluemix.net/keepalive-timeout"] = "timeout={}s".format(profile['keepalive_timeout'])
+        if not profile['buffering']:
+            annotations["ingress.bluemix.net/proxy-buffering"] = "enabled=false"
+        if profile['backend_protocol'] == 'HTTPS':
+            annotations["ingress.bluemix.net/ssl-services"] = "ssl-service={}".format(service_name)
+        return annotations
+
+
+class NginxRenderer(AnnotationRenderer):
+    """Kubernetes community ingress-nginx controller"""
+
+    protocols = ('HTTP', 'HTTPS', 'GRPC', 'GRPCS')
+    external_auth = True
+
+
+    def render(self, profile: dict, service_name: str) -> dict:
+        buffering = 'on' if profile['buffering'] else 'off'
+        annotations = {
+            "nginx.ingress.kubernetes.io/force-ssl-redirect": "true",
+            "nginx.ingress.kubernetes.io/proxy-body-size": profile['body_size'],
+            "nginx.ingress.kubernetes.io/proxy-connect-timeout": str(profile['connect_timeout']),
+            "nginx.ingress.kubernetes.io/proxy-read-timeout": str(profile['read_timeout']),
+            "nginx.ingress.kubernetes.io/proxy-send-timeout": str(profile['read_timeout']),
+            # streamed uploads and downloads aren't spooled to the controller's disk when buffering is off
+            "nginx.ingress.kubernetes.io/proxy-buffering": buffering,
+            "nginx.ingress.kubernetes.io/proxy-request-buffering": buffering,
+            "nginx.ingress.kubernetes.io/backend-protocol": profile['backend_protocol']
+        }
+        if profile['keepalive_timeout']:
+            annotations["nginx.ingress.kubernetes.io/server-snippet"] = \
+                "keepalive_timeout {}s;".format(profile['keepalive_timeout'])
+        return annotations
+
+
+    def render_auth(self, auth: dict) -> dict:
+        url = auth['url']
+        if auth.get('groups'):
+            # oauth2-proxy answers 403 unless the user belongs to one of the groups
+            url += ('&' if '?' in url else '?') + urlencode({'allowed_groups': ','.join(auth['groups'])})
+        annotations = {
+            "nginx.ingress.kubernetes.io/auth-url": url,
+            # the user's token and identity are passed to the server, as the gatekeeper sidecar did
+            "nginx.ingress.kubernetes.io/auth-response-headers":
+                "Authorization,X-Auth-Request-User,X-Auth-Request-Email,X-Auth-Request-Groups"
+        }
+        if auth.get('signin_url'):
+            annotations["nginx.ingress.kubernetes.io/auth-signin"] = auth['signin_url']
+        return annotations
+
+
+_renderers = {
+    'bluemix': BluemixRenderer(),
+    'nginx': NginxRenderer()
+}
+
+
+def register_renderer(controller: str, renderer: AnnotationRenderer):
+    """
+    :param controller: ingress controller name, as configured by INGRESS_CONTROLLER
+    :param renderer: annotation renderer of the controller
+    :return:
+    """
+    _renderers[controller] = renderer
+
+
+def get_renderer(controller: str) -> AnnotationRenderer:
+    """
+    :param controller: ingress controller name
+    :return: annotation renderer of the controller
+    """
+    try:
+        return _renderers[controller]
+    except KeyError:
+        raise ValueError("Unknown ingress controller {}, one of {} is expected".format(controller,
+                                                                                       sorted(_renderers)))
+
+
+def render_annotations(profile: dict = None, service_name: str = None, controller: str = 'bluemix',
+                       auth: dict = None) -> dict:
+    """
+    :param profile: service's ingress profile, see services.get_ingress_profile, missing values are defaulted
+    :param service_name: backend service name
+    :param controller: ingress controller name
+    :param auth: optional external authentication, see K8s.ingress_auth
+    :return: ingress annotations
+    """
+    profile = dict(DEFAULT_PROFILE, **{k: v for k, v in (profile or {}).items() if v is not None})
+    renderer = get_renderer(controller)
+    annotations = renderer.render(profile, service_name)
+    if auth:
+        annotations.update(renderer.render_auth(auth))
+    return annotations
@@ -0,0 +1,285 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+This package provide a background executor for slow K8s operations, the jobs are persisted in the jobs table,
+so the web workers only enqueue them and the clients poll their status.
+"""
+import logging
+import os
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable
+from uuid import uuid4
+
+from sqlalchemy.exc import IntegrityError
+
+from papaya_server import db
+from papaya_server.constants import JobStatus
+from papaya_server.exceptions import Conflict
+from papaya_server.models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class JobExecutor:
+    """Runs the persisted jobs on a bounded thread pool within the application context"""
+
+    def __init__(self):
+        self._app = None
+        self._pool = None
+        self._handlers = {}
+        self.stale_after = None
+        self.heartbeat_interval = None
+        # a restarted process with the same pid is another worker
+        self.worker = '{}:{}:{}'.format(platform.node(), os.getpid(), uuid4().hex[:8])
+        self._stop = threading.Event()
+        self._watching = False
+
+
+    def init_app(self, app, max_workers: int = 4, stale_after: int = 120, heartbeat_interval: int = 30):
+        """
+        :param app: flask app
+        :param max_workers: number of jobs that run concurrently
+        :param stale_after: seconds without a heartbeat after which a running job is considered as interrupted
+        :param heartbeat_interval: seconds between the heartbeats of the running jobs
+        :return:
+        """
+        self._app = app
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='papaya-job')
+        self.stale_after = stale_after
+        self.heartbeat_interval = heartbeat_interval
+
+
+    def register(self, action: str, handler: Callable[[Job], None]):
+        """
+        :param action: job action
+        :param handler: function that performs the job, changes it makes in the session are committed
+                together with the job status. It may return a callable, which is called after the commit
+        :return:
+        """
+        self._handlers[action] = handler
+
+
+    def submit(self, application_id: int, user_id: int, action: str):
+        """
+        Persist a new job and enqueue it
+        :param application_id: application id
+        :param user_id: user id
+        :param action: job action
+        :return: job
+        """
+        if action not in self._handlers:
+            raise ValueError("Unknown job action [{}]".format(action))
+
+        conflict = Conflict("Another operation on application {} is in progress".format(application_id))
+        if self.active_job(application_id) is not None:
+            raise conflict
+
+        # the unique active application id rejects a job submitted concurrently by another request or worker
+        job = Job(application_id=application_id, user_id=user_id, action=action, status=JobStatus.PENDING.value,
+                  active_application_id=application_id)
+        db.session.add(job)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise conflict
+
+        logger.info("{} was enqueued".format(job))
+        self._pool.submit(self._run, job.id)
+        return job
+
+
+    def begin(self, application_id: int, user_id: int, action: str):
+        """
+        Persist a job that the caller runs itself, e.g. within a batch, so other operations on the application
+        see it as active. The job is running from the start, its heartbeat is refreshed by this process
+        :param application_id: application id
+        :param user_id: user id
+        :param action: job action
+        :return: job, committed
+        :raise Conflict: if another operation on the application is in progress
+        """
+        conflict = Conflict("Another operation on application {} is in progress".format(application_id))
+        if self.active_job(application_id) is not None:
+            raise conflict
+
+        now = datetime.utcnow()
+        job = Job(application_id=application_id, user_id=user_id, action=action, status=JobStatus.RUNNING.value,
+                  active_application_id=application_id, worker=self.worker, start_date=now, heartbeat_date=now)
+        db.session.add(job)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise conflict
+        return job
+
+
+    @staticmethod
+    def finish(job: Job, error: str = None):
+        """
+        Update the status of a job started by begin in the session, the caller commits
+        :param job: job
+        :param error: error message if the job failed
+        :return:
+        """
+        job.status = JobStatus.FAILED.value if error else JobStatus.SUCCEEDED.value
+        job.error = error
+        job.end_date = datetime.utcnow()
+        job.active_application_id = None
+
+
+    def _run(self, job_id: int):
+        with self._app.app_context():
+            # claim the job, it might have been enqueued by several workers after a restart
+            now = datetime.utcnow()
+            claimed = Job.query.filter_by(id=job_id, status=JobStatus.PENDING.value) \
+                .update({'status': JobStatus.RUNNING.value, 'start_date': now, 'worker': self.worker,
+                         'heartbeat_date': now}, synchronize_session=False)
+            db.session.commit()
+            if not claimed:
+                return
+
+            job = Job.query.get(job_id)
+            after_commit = None
+            try:
+                after_commit = self._handlers[job.action](job)
+                job.status = JobStatus.SUCCEEDED.value
+
+            except Exception as e:
+                logger.error("Error occurred in {}".format(job))
+                logger.exception(e)
+                db.session.rollback()
+
+                job = Job.query.get(job_id)
+                job.status = JobStatus.FAILED.value
+                job.error = getattr(e, 'message', None) or str(e) or e.__class__.__name__
+                after_commit = None
+
+            job.end_date = datetime.utcnow()
+            job.active_application_id = None
+            db.session.commit()
+            logger.info("{} finished with status {}".format(job, JobStatus(job.status).name))
+
+            if callable(after_commit):
+                try:
+                    after_commit()
+                except Exception as e:
+                    logger.error("Error occurred after {} was committed".format(job))
+                    logger.exception(e)
+
+
+    def resume(self):
+        """
+        Enqueue the jobs left pending by a previous process, fail the ones that were interrupted while running
+        and start refreshing the heartbeats of this process' jobs
+        :return:
+        """
+        self.sweep(pending_before=datetime.utcnow())
+
+        if not self._watching and self.heartbeat_interval and self.heartbeat_interval > 0:
+            self._watching = True
+            threading.Thread(target=self._watch, name='job-heartbeat', daemon=True).start()
+
+
+    def stop(self):
+        self._stop.set()
+
+
+    def _watch(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                with self._app.app_context():
+                    self.heartbeat()
+                    # a pending job is normally claimed within seconds, older ones were left by a dead process
+                    self.sweep(pending_before=datetime.utcnow() - timedelta(seconds=self.stale_after))
+            except Exception as e:
+                logger.error("Error occurred in jobs heartbeat")
+                logger.exception(e)
+
+
+    def heartbeat(self):
+        """
+        Refresh the heartbeat of the jobs this process runs, should run within app context
+        :return:
+        """
+        Job.query.filter(Job.status == JobStatus.RUNNING.value, Job.worker == self.worker) \
+            .update({'heartbeat_date': datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+
+
+    def sweep(self, pending_before: datetime = None):
+        """
+        Fail the running jobs whose process stopped refreshing their heartbeat and enqueue the pending ones,
+        a job enqueued twice is claimed only once, should run within app context
+        :param pending_before: only the jobs created before are enqueued, none if not provided
+        :return:
+        """
+        now = datetime.utcnow()
+        deadline = now - timedelta(seconds=self.stale_after)
+        stale = Job.query.filter(Job.status == JobStatus.RUNNING.value,
+                                 db.func.coalesce(Job.heartbeat_date, Job.start_date) < deadline) \
+            .update({'status': JobStatus.FAILED.value, 'error': 'Interrupted', 'end_date': now,
+                     'active_application_id': None}, synchronize_session=False)
+        db.session.commit()
+        if stale:
+            logger.warning("{} interrupted jobs were marked as failed".format(stale))
+
+        if pending_before is None:
+            return
+
+        for job in Job.query.filter(Job.status == JobStatus.PENDING.value, Job.creation_date <= pending_before) \
+                .order_by(Job.id).all():
+            self._pool.submit(self._run, job.id)
+
+
+    @staticmethod
+    def active_job(application_id: int):
+        """
+        :param application_id: application id
+        :return: pending or running job of the application
+        """
+        return Job.query.filter(Job.application_id == application_id,
+                                Job.status.in_([JobStatus.PENDING.value, JobStatus.RUNNING.value])).first()
+
+
+def job_to_dict(job: Job):
+    """
+    :param job: job
+    :return: json serializable job status
+    """
+    return {
+        'id': job.id,
+        'application_id': job.application_id,
+        'action': job.action,
+        'status': JobStatus(job.status).name,
+        'error': job.error,
+        'creation_date': job.creation_date.isoformat() if job.creation_date else None,
+        'start_date': job.start_date.isoformat() if job.start_date else None,
+        'end_date': job.end_date.isoformat() if job.end_date else None
+    }
+
+
+executor = JobExecutor()
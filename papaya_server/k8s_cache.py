@@ -0,0 +1,341 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+This package provide an in-memory cache of the cluster state, kept up to date by the K8s watch API,
+so pages and status endpoints can read the deployments, pods and services without calling the API server.
+"""
+import logging
+import threading
+import time
+from typing import Callable
+
+from kubernetes import watch
+
+logger = logging.getLogger(__name__)
+
+# container waiting reasons after which a pod won't become ready without an intervention
+FAILURE_REASONS = ('ErrImagePull', 'ImagePullBackOff', 'InvalidImageName', 'CrashLoopBackOff',
+                   'CreateContainerConfigError', 'CreateContainerError', 'RunContainerError')
+# init container of the pre-pull daemon sets which runs the pulled image
+PREPULL_CONTAINER = 'prepull'
+
+
+class ResourceInformer:
+    """Lists a resource kind once and then follows its changes, keeps the objects indexed by name and by label"""
+
+    def __init__(self, kind: str, list_fn: Callable, namespace: str, label_selector: str = None,
+                 index_label: str = 'app', watch_timeout: int = 300, on_event: Callable = None):
+        """
+        :param kind: resource kind, used in logs and events
+        :param list_fn: namespaced list function of the K8s api, e.g. CoreV1Api.list_namespaced_pod
+        :param namespace: watched namespace
+        :param label_selector: optional label selector of the watched objects
+        :param index_label: label by which the objects are indexed
+        :param watch_timeout: seconds after which the watch is renewed
+        :param on_event: callback called with (kind, event type, object) on each change
+        """
+        self.kind = kind
+        self._list_fn = list_fn
+        self._namespace = namespace
+        self._label_selector = label_selector
+        self._index_label = index_label
+        self._watch_timeout = watch_timeout
+        self._on_event = on_event
+
+        self._lock = threading.RLock()
+        self._objects = {}
+        self._index = {}
+        self._synced = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='informer-' + self.kind, daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        self._stop.set()
+
+
+    @property
+    def synced(self):
+        """:return: whether the initial list was loaded"""
+        return self._synced.is_set()
+
+
+    def wait_synced(self, timeout: float = None):
+        return self._synced.wait(timeout)
+
+
+    def _label(self, obj):
+        labels = obj.metadata.labels or {}
+        return labels.get(self._index_label)
+
+
+    def _store(self, obj):
+        name = obj.metadata.name
+        with self._lock:
+            self._remove(name)
+            self._objects[name] = obj
+            label = self._label(obj)
+            if label is not None:
+                self._index.setdefault(label, set()).add(name)
+
+
+    def _remove(self, name):
+        with self._lock:
+            old = self._objects.pop(name, None)
+            if old is not None:
+                label = self._label(old)
+                names = self._index.get(label)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del self._index[label]
+
+
+    def _list(self):
+        """Replace the cache content with a fresh list, :return: list resource version"""
+        kwargs = {'label_selector': self._label_selector} if self._label_selector else {}
+        ret = self._list_fn(self._namespace, **kwargs)
+
+        with self._lock:
+            self._objects = {}
+            self._index = {}
+            for obj in ret.items:
+                self._store(obj)
+
+        self._synced.set()
+        logger.info("Informer [{}] loaded {} objects".format(self.kind, len(ret.items)))
+        return ret.metadata.resource_version
+
+
+    def _run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                resource_version = self._list()
+                backoff = 1
+                resource_version = self._watch(resource_version)
+                while resource_version is not None and not self._stop.is_set():
+                    resource_version = self._watch(resource_version)
+
+            except Exception as e:
+                logger.error("Error occurred in informer [{}], retrying in {}s".format(self.kind, backoff))
+                logger.exception(e)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60)
+
+
+    def _watch(self, resource_version):
+        """
+        Follow the changes since resource_version
+        :return: the last seen resource version to continue from, or None if the objects should be listed again
+        """
+        kwargs = {'label_selector': self._label_selector} if self._label_selector else {}
+        w = watch.Watch()
+
+        # the client side timeout only protects from connections that silently died, the server ends the watch first
+        for event in w.stream(self._list_fn, self._namespace, resource_version=resource_version,
+                              timeout_seconds=self._watch_timeout, _request_timeout=self._watch_timeout + 30,
+                              **kwargs):
+            if self._stop.is_set():
+                w.stop()
+                return None
+
+            event_type, obj = event['type'], event['object']
+            if event_type == 'ERROR':
+                # most likely 410 Gone, the resource version is too old
+                logger.info("Informer [{}] watch expired, listing again".format(self.kind))
+                return None
+
+            if event_type == 'DELETED':
+                self._remove(obj.metadata.name)
+            else:
+                self._store(obj)
+
+            resource_version = obj.metadata.resource_version
+            if self._on_event is not None:
+                try:
+                    self._on_event(self.kind, event_type, obj)
+                except Exception as e:
+                    logger.error("Error occurred in [{}] event listener".format(self.kind))
+                    logger.exception(e)
+
+        return resource_version
+
+
+    def get(self, name: str):
+        with self._lock:
+            return self._objects.get(name)
+
+
+    def by_label(self, value: str):
+        """:return: objects whose index label equals value"""
+        with self._lock:
+            return [self._objects[n] for n in self._index.get(value, ())]
+
+
+    def list(self):
+        with self._lock:
+            return list(self._objects.values())
+
+
+class ClusterStateCache:
+    """Label indexed cache of the deployments, pods and services of the applications namespace"""
+
+    def __init__(self, deployment_api, core_api, namespace: str, label_selector: str = None):
+        """
+        :param deployment_api: AppsV1Api
+        :param core_api: CoreV1Api
+        :param namespace: applications namespace
+        :param label_selector: optional selector of the platform's objects
+        """
+        self._listeners = []
+        self.deployments = ResourceInformer('deployment', deployment_api.list_namespaced_deployment, namespace,
+                                            label_selector, on_event=self._notify)
+        self.pods = ResourceInformer('pod', core_api.list_namespaced_pod, namespace, label_selector,
+                                     on_event=self._notify)
+        self.services = ResourceInformer('service', core_api.list_namespaced_service, namespace, label_selector,
+                                         on_event=self._notify)
+        self._started = False
+
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            for informer in (self.deployments, self.pods, self.services):
+                informer.start()
+
+
+    @property
+    def synced(self):
+        return self.deployments.synced and self.pods.synced and self.services.synced
+
+
+    def add_listener(self, listener: Callable):
+        """
+        :param listener: callback called with (kind, event type, object) on each change in the cluster
+        :return:
+        """
+        self._listeners.append(listener)
+
+
+    def _notify(self, kind, event_type, obj):
+        for listener in self._listeners:
+            listener(kind, event_type, obj)
+
+
+    def readiness(self, app_name: str):
+        """
+        Summarize the application's readiness from the cached deployment and pods
+        :param app_name: application name as used by K8s objects
+        :return: dictionary of desired/ready replicas and the reason the pods aren't ready, None if not synced
+        """
+        if not self.synced:
+            return None
+
+        # standby deployments claimed from a warm pool keep their names, they're found by their app label
+        labelled = self.deployments.by_label(app_name)
+        deployment = labelled[0] if labelled else self.deployments.get(app_name + '-deployment')
+        pods = self.pods.by_label(app_name)
+        return summarize_readiness(deployment, pods)
+
+
+def summarize_prepull(pods: list):
+    """
+    :param pods: pre-pull daemon set pods
+    :return: dictionary of the number of nodes, the number of nodes which pulled the image and per node state,
+            one of pulled, pulling or failed
+    """
+    nodes = []
+    for pod in pods:
+        statuses = (pod.status.init_container_statuses or []) if pod.status else []
+        state, reason = 'pulling', None
+        for cs in statuses:
+            if cs.name != PREPULL_CONTAINER:
+                continue
+            waiting = cs.state.waiting if cs.state else None
+            if cs.image_id:
+                # the image is on the node once the container has an image id, whether or not it ran successfully
+                state, reason = 'pulled', None
+            elif waiting is not None and waiting.reason in FAILURE_REASONS:
+                state, reason = 'failed', waiting.reason
+            elif waiting is not None:
+                reason = waiting.reason
+
+        nodes.append({'node': pod.spec.node_name if pod.spec else None, 'state': state, 'reason': reason})
+
+    nodes.sort(key=lambda n: n['node'] or '')
+    return {
+        'nodes': len(nodes),
+        'pulled': sum(1 for n in nodes if n['state'] == 'pulled'),
+        'per_node': nodes
+    }
+
+
+def summarize_readiness(deployment, pods: list):
+    """
+    :param deployment: V1Deployment or None
+    :param pods: list of V1Pod
+    :return: readiness dictionary
+    """
+    summary = {
+        'exists': deployment is not None,
+        'desired': 0,
+        'ready': 0,
+        'available': False,
+        'reason': None,
+        'failed': False
+    }
+
+    if deployment is None:
+        summary['reason'] = 'NotFound'
+        return summary
+
+    summary['desired'] = deployment.spec.replicas if deployment.spec.replicas is not None else 1
+    summary['ready'] = (deployment.status.ready_replicas or 0) if deployment.status else 0
+    summary['available'] = summary['ready'] >= summary['desired'] > 0
+
+    for condition in (deployment.status.conditions or []) if deployment.status else []:
+        if condition.type == 'Progressing' and condition.status == 'False':
+            summary['reason'] = condition.reason
+            summary['failed'] = True
+
+    for pod in pods:
+        statuses = (pod.status.container_statuses or []) if pod.status else []
+        for cs in statuses:
+            waiting = cs.state.waiting if cs.state else None
+            if waiting is not None and waiting.reason:
+                summary['reason'] = summary['reason'] or waiting.reason
+                summary['failed'] = summary['failed'] or waiting.reason in FAILURE_REASONS
+
+        if not statuses and pod.status and pod.status.phase:
+            summary['reason'] = summary['reason'] or pod.status.phase
+
+    if summary['available']:
+        summary['reason'] = None
+        summary['failed'] = False
+
+    return summary
@@ -22,87 +22,347 @@ SOFTWARE.
 """
 This package provide a function to activate, terminate or obtain information of K8s cluster.
 """
+from abc import ABC, abstractmethod
 from kubernetes import client, config
+from kubernetes.client.rest import ApiException
+from urllib3.connection import HTTPConnection
 from flask import current_app
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from typing import List
 from papaya_server.exceptions import K8sError
+from papaya_server.k8s_cache import PREPULL_CONTAINER, ClusterStateCache
+from papaya_server.k8s_ingress import SHARED_INGRESS_LABEL, SharedIngress
+from papaya_server.ingress_profiles import get_renderer, render_annotations
+from papaya_server.k8s_pipeline import DeploymentPipeline
+from papaya_server.k8s_resilience import ApiGuard
+import hashlib
+import json
 import logging
+import socket
 import threading
-import uuid
 import yaml
+from uuid import uuid4
+from datetime import datetime
 import os
 
 logger = logging.getLogger(__name__)
 
+# label of all the objects created by the platform
+MANAGED_LABELS = {'app.kubernetes.io/managed-by': 'papaya-platform'}
+MANAGED_SELECTOR = ','.join('{}={}'.format(k, v) for k, v in MANAGED_LABELS.items())
+# ownership labels, the application's objects are selected by them when it's deleted
+APP_LABEL = 'app'
+USER_LABEL = 'papaya-platform/user-id'
+APPLICATION_LABEL = 'papaya-platform/application-id'
+# standby deployments carry their service id, they're selected by their instance label which survives their claim
+WARM_POOL_LABEL = 'papaya-platform/warm-pool'
+INSTANCE_LABEL = 'papaya-platform/instance'
+# pre-pull daemon sets carry their service id
+PREPULL_LABEL = 'papaya-platform/prepull'
+# init containers of the pre-pull daemon sets, the first one copies a static binary the second one runs
+PREPULL_CONTAINERS = ['tools', PREPULL_CONTAINER]
+# sidecar of the IAM applications which authenticates and logs their requests
+GATEKEEPER_CONTAINER = 'gatekeeper'
+# the IAM applications' admin pages are restricted to the groups
+ADMIN_PATH = '/admin'
+ADMIN_GROUPS = ['papaya-admin']
+# 'sidecar' runs the gatekeeper in the IAM applications' pods, 'ingress' authenticates through the auth proxy
+IAM_MODES = ('sidecar', 'ingress')
+# hash of the rendered object, an existing object is patched only when it differs
+MANIFEST_HASH_ANNOTATION = 'papaya-platform/manifest-hash'
+
+
+def autoscaled(profile: dict = None):
+    """
+    :param profile: service's resource profile, see services.get_resource_profile
+    :return: whether the profile requires a HorizontalPodAutoscaler
+    """
+    return bool(profile and profile.get('max_replicas') and profile['max_replicas'] > profile['min_replicas'])
+
+
+def owner_labels(app_name: str, user_id: int = None, application_id: int = None):
+    """
+    :param app_name: application name, as used in the objects' names
+    :param user_id: application owner id
+    :param application_id: application id
+    :return: labels of the application's objects
+    """
+    labels = dict(MANAGED_LABELS)
+    labels[APP_LABEL] = app_name
+    if user_id is not None:
+        labels[USER_LABEL] = str(user_id)
+    if application_id is not None:
+        labels[APPLICATION_LABEL] = str(application_id)
+    return labels
+
+
+def owner_selector(app_name: str = None, user_id: int = None, application_id: int = None):
+    """
+    :return: label selector of the platform's objects, optionally narrowed to an application or a user
+    """
+    selector = [MANAGED_SELECTOR]
+    if app_name is not None:
+        selector.append('{}={}'.format(APP_LABEL, app_name))
+    if user_id is not None:
+        selector.append('{}={}'.format(USER_LABEL, user_id))
+    if application_id is not None:
+        selector.append('{}={}'.format(APPLICATION_LABEL, application_id))
+    return ','.join(selector)
+
+
+class PortAllocator(ABC):
+    """Common interface of the NodePort allocators"""
+
+    def get_available_port(self):
+        """
+        Allocate a single port
+        :return: allocated port
+        """
+        return self.get_available_ports(1)[0]
+
+
+    @abstractmethod
+    def get_available_ports(self, count: int):
+        pass
+
+
+    def release_port(self, port):
+        """
+        Return port to the pool
+        :param port: allocated port
+        :return:
+        """
+        self.release_ports([port])
+
+
+    @abstractmethod
+    def release_ports(self, ports: list):
+        pass
+
+
+    @abstractmethod
+    def reserve_ports(self, ports: list):
+        pass
+
+
+    def confirm_port(self, port: int, application_id: int = None):
+        """
+        Bind an allocated port to the application that uses it, nothing to do for in memory allocators
+        :param port: allocated port
+        :param application_id: application id
+        :return:
+        """
+        pass
+
+
+    def init(self, ports: list = None):
+        """
+        Load used ports in memory
+        :param ports: list of used ports
+        :return:
+        """
+        if ports is not None:
+            self.reserve_ports(ports)
+
+
+    @contextmanager
+    def allocation(self):
+        """
+        Allocate a port for the duration of a deployment, the port is returned to the pool
+        if any step inside the block fails
+        :return: allocated port
+        """
+        port = self.get_available_port()
+        try:
+            yield port
+        except BaseException:
+            logger.info("Returning port [{}] to the pool after failure".format(port))
+            self.release_port(port)
+            raise
+
+
+    @abstractmethod
+    def snapshot(self):
+        pass
+
+
+class OpenPorts(PortAllocator):
+    """Open Port Manager, allows manage thread safe ports list
+
+    Free ports are kept in a doubly linked free-list laid over the ports range and a bitmap marks the used ones,
+    so allocating, releasing and reserving a specific port are all O(1) regardless of the range width.
+    Released ports are appended to the tail of the free-list, which delays their reuse as long as possible.
+    """
+
+    _NIL = -1
 
-class OpenPorts:
-    """Open Port Manager, allows manage thread safe ports list"""
     def __init__(self, start: int = None, end: int = None):
         self.start = start
         self.end = end
         self.lock = threading.Lock()
 
-        self.ports = [True] * (self.end - self.start + 1)
+        size = self.end - self.start + 1
+        self._used = bytearray(size)
+        self._next = list(range(1, size)) + [self._NIL]
+        self._prev = [self._NIL] + list(range(size - 1))
+        self._head = 0 if size > 0 else self._NIL
+        self._tail = size - 1 if size > 0 else self._NIL
+        self._free = size
 
 
-    def get_available_port(self):
+    def _index(self, port: int):
+        """
+        :param port: port number
+        :return: index of the port in the range or None if the port is out of the range
+        """
+        if port is None or not self.start <= port <= self.end:
+            logger.warning("Port [{}] is out of the range [{}, {}]".format(port, self.start, self.end))
+            return None
 
-        logger.debug('Waiting for writing lock')
-        self.lock.acquire()
+        return port - self.start
 
-        try:
+
+    def _unlink(self, ind: int):
+        """Remove a free port from the free-list and mark it as used, the caller should hold the lock"""
+        prev, nxt = self._prev[ind], self._next[ind]
+
+        if prev == self._NIL:
+            self._head = nxt
+        else:
+            self._next[prev] = nxt
+
+        if nxt == self._NIL:
+            self._tail = prev
+        else:
+            self._prev[nxt] = prev
+
+        self._prev[ind] = self._next[ind] = self._NIL
+        self._used[ind] = 1
+        self._free -= 1
+
+
+    def _append(self, ind: int):
+        """Append a used port to the tail of the free-list, the caller should hold the lock"""
+        self._prev[ind] = self._tail
+        self._next[ind] = self._NIL
+
+        if self._tail == self._NIL:
+            self._head = ind
+        else:
+            self._next[self._tail] = ind
+
+        self._tail = ind
+        self._used[ind] = 0
+        self._free += 1
+
+
+    def get_available_ports(self, count: int):
+        """
+        Allocate several ports at once, either all of them are allocated or none
+        :param count: number of ports to allocate
+        :return: list of allocated ports
+        """
+        logger.debug('Waiting for writing lock')
+        with self.lock:
             logger.debug('Acquired a lock')
-            ind = next(i for i in range(len(self.ports)) if self.ports[i])
-            self.ports[ind] = False
-            logger.debug("Acquiring port [{}]".format(self.start + ind))
 
-            return self.start + ind
+            if count > self._free:
+                logger.error("Error occurred in get_available_ports, requested {} ports while only {} are free"
+                             .format(count, self._free))
+                raise K8sError("No available ports")
 
-        except Exception as e:
-            logger.error("Error occurred in get_available_port")
-            logger.exception(e)
-            raise K8sError("No available ports")
+            ports = []
+            for _ in range(count):
+                ind = self._head
+                self._unlink(ind)
+                ports.append(self.start + ind)
 
-        finally:
-            logger.debug('Released a lock')
-            self.lock.release()
+            logger.debug("Acquiring ports {}".format(ports))
 
+        logger.debug('Released a lock')
+        return ports
 
-    def release_port(self, port):
 
+    def release_ports(self, ports: list):
+        """
+        Return several ports to the pool, releasing a free port has no effect
+        :param ports: list of allocated ports
+        :return:
+        """
         logger.debug('Waiting for a lock')
-        self.lock.acquire()
-        try:
+        with self.lock:
             logger.debug('Acquired a lock')
-            self.ports[port - self.start] = True
-            logger.debug("Releasing port [{}]".format(port))
-        finally:
-            logger.debug('Released a lock')
-            self.lock.release()
+            for port in ports:
+                ind = self._index(port)
+                if ind is not None and self._used[ind]:
+                    self._append(ind)
+                    logger.debug("Releasing port [{}]".format(port))
 
+        logger.debug('Released a lock')
 
-    def init(self, ports: list = None):
+
+    def reserve_ports(self, ports: list):
         """
-        Load used ports in memory
-        :param ports: list of used ports
+        Mark specific ports as used, reserving a used port has no effect
+        :param ports: list of ports
         :return:
         """
-        if ports is not None:
-            for p in ports:
-                self.ports[p-self.start] = False
+        with self.lock:
+            for port in ports:
+                ind = self._index(port)
+                if ind is not None and not self._used[ind]:
+                    self._unlink(ind)
+
+
+    def snapshot(self):
+        """
+        :return: utilization of the ports range
+        """
+        with self.lock:
+            free = self._free
+
+        total = self.end - self.start + 1
+        return {
+            'start': self.start,
+            'end': self.end,
+            'total': total,
+            'used': total - free,
+            'free': free,
+            'utilization': float(total - free) / total if total else 0.0
+        }
 
 
 class K8s:
 
     _deployment_api = None
     _service_api = None
+    shared_ingress = None
+    ingress_controller = 'bluemix'
+    iam_mode = 'sidecar'
+    iam_auth_url = None
+    iam_signin_url = None
 
 
-    def __init__(self, incluster=False, secret_name='papaya', ports_range: dict = None):
+    def __init__(self, incluster=False, secret_name='papaya', ports_range: dict = None,
+                 port_allocator: PortAllocator = None, deploy_workers: int = 8, pool_size: int = None,
+                 connect_timeout: float = 5, read_timeout: float = 30, api_guard: ApiGuard = None,
+                 ingress_shards: int = 0, ingress_batch_window: float = 0.5, ingress_controller: str = 'bluemix',
+                 iam_mode: str = 'sidecar', iam_auth_url: str = None, iam_signin_url: str = None):
 
         if self._deployment_api is None or self._service_api is None:
 
-            self.open_ports = OpenPorts(ports_range['start'], ports_range['end'])
+            if iam_mode not in IAM_MODES:
+                raise ValueError("Unknown IAM mode {}, one of {} is expected".format(iam_mode, IAM_MODES))
+            if iam_mode == 'ingress' and not get_renderer(ingress_controller).external_auth:
+                raise ValueError("IAM mode ingress requires an ingress controller with external authentication, "
+                                 "{} doesn't support it".format(ingress_controller))
+
+            # bounded pool shared by all the deployment pipelines
+            self._executor = ThreadPoolExecutor(max_workers=deploy_workers, thread_name_prefix='k8s-deploy')
+
+            self.open_ports = port_allocator or OpenPorts(ports_range['start'], ports_range['end'])
             try:
                 if incluster:
 
@@ -118,56 +378,116 @@ class K8s:
                 logging.error("Error occurred on k8s config loading")
 
             self._secret_name = secret_name
-            self._deployment_api = client.AppsV1Api()
-            self._service_api = client.CoreV1Api()
-            self._networking_api = client.NetworkingV1beta1Api()
+            self.ingress_controller = ingress_controller
+            self.iam_mode = iam_mode
+            self.iam_auth_url = iam_auth_url
+            self.iam_signin_url = iam_signin_url
+            self._request_timeout = (connect_timeout, read_timeout)
+            # rate limiter, retries and circuit breaker shared by all the api calls
+            self.api_guard = api_guard or ApiGuard()
+            self.api_client = self._create_api_client(pool_size or deploy_workers)
+            self._deployment_api = client.AppsV1Api(self.api_client)
+            self._service_api = client.CoreV1Api(self.api_client)
+            self._networking_api = client.NetworkingV1beta1Api(self.api_client)
+            self._autoscaling_api = client.AutoscalingV1Api(self.api_client)
+
+            if ingress_shards:
+                # the applications' host rules are kept in shared ingresses instead of an ingress per application
+                self.shared_ingress = SharedIngress(self._networking_api, self._call, self._call_once,
+                                                    shards=ingress_shards, window=ingress_batch_window,
+                                                    labels=MANAGED_LABELS)
+
+
+    @staticmethod
+    def _create_api_client(pool_size: int):
+        """
+        Create the ApiClient shared by all the K8s apis, so concurrent calls reuse the pooled
+        keep-alive connections to the API server instead of handshaking each time
+        :param pool_size: maximal number of connections kept open, should match the calls concurrency
+        :return: ApiClient
+        """
+        if hasattr(client.Configuration, 'get_default_copy'):
+            configuration = client.Configuration.get_default_copy()
+        else:
+            configuration = client.Configuration()
+        configuration.connection_pool_maxsize = pool_size
+
+        api_client = client.ApiClient(configuration)
+        api_client.set_default_header('Accept-Encoding', 'gzip')
+        api_client.set_default_header('Connection', 'keep-alive')
+
+        # detect dead connections kept in the pool, e.g. after an API server restart
+        pool_manager = getattr(api_client.rest_client, 'pool_manager', None)
+        if pool_manager is not None:
+            pool_manager.connection_pool_kw['socket_options'] = \
+                HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+
+        return api_client
+
+
+    def _call(self, fn, *args, **kwargs):
+        """
+        Call K8s api function with the default connect and read timeouts,
+        through the rate limiter, retries and circuit breaker
+        :param fn: api function
+        :return: api function result
+        """
+        kwargs.setdefault('_request_timeout', self._request_timeout)
+        return self.api_guard.call(fn, *args, **kwargs)
+
+
+    def _call_once(self, fn, *args, **kwargs):
+        """
+        Call K8s api function like _call, but without the retries
+        :param fn: api function
+        :return: api function result
+        """
+        kwargs.setdefault('_request_timeout', self._request_timeout)
+        return self.api_guard.call_once(fn, *args, **kwargs)
+
+
+    def watch_cluster(self, namespace: str, label_selector: str = None):
+        """
+        :param namespace: applications namespace
+        :param label_selector: optional selector of the platform's objects
+        :return: cluster state cache, should be started by the caller
+        """
+        return ClusterStateCache(self._deployment_api, self._service_api, namespace, label_selector=label_selector)
+
+
+    def gatekeeper(self, iam: bool, iam_mode: str = None):
+        """
+        :param iam: whether the application is integrated with IAM
+        :param iam_mode: IAM mode the application was activated with, the configured mode by default
+        :return: whether its pods run the gatekeeper sidecar, otherwise its ingress authenticates the requests
+                with the shared auth proxy
+        """
+        return bool(iam) and (iam_mode or self.iam_mode) != 'ingress'
+
+
+    def ingress_auth(self, admin=False):
+        """
+        :param admin: whether the ingress serves the admin pages
+        :return: external authentication of the IAM applications' ingresses, see ingress_profiles.render_annotations
+        """
+        return {'url': self.iam_auth_url, 'signin_url': self.iam_signin_url, 'groups': ADMIN_GROUPS if admin else None}
 
 
-    def create_iam_configmap(self, name, ingress_url, app_port, namespace="papaya"):
+    def create_iam_configmap(self, name, ingress_url, app_port, namespace="papaya", labels: dict = None):
         """
         :param name: config map name
         :param ingress_url: application url
         :param app_port: application port
         :param namespace: K8s namespace
+        :param labels: ownership labels, see owner_labels
         :return:
         """
-        upstream_url = 'http://127.0.0.1:' + str(app_port)
         cfgmap_name = name + '-configmap'
         try:
-
-            data = {'discovery-url': os.getenv("IAM_URL", None),
-                    'client-id': os.getenv("IAM_CLIENT_ID", None),
-                    'client-secret': os.getenv('IAM_CLIENT_SECRET', None),
-                    'encryption-key': os.getenv('ENC_KEY', None),
-                    'listen': ':3000',
-                    'upstream-url': upstream_url,
-                    'redirection-url': ingress_url,
-                    'ingress.enabled': True,
-                    'enable-security-filter': True,
-                    'enable-refresh-tokens': True,
-                    'enable-session-cookies': False,
-                    'server-write-timeout': '600s',
-                    'server-read-timeout': '600s',
-                    'upstream-response-header-timeout': '600s',
-                    'skip-upstream-tls-verify': False,
-                    'skip-openid-provider-tls-verify': True,
-                    'enable-https-redirection': True,
-                    'pass-authorization-header': True,
-                    'resources': [{"uri": "/admin*", "groups": ["papaya-admin"]}]
-                    }
-
-            body = client.V1ConfigMap(
-                    api_version='v1',
-                    metadata=client.V1ObjectMeta(
-                        namespace=namespace,
-                        name=cfgmap_name),
-
-                    data={
-                        'keycloak-gatekeeper.conf': yaml.dump(data)
-                        })
+            body = self.create_iam_configmap_object(name, ingress_url, app_port, namespace=namespace, labels=labels)
 
             current_app.logger.info("Creating application's configuration map [{}] deployment...".format(cfgmap_name))
-            self._service_api.create_namespaced_config_map_with_http_info(namespace=namespace, body=body)
+            self.apply('configmap', body, namespace)
             current_app.logger.info("application's configuration map [{}] was created".format(cfgmap_name))
 
         except Exception as e:
@@ -178,7 +498,54 @@ class K8s:
             raise K8sError(msg)
 
 
-    def create_deployment(self, name, image, namespace, ports, iam=False):
+    def create_iam_configmap_object(self, name, ingress_url, app_port, namespace="papaya", labels: dict = None):
+        """
+        :param name: application name
+        :param ingress_url: application url
+        :param app_port: application port
+        :param namespace: K8s namespace
+        :param labels: ownership labels, see owner_labels
+        :return: IAM gatekeeper configuration map object
+        """
+        upstream_url = 'http://127.0.0.1:' + str(app_port)
+        cfgmap_name = name + '-configmap'
+
+        data = {'discovery-url': os.getenv("IAM_URL", None),
+                'client-id': os.getenv("IAM_CLIENT_ID", None),
+                'client-secret': os.getenv('IAM_CLIENT_SECRET', None),
+                'encryption-key': os.getenv('ENC_KEY', None),
+                'listen': ':3000',
+                'upstream-url': upstream_url,
+                'redirection-url': ingress_url,
+                'ingress.enabled': True,
+                'enable-security-filter': True,
+                'enable-refresh-tokens': True,
+                'enable-session-cookies': False,
+                'server-write-timeout': '600s',
+                'server-read-timeout': '600s',
+                'upstream-response-header-timeout': '600s',
+                'skip-upstream-tls-verify': False,
+                'skip-openid-provider-tls-verify': True,
+                'enable-https-redirection': True,
+                'pass-authorization-header': True,
+                'resources': [{"uri": ADMIN_PATH + "*", "groups": ADMIN_GROUPS}]
+                }
+
+        return client.V1ConfigMap(
+                api_version='v1',
+                kind='ConfigMap',
+                metadata=client.V1ObjectMeta(
+                    namespace=namespace,
+                    name=cfgmap_name,
+                    labels=labels or owner_labels(name)),
+
+                data={
+                    'keycloak-gatekeeper.conf': yaml.dump(data)
+                    })
+
+
+    def create_deployment(self, name, image, namespace, ports, iam=False, labels: dict = None, replicas=1,
+                          selector: dict = None, resources: dict = None, iam_mode: str = None):
         """
         Create application deployment
         :param name: application name
@@ -186,12 +553,18 @@ class K8s:
         :param namespace: cluster namespace in which the service should be deployed
         :param ports: application ports for NodePort service
         :param iam: whether or not to integrate deployment with IAM service
+        :param labels: ownership labels, see owner_labels
+        :param replicas: number of replicas, 0 for suspended applications
+        :param selector: pods selector, the app label by default
+        :param resources: requests and limits of the application container
+        :param iam_mode: IAM mode the application was activated with, see gatekeeper
         :return:
         """
         try:
-            deployment = self.create_deployment_object(name, image, ports, iam=iam)
+            deployment = self.create_deployment_object(name, image, ports, replicas=replicas, iam=iam, labels=labels,
+                                                       selector=selector, resources=resources, iam_mode=iam_mode)
             current_app.logger.info("Creating application [{}] deployment...".format(name))
-            self._deployment_api.create_namespaced_deployment(body=deployment, namespace=namespace, pretty=True)
+            self.apply('deployment', deployment, namespace)
             current_app.logger.info("Application [{}] deployment was created".format(name))
 
         except Exception as e:
@@ -202,6 +575,224 @@ class K8s:
             raise K8sError(msg)
 
 
+    def scale_deployment(self, name, namespace, replicas, deployment_name=None):
+        """
+        Scale the application's deployment, the rest of its objects stay untouched
+        :param name: application name
+        :param namespace: namespace
+        :param replicas: number of replicas
+        :param deployment_name: name of the claimed standby deployment, if the application runs on one
+        :return:
+        """
+        try:
+            self._call(self._deployment_api.patch_namespaced_deployment_scale, deployment_name or name + "-deployment",
+                       namespace, {'spec': {'replicas': replicas}})
+            logger.info("Application [{}] deployment was scaled to {}".format(name, replicas))
+
+        except Exception as e:
+            msg = "Error occurred in scale_deployment"
+            logger.error(msg)
+            logger.exception(e)
+            raise K8sError(msg)
+
+
+    def list_standby(self, namespace, service_id=None):
+        """
+        :param namespace: applications namespace
+        :param service_id: if provided, only the standby deployments of this service are listed
+        :return: list of the warm pools' standby deployments
+        """
+        selector = WARM_POOL_LABEL if service_id is None else '{}={}'.format(WARM_POOL_LABEL, service_id)
+        return self._call(self._deployment_api.list_namespaced_deployment, namespace,
+                          label_selector='{},{}'.format(MANAGED_SELECTOR, selector)).items
+
+
+    def create_standby(self, service_id: int, image, ports: List[int], namespace, resources: dict = None):
+        """
+        Create a standby deployment of the service, it runs the service's image without any service or ingress
+        :param service_id: service id
+        :param image: server side image
+        :param ports: server side container ports
+        :param namespace: applications namespace
+        :param resources: requests and limits of the container, see create_deployment_object
+        :return: standby instance name
+        """
+        instance = 'warm-{}-{}'.format(service_id, uuid4().hex[:8])
+        labels = dict(MANAGED_LABELS)
+        labels[WARM_POOL_LABEL] = str(service_id)
+        try:
+            deployment = self.create_deployment_object(instance, image, ports, labels=labels,
+                                                       selector={INSTANCE_LABEL: instance}, resources=resources)
+            self.apply('deployment', deployment, namespace)
+            logger.info("Standby deployment [{}] was created".format(instance))
+            return instance
+
+        except Exception as e:
+            msg = "Error occurred in create_standby"
+            logger.error(msg)
+            logger.exception(e)
+            raise K8sError(msg)
+
+
+    def claim_standby(self, service_id: int, image, namespace, labels: dict, replicas: int = 1):
+        """
+        Claim an available standby deployment of the service by relabelling it with the application's labels,
+        the deployment's resource version makes sure that concurrent activations don't claim the same one.
+        The pod template is relabelled, so the pods created later are found by the application's name,
+        the running pods are relabelled too, so they serve the application until the template's rollout
+        replaces them
+        :param service_id: service id
+        :param image: server side image the standby should run
+        :param namespace: applications namespace
+        :param labels: application's ownership labels, see owner_labels
+        :param replicas: application's number of replicas
+        :return: claimed instance name or None if no standby is available
+        """
+        for d in self.list_standby(namespace, service_id):
+            containers = d.spec.template.spec.containers
+            if not (d.status and d.status.available_replicas) or containers[0].image != image:
+                continue
+
+            instance = d.spec.selector.match_labels[INSTANCE_LABEL]
+            claimed = dict(labels, **{WARM_POOL_LABEL: None})
+            patch = {
+                'metadata': {'resourceVersion': d.metadata.resource_version, 'labels': claimed},
+                # the pods keep the selector's instance label
+                'spec': {'replicas': replicas,
+                         'template': {'metadata': {'labels': dict(claimed, **{INSTANCE_LABEL: instance})}}}
+            }
+            try:
+                # not retried, a conflict means that another activation claimed it
+                self._deployment_api.patch_namespaced_deployment(d.metadata.name, namespace, patch,
+                                                                 _request_timeout=self._request_timeout)
+            except ApiException as e:
+                if e.status == 409:
+                    continue
+                raise
+
+            pods = self._call(self._service_api.list_namespaced_pod, namespace,
+                              label_selector='{}={}'.format(INSTANCE_LABEL, instance)).items
+            for pod in pods:
+                self._call(self._service_api.patch_namespaced_pod, pod.metadata.name, namespace,
+                           {'metadata': {'labels': claimed}})
+
+            logger.info("Standby deployment [{}] was claimed by [{}]".format(instance, labels.get(APP_LABEL)))
+            return instance
+
+        return None
+
+
+    def prepull_image(self, service_id: int, image, namespace, pause_image='k8s.gcr.io/pause:3.2',
+                      tools_image='busybox:1.33.1-musl'):
+        """
+        Pull the service's image on every node with a daemon set, the image runs once as an init container
+        and the pod then idles on the pause image. An image change rolls the daemon set, so the new image is pulled.
+        The image might have no shell, e.g. distroless, so it runs a static busybox copied from the tools image
+        into a shared volume
+        :param service_id: service id
+        :param image: server side image
+        :param namespace: applications namespace
+        :param pause_image: image of the idle container
+        :param tools_image: image with a static busybox
+        :return:
+        """
+        name = 'prepull-{}'.format(service_id)
+        labels = dict(MANAGED_LABELS, app=name)
+        labels[PREPULL_LABEL] = str(service_id)
+        resources = client.V1ResourceRequirements(requests={'cpu': '1m', 'memory': '8Mi'},
+                                                  limits={'cpu': '10m', 'memory': '16Mi'})
+        mount = client.V1VolumeMount(name='prepull', mount_path='/prepull')
+
+        body = client.V1DaemonSet(
+            api_version='apps/v1',
+            kind='DaemonSet',
+            metadata=client.V1ObjectMeta(name=name, labels=labels),
+            spec=client.V1DaemonSetSpec(
+                selector=client.V1LabelSelector(match_labels={PREPULL_LABEL: str(service_id)}),
+                template=client.V1PodTemplateSpec(
+                    metadata=client.V1ObjectMeta(labels=labels),
+                    spec=client.V1PodSpec(
+                        # busybox runs the applet of its file name
+                        init_containers=[
+                            client.V1Container(name=PREPULL_CONTAINERS[0], image=tools_image,
+                                               command=['cp', '/bin/busybox', '/prepull/true'],
+                                               volume_mounts=[mount], resources=resources),
+                            client.V1Container(name=PREPULL_CONTAINERS[1], image=image, command=['/prepull/true'],
+                                               volume_mounts=[mount], resources=resources)],
+                        containers=[client.V1Container(name='pause', image=pause_image, resources=resources)],
+                        volumes=[client.V1Volume(name='prepull', empty_dir=client.V1EmptyDirVolumeSource())]))))
+
+        try:
+            self.apply('daemonset', body, namespace)
+            logger.info("Pre-pull of [{}] was scheduled".format(image))
+
+        except Exception as e:
+            msg = "Error occurred in prepull_image"
+            logger.error(msg)
+            logger.exception(e)
+            raise K8sError(msg)
+
+
+    def list_prepull(self, namespace):
+        """
+        :param namespace: applications namespace
+        :return: list of the pre-pull daemon sets
+        """
+        return self._call(self._deployment_api.list_namespaced_daemon_set, namespace,
+                          label_selector='{},{}'.format(MANAGED_SELECTOR, PREPULL_LABEL)).items
+
+
+    def delete_prepull(self, service_id: int, namespace):
+        """
+        :param service_id: service id
+        :param namespace: applications namespace
+        :return:
+        """
+        self.delete_object('daemonset', 'prepull-{}'.format(service_id), namespace)
+
+
+    def last_log_date(self, pods: list, namespace, since_seconds: int, containers: list = None):
+        """
+        Find when the pods' containers logged last, only the last line of each container is read,
+        the IAM gatekeeper logs the requests that come through the ingress
+        :param pods: list of V1Pod
+        :param namespace: namespace
+        :param since_seconds: length of the checked period
+        :param containers: names of the read containers, all the pods' containers if not provided
+        :return: UTC date of the newest line logged during the period, None if nothing was logged
+        """
+        newest = None
+        for pod in pods:
+            for container in pod.spec.containers:
+                if containers is not None and container.name not in containers:
+                    continue
+                log = self._call(self._service_api.read_namespaced_pod_log, pod.metadata.name, namespace,
+                                 container=container.name, since_seconds=since_seconds, tail_lines=1,
+                                 timestamps=True, limit_bytes=64)
+                if not log:
+                    continue
+                try:
+                    date = datetime.strptime(log[:19], '%Y-%m-%dT%H:%M:%S')
+                except ValueError:
+                    date = datetime.utcnow()
+                newest = date if newest is None else max(newest, date)
+        return newest
+
+
+    def read_pod_logs(self, pod_name, namespace, container, since_seconds: int = None, tail_lines: int = None):
+        """
+        :param pod_name: pod name
+        :param namespace: namespace
+        :param container: container name
+        :param since_seconds: only the lines of the period are returned
+        :param tail_lines: only the last lines are returned
+        :return: log lines prefixed by their RFC3339 timestamp and a space
+        """
+        kwargs = {k: v for k, v in (('since_seconds', since_seconds), ('tail_lines', tail_lines)) if v is not None}
+        return self._call(self._service_api.read_namespaced_pod_log, pod_name, namespace, container=container,
+                          timestamps=True, **kwargs)
+
+
     def delete_deployment(self, name, namespace):
         """
         Delete K8s deployment
@@ -212,10 +803,8 @@ class K8s:
         name = name + "-deployment"
 
         try:
-            self._deployment_api.delete_namespaced_deployment(name=name, namespace=namespace,
-                                                              body=client.V1DeleteOptions(
-                                                                  propagation_policy='Foreground',
-                                                                  grace_period_seconds=5))
+            self._call(self._deployment_api.delete_namespaced_deployment, name=name, namespace=namespace,
+                       body=client.V1DeleteOptions(propagation_policy='Foreground', grace_period_seconds=5))
         except Exception as e:
             current_app.logger.error("Exception when calling _deployment_api->delete_namespaced_deployment")
             current_app.logger.exception(e)
@@ -223,41 +812,32 @@ class K8s:
             raise K8sError("Error occurred in delete_deployment")
 
 
-    def create_node_port_service(self, name, namespace="default", ports=None):
+    def create_node_port_service(self, name, namespace="default", ports=None, node_port=None, labels: dict = None,
+                                 selector: dict = None):
         """
         create and deploy NodePort service
         :param name: application name
         :param namespace: cluster namespace in which the service should be deployed
         :param ports: TCP ports for NodePort service
+        :param node_port: port allocated by the caller, if not provided a port is allocated from the pool
+                and returned to it if the service creation fails
+        :param labels: ownership labels, see owner_labels
+        :param selector: pods selector, the app label by default
         :return: the allocated node_port
         """
-        try:
+        if node_port is None:
+            with self.open_ports.allocation() as np:
+                return self.create_node_port_service(name=name, namespace=namespace, ports=ports, node_port=np,
+                                                     labels=labels, selector=selector)
 
-            if ports['target'] is None:
-                ports['target'] = ports['source']
-                logger.debug("target_port set to be equal to source port")
-
-            service = client.V1Service(
-                kind="Service",
-                metadata=client.V1ObjectMeta(
-                    name=name + "-tcp-service",
-                    namespace=namespace),
-                spec=client.V1ServiceSpec(type="NodePort",
-                                          selector={"app": name})
-            )
-            service.spec.ports = []
-
-            np = self.open_ports.get_available_port()
-            service.spec.ports.append(client.V1ServicePort(name=uuid.uuid4().hex[:6],
-                                                           protocol="TCP",
-                                                           port=ports['source'],
-                                                           target_port=ports['target'],
-                                                           node_port=np))
+        try:
+            service = self.create_node_port_service_object(name, namespace, ports, node_port, labels=labels,
+                                                           selector=selector)
 
             logger.info("Creating application [{}] ￿NodePort Service...".format(name))
-            self._service_api.create_namespaced_service(namespace, body=service, pretty=True)
+            self.apply('service', service, namespace)
             logger.info("Application [{}] NodePort service was created".format(name))
-            return np
+            return node_port
 
         except Exception as e:
             msg = "Error occurred in create_node_port_service"
@@ -267,6 +847,43 @@ class K8s:
             raise K8sError(msg)
 
 
+    def create_node_port_service_object(self, name, namespace, ports, node_port, labels: dict = None,
+                                        selector: dict = None):
+        """
+        :param name: application name
+        :param namespace: cluster namespace in which the service should be deployed
+        :param ports: TCP source and target ports
+        :param node_port: allocated NodePort
+        :param labels: ownership labels, see owner_labels
+        :param selector: pods selector, the app label by default
+        :return: NodePort service object
+        """
+        target_port = ports['target']
+        if target_port is None:
+            target_port = ports['source']
+            logger.debug("target_port set to be equal to source port")
+
+        service = client.V1Service(
+            api_version="v1",
+            kind="Service",
+            metadata=client.V1ObjectMeta(
+                name=name + "-tcp-service",
+                namespace=namespace,
+                labels=labels or owner_labels(name)),
+            spec=client.V1ServiceSpec(type="NodePort",
+                                      selector=selector or {"app": name})
+        )
+        service.spec.ports = []
+
+        # the port name is stable, so the rendered service doesn't change between activations
+        service.spec.ports.append(client.V1ServicePort(name="tcp",
+                                                       protocol="TCP",
+                                                       port=ports['source'],
+                                                       target_port=target_port,
+                                                       node_port=node_port))
+        return service
+
+
     def delete_service(self, name, namespace):
         """
         Delete application's service
@@ -276,7 +893,7 @@ class K8s:
         """
         name = name + "-service"
         try:
-            self._service_api.delete_namespaced_service(name=name, namespace=namespace)
+            self._call(self._service_api.delete_namespaced_service, name=name, namespace=namespace)
 
         except Exception as e:
             current_app.logger.error("Exception when calling CoreV1Api->delete_service")
@@ -289,7 +906,9 @@ class K8s:
 
         name = name + "-ingress"
         try:
-            self._networking_api.delete_namespaced_ingress(name=name, namespace=namespace)
+            if self.shared_ingress is not None and self.shared_ingress.remove([name], namespace) == ['deleted']:
+                return
+            self._call(self._networking_api.delete_namespaced_ingress, name=name, namespace=namespace)
 
         except Exception as e:
             current_app.logger.error("Exception when calling CoreV1Api->delete_namespaced_ingress: %s\n" % e)
@@ -302,7 +921,7 @@ class K8s:
         cfgmap_name = name + "-configmap"
 
         try:
-            self._service_api.delete_namespaced_config_map(name=cfgmap_name, namespace=namespace)
+            self._call(self._service_api.delete_namespaced_config_map, name=cfgmap_name, namespace=namespace)
 
         except Exception as e:
             current_app.logger.error("Exception when calling CoreV1Api->delete_namespaced_configmap: %s\n" % e)
@@ -310,24 +929,135 @@ class K8s:
             raise K8sError("Error occurred in delete_configmap")
 
 
+    def list_managed(self, namespace):
+        """
+        List the objects created by the platform, a single call per kind
+        :param namespace: applications namespace
+        :return: dictionary of kind to dictionary of object name to object
+        """
+        lists = {
+            'deployment': self._deployment_api.list_namespaced_deployment,
+            'service': self._service_api.list_namespaced_service,
+            'ingress': self._networking_api.list_namespaced_ingress,
+            'configmap': self._service_api.list_namespaced_config_map,
+            'hpa': self._autoscaling_api.list_namespaced_horizontal_pod_autoscaler
+        }
+        try:
+            observed = {}
+            for kind, fn in lists.items():
+                ret = self._call(fn, namespace, label_selector=MANAGED_SELECTOR)
+                observed[kind] = {o.metadata.name: o for o in ret.items
+                                  if SHARED_INGRESS_LABEL not in (o.metadata.labels or {})}
+                if kind == 'ingress' and self.shared_ingress is not None:
+                    # the shared ingresses' rules stand for the applications' ingresses
+                    shards = [o for o in ret.items if SHARED_INGRESS_LABEL in (o.metadata.labels or {})]
+                    observed[kind].update(self.shared_ingress.rules(shards))
+            return observed
+
+        except Exception as e:
+            msg = "Error occurred in list_managed"
+            logger.error(msg)
+            logger.exception(e)
+            raise K8sError(msg)
+
+
+    def delete_object(self, kind, name, namespace):
+        """
+        Delete object by its full name
+        :param kind: one of deployment, service, ingress, configmap, daemonset or hpa
+        :param name: object name
+        :param namespace: namespace
+        :return:
+        """
+        deletes = {
+            'daemonset': self._deployment_api.delete_namespaced_daemon_set,
+            'hpa': self._autoscaling_api.delete_namespaced_horizontal_pod_autoscaler,
+            'deployment': self._deployment_api.delete_namespaced_deployment,
+            'service': self._service_api.delete_namespaced_service,
+            'ingress': self._networking_api.delete_namespaced_ingress,
+            'configmap': self._service_api.delete_namespaced_config_map
+        }
+        try:
+            if kind == 'ingress' and self.shared_ingress is not None and \
+                    self.shared_ingress.remove([name], namespace) == ['deleted']:
+                return
+            self._call(deletes[kind], name=name, namespace=namespace,
+                       body=client.V1DeleteOptions(propagation_policy='Background'))
+
+        except Exception as e:
+            msg = "Error occurred in delete_object [{} {}]".format(kind, name)
+            logger.error(msg)
+            logger.exception(e)
+            raise K8sError(msg)
+
+
+    def delete_collection(self, namespace, label_selector):
+        """
+        Delete all the objects matching the label selector with a call per kind,
+        the services API has no collection delete so the services are listed and deleted one by one,
+        the deleted applications' rules are removed from the shared ingresses
+        :param namespace: applications namespace
+        :param label_selector: see owner_selector
+        :return: dictionary of the deleted services' application label to the services' node ports
+        """
+        options = client.V1DeleteOptions(propagation_policy='Background')
+        try:
+            services = self._call(self._service_api.list_namespaced_service, namespace,
+                                  label_selector=label_selector).items
+            deleted = {}
+            for svc in services:
+                self._call(self._service_api.delete_namespaced_service, name=svc.metadata.name, namespace=namespace)
+                ports = deleted.setdefault((svc.metadata.labels or {}).get(APP_LABEL), [])
+                ports.extend(p.node_port for p in svc.spec.ports or [] if p.node_port)
+
+            self._call(self._deployment_api.delete_collection_namespaced_deployment, namespace,
+                       label_selector=label_selector, body=options)
+            self._call(self._networking_api.delete_collection_namespaced_ingress, namespace,
+                       label_selector=label_selector, body=options)
+            self._call(self._service_api.delete_collection_namespaced_config_map, namespace,
+                       label_selector=label_selector, body=options)
+            self._call(self._autoscaling_api.delete_collection_namespaced_horizontal_pod_autoscaler, namespace,
+                       label_selector=label_selector, body=options)
+            if self.shared_ingress is not None and deleted:
+                self.shared_ingress.remove([app + suffix for app in deleted if app
+                                            for suffix in ('-ingress', '-admin-ingress')], namespace)
+
+            logger.info("Objects matching [{}] were deleted".format(label_selector))
+            return deleted
+
+        except Exception as e:
+            msg = "Error occurred in delete_collection [{}]".format(label_selector)
+            logger.error(msg)
+            logger.exception(e)
+            raise K8sError(msg)
+
+
     def list_pods(self):
-        v1 = client.CoreV1Api()
-        ret = v1.list_pod_for_all_namespaces(watch=False)
+        ret = self._call(self._service_api.list_pod_for_all_namespaces, watch=False)
         for i in ret.items:
             print("%s\t%s\t%s" %
                   (i.status.pod_ip, i.metadata.namespace, i.metadata.name))
 
 
-    def create_deployment_object(self, name: str, image: str, ports: List[int], replicas=1, iam=False):
+    def create_deployment_object(self, name: str, image: str, ports: List[int], replicas=1, iam=False,
+                                 labels: dict = None, selector: dict = None, resources: dict = None,
+                                 iam_mode: str = None):
         """
         :param name: application name
         :param image: image that should run on the server side
         :param ports: application communication ports
         :param replicas: number of replicas to create, default is 1
         :param iam: whether or not to integrate deployment with IAM service
+        :param labels: ownership labels, see owner_labels
+        :param selector: pods selector, the app label by default
+        :param resources: requests and limits of the application container, e.g.
+                {'requests': {'cpu': '250m', 'memory': '256Mi'}, 'limits': {'memory': '1Gi'}}
+        :param iam_mode: IAM mode the application was activated with, see gatekeeper
         :return: deployment object
         """
         deployment_name = name + "-deployment"
+        labels = labels or owner_labels(name)
+        selector = selector or {'app': name}
 
         containers = []
         volumes = None
@@ -336,12 +1066,15 @@ class K8s:
             name=name,
             image=image,
             ports=[client.V1ContainerPort(container_port=port) for port in ports])
+        if resources and (resources.get('requests') or resources.get('limits')):
+            service_container.resources = client.V1ResourceRequirements(requests=resources.get('requests') or None,
+                                                                        limits=resources.get('limits') or None)
         containers.append(service_container)
 
-        if iam:
+        if self.gatekeeper(iam, iam_mode):
             cfgmap_name = name + "-configmap"
             keycloack_container = client.V1Container(
-                name='gatekeeper',
+                name=GATEKEEPER_CONTAINER,
                 image='keycloak/keycloak-gatekeeper:7.0.0',
                 ports=[client.V1ContainerPort(container_port=3000, name='keycloackport')],
                 args=['--config=/etc/keycloak-gatekeeper.conf'],
@@ -353,7 +1086,7 @@ class K8s:
 
         # Create and configure the spec section
         template = client.V1PodTemplateSpec(
-            metadata=client.V1ObjectMeta(labels={"app": name}),
+            metadata=client.V1ObjectMeta(labels=dict(labels, **selector)),
             spec=client.V1PodSpec(containers=containers, volumes=volumes))
 
         # service_account_name="papaya", automount_service_account_token=True
@@ -361,48 +1094,34 @@ class K8s:
         spec = client.ExtensionsV1beta1DeploymentSpec(
             replicas=replicas,
             template=template,
-            selector={'matchLabels': {'app': name}})
+            selector={'matchLabels': dict(selector)})
         # Instantiate the deployment object
         deployment = client.ExtensionsV1beta1Deployment(
             api_version="apps/v1",
             kind="Deployment",
-            metadata=client.V1ObjectMeta(name=deployment_name),
+            metadata=client.V1ObjectMeta(name=deployment_name, labels=dict(labels)),
             spec=spec)
 
         return deployment
 
 
-    def create_service(self, name=None, namespace=None, port=None, target_port=None):
+    def create_service(self, name=None, namespace=None, port=None, target_port=None, labels: dict = None,
+                       selector: dict = None):
         """
         Create default service instance
         :param name: application name
         :param namespace: application name space
         :param port: application source port, as defined in Services catalog
         :param target_port: exposed for outside port
+        :param labels: ownership labels, see owner_labels
+        :param selector: pods selector, the app label by default
         :return:
         """
         try:
-            if target_port is None:
-                target_port = port
-                logger.debug("target_port set to be equal to port")
-
-            body = client.V1Service(
-                api_version="v1",
-                kind="Service",
-                metadata=client.V1ObjectMeta(
-                    name=name + "-service"
-                ),
-                spec=client.V1ServiceSpec(
-                    selector={"app": name},
-                    ports=[client.V1ServicePort(
-                        port=port,
-                        target_port=target_port
-                    )]
-                )
-            )
+            body = self.create_service_object(name, port, target_port, labels=labels, selector=selector)
             # Creation of the Deployment in specified namespace
             # (Can replace "default" with a namespace you may have created)
-            self._service_api.create_namespaced_service(namespace=namespace, body=body)
+            self.apply('service', body, namespace)
 
         except Exception as e:
             msg = "Error occurred in create_service function"
@@ -412,48 +1131,47 @@ class K8s:
             raise K8sError(msg)
 
 
-    def create_ingress(self, name, uuid, service_name, service_port, host):
+    @staticmethod
+    def create_service_object(name, port, target_port=None, labels: dict = None, selector: dict = None):
+        """
+        :param name: application name
+        :param port: application source port, as defined in Services catalog
+        :param target_port: exposed for outside port
+        :param labels: ownership labels, see owner_labels
+        :param selector: pods selector, the app label by default
+        :return: service object
+        """
+        if target_port is None:
+            target_port = port
+            logger.debug("target_port set to be equal to port")
+
+        return client.V1Service(
+            api_version="v1",
+            kind="Service",
+            metadata=client.V1ObjectMeta(
+                name=name + "-service",
+                labels=labels or owner_labels(name)
+            ),
+            spec=client.V1ServiceSpec(
+                selector=selector or {"app": name},
+                ports=[client.V1ServicePort(
+                    port=port,
+                    target_port=target_port
+                )]
+            )
+        )
+
+
+    def create_ingress(self, name, uuid, service_name, service_port, host, labels: dict = None, namespace="papaya",
+                       profile: dict = None, iam=False, admin=False, iam_mode: str = None):
 
-        h = uuid + "." + host
         try:
-            body = client.NetworkingV1beta1Ingress(
-                api_version="networking.k8s.io/v1beta1",
-                kind="Ingress",
-                metadata=client.V1ObjectMeta(name=name + "-ingress", annotations={
-                    # require https connection
-                    "ingress.bluemix.net/redirect-to-https": "true",
-                    # increase the package size between the server side component and the client
-                    "ingress.bluemix.net/client-max-body-size": "300m",
-                    # increase timeout, essential when big packages are sent
-                    "ingress.bluemix.net/proxy-connect-timeout": "timeout=600s",
-                    "ingress.bluemix.net/proxy-read-timeout": "timeout=600s"
-                }),
-
-                spec=client.NetworkingV1beta1IngressSpec(
-                    rules=[client.NetworkingV1beta1IngressRule(
-                        host=h,
-                        http=client.NetworkingV1beta1HTTPIngressRuleValue(
-                            paths=[client.NetworkingV1beta1HTTPIngressPath(
-                                path="/",
-                                backend=client.NetworkingV1beta1IngressBackend(
-                                    service_port=service_port,
-                                    service_name=service_name
-                                )
-                            )
-                            ]
-                        )
-                    )
-                    ],
-                    tls=[client.NetworkingV1beta1IngressTLS(hosts=[h], secret_name=self._secret_name)]
-                )
-            )
+            body = self.create_ingress_object(name, uuid, service_name, service_port, host, labels=labels,
+                                              profile=profile, iam=iam, admin=admin, iam_mode=iam_mode)
 
             # Creation of the Deployment in specified namespace
             # (Can replace "default" with a namespace you may have created)
-            self._networking_api.create_namespaced_ingress(
-                namespace="papaya",
-                body=body
-            )
+            self.apply('ingress', body, namespace)
 
         except Exception as e:
             msg = "Error occurred in create_ingress function"
@@ -463,7 +1181,54 @@ class K8s:
             raise K8sError(msg)
 
 
-    def create_http_service_with_ingress(self, uuid=None, name=None, namespace=None, ports=None, host=None, iam=False):
+    def create_ingress_object(self, name, uuid, service_name, service_port, host, labels: dict = None,
+                              profile: dict = None, iam=False, admin=False, iam_mode: str = None):
+        """
+        :param name: application name
+        :param uuid: application sub domain
+        :param service_name: backend service name
+        :param service_port: backend service port
+        :param host: the ingress base host
+        :param labels: ownership labels, see owner_labels
+        :param profile: service's ingress profile, see services.get_ingress_profile
+        :param iam: whether the application is integrated with IAM, without the gatekeeper sidecar
+                the ingress authenticates the requests with the shared auth proxy
+        :param admin: render the ingress of the admin pages, restricted to the ADMIN_GROUPS
+        :param iam_mode: IAM mode the application was activated with, see gatekeeper
+        :return: ingress object
+        """
+        h = uuid + "." + host
+        auth = self.ingress_auth(admin) if iam and not self.gatekeeper(iam, iam_mode) else None
+        return client.NetworkingV1beta1Ingress(
+            api_version="networking.k8s.io/v1beta1",
+            kind="Ingress",
+            metadata=client.V1ObjectMeta(name=name + ("-admin-ingress" if admin else "-ingress"),
+                                         labels=labels or owner_labels(name),
+                                         annotations=render_annotations(profile, service_name,
+                                                                        self.ingress_controller, auth=auth)),
+
+            spec=client.NetworkingV1beta1IngressSpec(
+                rules=[client.NetworkingV1beta1IngressRule(
+                    host=h,
+                    http=client.NetworkingV1beta1HTTPIngressRuleValue(
+                        paths=[client.NetworkingV1beta1HTTPIngressPath(
+                            path=ADMIN_PATH if admin else "/",
+                            backend=client.NetworkingV1beta1IngressBackend(
+                                service_port=service_port,
+                                service_name=service_name
+                            )
+                        )
+                        ]
+                    )
+                )
+                ],
+                tls=[client.NetworkingV1beta1IngressTLS(hosts=[h], secret_name=self._secret_name)]
+            )
+        )
+
+
+    def create_http_service_with_ingress(self, uuid=None, name=None, namespace=None, ports=None, host=None, iam=False,
+                                         labels: dict = None):
         """
         Creating and deploying service and connecting this service to ingress service
 
@@ -473,17 +1238,19 @@ class K8s:
         :param ports: ports for
         :param host:the ingress base host
         :param iam: whether or not to integrate deployment with IAM service
+        :param labels: ownership labels, see owner_labels
         :return:
         """
         try:
             target_port = 3000 if iam else ports['target']
             logger.info("Creating application [{}] service...".format(name))
-            self.create_service(name=name, namespace=namespace, port=ports['source'], target_port=target_port)
+            self.create_service(name=name, namespace=namespace, port=ports['source'], target_port=target_port,
+                                labels=labels)
             logger.info("Application [{}] service was created".format(name))
 
             logger.info("Creating ingress service for application [{}]...".format(name))
             self.create_ingress(name=name, uuid=uuid, service_name=name+'-service',
-                                service_port=ports['source'], host=host)
+                                service_port=ports['source'], host=host, labels=labels, namespace=namespace)
             logger.info("Ingress service for application [{}] was created".format(name))
 
         except Exception as e:
@@ -493,7 +1260,7 @@ class K8s:
             raise K8sError(msg)
 
 
-    def terminate_service(self, name=None, namespace=None, type=None, node_port=None, iam=False):
+    def terminate_service(self, name=None, namespace=None, type=None, node_port=None, iam=False, iam_mode=None):
         """
         Delete application
         :param name:  application name
@@ -501,6 +1268,7 @@ class K8s:
         :param type: can be one of the following "tcp" "http" or "dual"
         :param node_port: relevant only for TCP or dual communication
         :param iam: whether or not to integrate deployment with IAM service
+        :param iam_mode: IAM mode the application was activated with, see gatekeeper
 
         :return:
         """
@@ -535,15 +1303,204 @@ class K8s:
             except:
                 logger.info("Wasn't able to delete ingress service")
 
-        if iam:
+        if iam and self.gatekeeper(iam, iam_mode):
             try:
                 logger.info("Deleting config map [{}]".format(name))
                 self.delete_configmap(name=name, namespace=namespace)
             except:
                 logger.info("Wasn't able to delete ingress configmap")
 
+        elif iam and (type == 'dual' or type == 'http'):
+            try:
+                logger.info("Deleting application [{}] admin ingress".format(name))
+                self.delete_ingress(name + "-admin", namespace)
+            except:
+                logger.info("Wasn't able to delete admin ingress service")
+
+        try:
+            self.delete_object('hpa', name + '-hpa', namespace)
+        except:
+            logger.debug("Application [{}] has no autoscaler".format(name))
+
+
+    def create_hpa_object(self, name, deployment_name, profile: dict, labels: dict = None):
+        """
+        :param name: application name
+        :param deployment_name: name of the scaled deployment
+        :param profile: service's resource profile, see services.get_resource_profile
+        :param labels: ownership labels, see owner_labels
+        :return: HorizontalPodAutoscaler object
+        """
+        return client.V1HorizontalPodAutoscaler(
+            api_version='autoscaling/v1',
+            kind='HorizontalPodAutoscaler',
+            metadata=client.V1ObjectMeta(name=name + '-hpa', labels=labels or owner_labels(name)),
+            spec=client.V1HorizontalPodAutoscalerSpec(
+                scale_target_ref=client.V1CrossVersionObjectReference(api_version='apps/v1', kind='Deployment',
+                                                                      name=deployment_name),
+                min_replicas=profile['min_replicas'],
+                max_replicas=profile['max_replicas'],
+                target_cpu_utilization_percentage=profile.get('target_cpu_utilization') or 80))
+
+
+    def render_application(self, app_name, uuid, image, namespace, host, ports, iam=False, url=None,
+                           node_port=None, labels: dict = None, workload: str = None, profile: dict = None,
+                           ingress_profile: dict = None, iam_mode: str = None):
+        """
+        Render all the application's objects as a single manifest bundle
+        :param app_name: application name
+        :param uuid: application uuid will be used for ingress sub domain
+        :param image: path to server side image
+        :param namespace: cluster namespace in which the application should be deployed
+        :param host: the ingress base host
+        :param ports: http and/or tcp source and target port dictionary, see deploy_dual_port_application
+        :param iam: whether or not to integrate deployment with IAM service
+        :param url: ingress url, required for integration with IAM
+        :param node_port: allocated NodePort, required when the application has a tcp port
+        :param labels: ownership labels, see owner_labels
+        :param workload: instance name of a standby deployment claimed from the warm pool,
+                the application's deployment isn't rendered and the services select the standby's pods
+        :param profile: service's resource profile, see services.get_resource_profile
+        :param ingress_profile: service's ingress profile, see services.get_ingress_profile
+        :param iam_mode: IAM mode the application was activated with, see gatekeeper
+        :return: list of objects, the configuration map comes before the deployment which mounts it
+        """
+        labels = labels or owner_labels(app_name)
+        selector = {INSTANCE_LABEL: workload} if workload else None
+        gatekeeper = self.gatekeeper(iam, iam_mode)
+        http = ports.get('http')
+        tcp = ports.get('tcp')
+        container_ports = [p['source'] for p in (http, tcp) if p and p['source']]
+
+        bundle = []
+        if http and gatekeeper:
+            bundle.append(self.create_iam_configmap_object(app_name, url, http['source'], namespace=namespace,
+                                                           labels=labels))
+
+        if not workload:
+            bundle.append(self.create_deployment_object(app_name, image, container_ports, iam=iam, labels=labels,
+                                                        replicas=profile['min_replicas'] if profile else 1,
+                                                        resources=profile, iam_mode=iam_mode))
+
+        if autoscaled(profile):
+            deployment_name = workload + '-deployment' if workload else app_name + '-deployment'
+            bundle.append(self.create_hpa_object(app_name, deployment_name, profile, labels=labels))
+
+        if http:
+            bundle.append(self.create_service_object(app_name, http['source'],
+                                                     target_port=3000 if gatekeeper else http['target'],
+                                                     labels=labels, selector=selector))
+            bundle.append(self.create_ingress_object(app_name, uuid, app_name + '-service', http['source'], host,
+                                                     labels=labels, profile=ingress_profile, iam=iam,
+                                                     iam_mode=iam_mode))
+            if iam and not gatekeeper:
+                bundle.append(self.create_ingress_object(app_name, uuid, app_name + '-service', http['source'],
+                                                         host, labels=labels, profile=ingress_profile, iam=iam,
+                                                         admin=True, iam_mode=iam_mode))
+
+        if tcp and node_port is not None:
+            bundle.append(self.create_node_port_service_object(app_name, namespace, tcp, node_port, labels=labels,
+                                                               selector=selector))
+
+        return bundle
+
+
+    def apply_bundle(self, name, bundle: list, namespace):
+        """
+        Apply the bundle's objects concurrently,
+        services and ingress don't depend on the pods, only the deployment should wait for the IAM configuration map
+        :param name: application name
+        :param bundle: see render_application
+        :param namespace: cluster namespace
+        :return: dictionary of object name to its apply result
+        """
+        pipeline = DeploymentPipeline(self._executor, name)
+        configmaps = [o.metadata.name for o in bundle if o.kind == 'ConfigMap']
+        for o in bundle:
+            depends = configmaps if o.kind == 'Deployment' else ()
+            kind = 'hpa' if o.kind == 'HorizontalPodAutoscaler' else o.kind.lower()
+            pipeline.add(o.metadata.name, partial(self.apply, kind, o, namespace), depends=depends)
+
+        return pipeline.run()
+
+
+    def apply(self, kind, body, namespace):
+        """
+        Create the object, if it already exists it's patched unless its rendered manifest didn't change,
+        so a retried or repeated activation only sends the changes. With shared ingresses an ingress' rule is
+        added to its shared ingress instead
+        :param kind: one of deployment, service, ingress, configmap, daemonset or hpa
+        :param body: object
+        :param namespace: namespace
+        :return: one of created, patched or unchanged
+        """
+        if kind == 'ingress' and self.shared_ingress is not None:
+            return self.shared_ingress.add(body, namespace)
+
+        apis = {
+            'deployment': (self._deployment_api.create_namespaced_deployment,
+                           self._deployment_api.read_namespaced_deployment,
+                           self._deployment_api.patch_namespaced_deployment),
+            'service': (self._service_api.create_namespaced_service,
+                        self._service_api.read_namespaced_service,
+                        self._service_api.patch_namespaced_service),
+            'ingress': (self._networking_api.create_namespaced_ingress,
+                        self._networking_api.read_namespaced_ingress,
+                        self._networking_api.patch_namespaced_ingress),
+            'configmap': (self._service_api.create_namespaced_config_map,
+                          self._service_api.read_namespaced_config_map,
+                          self._service_api.patch_namespaced_config_map),
+            'daemonset': (self._deployment_api.create_namespaced_daemon_set,
+                          self._deployment_api.read_namespaced_daemon_set,
+                          self._deployment_api.patch_namespaced_daemon_set),
+            'hpa': (self._autoscaling_api.create_namespaced_horizontal_pod_autoscaler,
+                    self._autoscaling_api.read_namespaced_horizontal_pod_autoscaler,
+                    self._autoscaling_api.patch_namespaced_horizontal_pod_autoscaler)
+        }
+        create, read, patch = apis[kind]
+        name = body.metadata.name
+
+        annotations = dict(body.metadata.annotations or {})
+        annotations.pop(MANIFEST_HASH_ANNOTATION, None)
+        body.metadata.annotations = annotations
+        manifest = json.dumps(self.api_client.sanitize_for_serialization(body), sort_keys=True)
+        digest = hashlib.sha256(manifest.encode('utf-8')).hexdigest()
+        annotations[MANIFEST_HASH_ANNOTATION] = digest
+
+        try:
+            self._call(create, namespace, body)
+            return 'created'
+        except ApiException as e:
+            if e.status != 409:
+                raise
+
+        current = self._call(read, name, namespace)
+        if (current.metadata.annotations or {}).get(MANIFEST_HASH_ANNOTATION) == digest:
+            logger.info("{} [{}] is up to date".format(kind, name))
+            return 'unchanged'
+
+        # a dictionary body is sent as a strategic merge patch
+        self._call(patch, name, namespace, self.api_client.sanitize_for_serialization(body))
+        logger.info("{} [{}] was patched".format(kind, name))
+        return 'patched'
+
+
+    @contextmanager
+    def _node_port(self, node_port=None):
+        """
+        :param node_port: port allocated by the caller, which stays responsible for releasing it
+        :return: the caller's port or a port allocated from the pool for the duration of the block
+        """
+        if node_port is not None:
+            yield node_port
+        else:
+            with self.open_ports.allocation() as np:
+                yield np
+
+
     def deploy_dual_port_application(self, app_name=None, uuid=None, image=None, namespace=None, host=None, ports=None,
-                                     iam=False, url=None):
+                                     iam=False, url=None, node_port=None, labels: dict = None, workload: str = None,
+                                     profile: dict = None, ingress_profile: dict = None, iam_mode: str = None):
         """
         Create and deploy application that communicates via http and tcp channels
         :param app_name: application name
@@ -558,33 +1515,40 @@ class K8s:
                 }
         :param iam: whether or not to integrate deployment with IAM service
         :param url: ingress url, required for integration with IAM
+        :param node_port: pre-allocated NodePort, if not provided a port is allocated from the pool
+        :param labels: ownership labels of the created objects, see owner_labels
+        :param workload: instance name of a claimed standby deployment, see render_application
+        :param profile: service's resource profile, see services.get_resource_profile
+        :param ingress_profile: service's ingress profile, see services.get_ingress_profile
+        :param iam_mode: IAM mode the application was activated with, see gatekeeper
         :return: application node_port
         """
 
         try:
-            if iam:
-                self.create_iam_configmap(namespace=namespace, name=app_name, app_port=ports['http']['source'],
-                                          ingress_url=url)
-            self.create_deployment(name=app_name, image=image, namespace=namespace,
-                                   ports=[ports['http']['source'], ports['tcp']['source']], iam=iam)
-            self.create_http_service_with_ingress(uuid=uuid, name=app_name, namespace=namespace, ports=ports['http'],
-                                                  host=host, iam=iam)
-            return self.create_node_port_service(name=app_name, ports=ports['tcp'], namespace=namespace)
+            # the port is returned to the pool if any of the following steps fails
+            with self._node_port(node_port) as np:
+                bundle = self.render_application(app_name, uuid, image, namespace, host, ports, iam=iam, url=url,
+                                                 node_port=np, labels=labels, workload=workload,
+                                                 profile=profile, ingress_profile=ingress_profile,
+                                                 iam_mode=iam_mode)
+                self.apply_bundle(app_name, bundle, namespace)
+                return np
 
         except K8sError:
-            self.terminate_service(name=app_name, namespace=namespace, type="dual", iam=iam)
+            self.terminate_service(name=app_name, namespace=namespace, type="dual", iam=iam, iam_mode=iam_mode)
             raise
 
         except Exception as e:
             msg = "Error occurred in create_dual_port_application"
             logger.error(msg)
             logger.exception(e)
-            self.terminate_service(name=app_name, namespace=namespace, type="dual", iam=iam)
+            self.terminate_service(name=app_name, namespace=namespace, type="dual", iam=iam, iam_mode=iam_mode)
             raise K8sError(msg)
 
 
     def deploy_http_application(self, app_name=None, uuid=None, image=None, namespace=None, host=None, ports=None,
-                                iam=False, url=None):
+                                iam=False, url=None, labels: dict = None, workload: str = None,
+                                profile: dict = None, ingress_profile: dict = None, iam_mode: str = None):
         """
         Create and deploy application that communicates via http channel
 
@@ -599,30 +1563,33 @@ class K8s:
                 }
         :param iam: whether or not to integrate deployment with IAM service
         :param url: ingress url, required for integration with IAM
+        :param labels: ownership labels of the created objects, see owner_labels
+        :param workload: instance name of a claimed standby deployment, see render_application
+        :param profile: service's resource profile, see services.get_resource_profile
+        :param ingress_profile: service's ingress profile, see services.get_ingress_profile
+        :param iam_mode: IAM mode the application was activated with, see gatekeeper
         :return:
         """
         try:
-            if iam:
-                self.create_iam_configmap(namespace=namespace, name=app_name, app_port=ports['http']['source'],
-                                          ingress_url=url)
-
-            self.create_deployment(name=app_name, image=image, namespace=namespace,
-                                   ports=[ports['http']['source']], iam=iam)
-            self.create_http_service_with_ingress(uuid=uuid, name=app_name, namespace=namespace, ports=ports['http'],
-                                                  host=host, iam=iam)
+            bundle = self.render_application(app_name, uuid, image, namespace, host, {'http': ports['http']}, iam=iam,
+                                             url=url, labels=labels, workload=workload, profile=profile,
+                                             ingress_profile=ingress_profile, iam_mode=iam_mode)
+            self.apply_bundle(app_name, bundle, namespace)
+
         except K8sError:
-            self.terminate_service(name=app_name, namespace=namespace, type="http", iam=iam)
+            self.terminate_service(name=app_name, namespace=namespace, type="http", iam=iam, iam_mode=iam_mode)
             raise
 
         except Exception as e:
             msg = "Error occurred in create_dual_port_application"
             logger.error(msg)
             logger.exception(e)
-            self.terminate_service(name=app_name, namespace=namespace, type="http", iam=iam)
+            self.terminate_service(name=app_name, namespace=namespace, type="http", iam=iam, iam_mode=iam_mode)
             raise K8sError(msg)
 
 
-    def deploy_tcp_application(self, app_name=None, uuid=None, image=None, namespace=None, host=None, ports=None):
+    def deploy_tcp_application(self, app_name=None, uuid=None, image=None, namespace=None, host=None, ports=None,
+                               node_port=None, labels: dict = None, workload: str = None, profile: dict = None):
         """
         Create and deploy application that communicates tcp channels
         :param app_name: application name
@@ -634,22 +1601,29 @@ class K8s:
                 {
                     'tcp' : {'source': number, 'target': number}
                 }
+        :param node_port: pre-allocated NodePort, if not provided a port is allocated from the pool
+        :param labels: ownership labels of the created objects, see owner_labels
+        :param workload: instance name of a claimed standby deployment, see render_application
+        :param profile: service's resource profile, see services.get_resource_profile
         :return: application node_port
         """
 
         try:
-            self.create_deployment(name=app_name, image=image, namespace=namespace,
-                                   ports=[ports['http']['source']])
-
-            return self.create_node_port_service(name=app_name, ports=ports['tcp'], namespace=namespace)
+            # the port is returned to the pool if any of the following steps fails
+            with self._node_port(node_port) as np:
+                bundle = self.render_application(app_name, uuid, image, namespace, host, {'tcp': ports['tcp']},
+                                                 node_port=np, labels=labels, workload=workload,
+                                                 profile=profile)
+                self.apply_bundle(app_name, bundle, namespace)
+                return np
 
         except K8sError:
-            self.terminate_service(name=app_name, namespace=namespace, type="http")
+            self.terminate_service(name=app_name, namespace=namespace, type="tcp")
             raise
 
         except Exception as e:
-            msg = "Error occurred in create_dual_port_application"
+            msg = "Error occurred in deploy_tcp_application"
             logger.error(msg)
             logger.exception(e)
-            self.terminate_service(name=app_name, namespace=namespace, type="http")
+            self.terminate_service(name=app_name, namespace=namespace, type="tcp")
             raise K8sError(msg)
@@ -0,0 +1,333 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+This package keeps the applications' host rules in a few shared Ingress objects instead of an Ingress per
+application, so the ingress controller reloads once per batch of activations rather than once per application.
+The rules are sharded by the annotations they require and by their host, the changes submitted within a short
+window are applied with a single list call and a single update per changed shard.
+"""
+import hashlib
+import json
+import logging
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from typing import Callable
+
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+
+logger = logging.getLogger(__name__)
+
+# label of the shared ingresses
+SHARED_INGRESS_LABEL = 'papaya-platform/shared-ingress'
+# rules kept in a shared ingress, JSON dictionary of the application's ingress name to its host and adding date
+RULES_ANNOTATION = 'papaya-platform/rules'
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class IngressBatcher:
+    """
+    Collects the rule changes for window seconds and hands them over to the flush function,
+    a namespace at a time. The flushes are serialized, the changes submitted meanwhile wait for the next one
+    """
+
+    def __init__(self, flush_fn: Callable[[str, list], list], window: float = 0.5):
+        """
+        :param flush_fn: applies the changes of a namespace and returns the result of each change
+        :param window: seconds during which the changes are collected
+        """
+        self._flush_fn = flush_fn
+        self.window = window
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._timer = None
+
+
+    def submit(self, namespace: str, change: dict):
+        """
+        :param namespace: namespace of the shared ingresses
+        :param change: rule change, see SharedIngress
+        :return: future of the change's result
+        """
+        future = Future()
+        with self._lock:
+            self._pending.setdefault(namespace, []).append((change, future))
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self._flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+
+    def _flush(self):
+        with self._flushing:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._timer = None
+
+            for namespace, changes in pending.items():
+                try:
+                    results = self._flush_fn(namespace, [c for c, _ in changes])
+                    for (_, future), result in zip(changes, results):
+                        future.set_result(result)
+
+                except Exception as e:
+                    logger.error("Error occurred in flushing {} ingress rule changes".format(len(changes)))
+                    logger.exception(e)
+                    for _, future in changes:
+                        future.set_exception(e)
+
+
+class SharedIngress:
+    """
+    Adds and removes the applications' host rules of the shared ingresses. An application's rule keeps
+    the name of its dedicated ingress, so the rest of the platform keeps addressing it by that name
+    """
+
+    def __init__(self, api, call: Callable, call_once: Callable, shards: int = 4, window: float = 0.5,
+                 labels: dict = None, max_conflicts: int = 5):
+        """
+        :param api: NetworkingV1beta1Api
+        :param call: guarded api call, see K8s._call
+        :param call_once: guarded api call without retries, see K8s._call_once, the updates' conflicts
+                are handled by listing the shared ingresses again
+        :param shards: number of shared ingresses per annotation set
+        :param window: seconds during which the changes are collected, see IngressBatcher
+        :param labels: labels of the shared ingresses
+        :param max_conflicts: number of times the changes are re-applied after a concurrent update
+        """
+        self._api = api
+        self._call = call
+        self._call_once = call_once
+        self.shards = shards
+        self.labels = dict(labels or {}, **{SHARED_INGRESS_LABEL: 'true'})
+        self.max_conflicts = max_conflicts
+        self._batcher = IngressBatcher(self._flush, window)
+
+
+    def shard_name(self, annotations: dict, host: str):
+        """
+        :param annotations: annotations required by the rule
+        :param host: rule host
+        :return: name of the shared ingress which keeps the rule
+        """
+        key = hashlib.sha1(json.dumps(annotations, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+        index = int(hashlib.sha1(host.encode('utf-8')).hexdigest(), 16) % self.shards
+        return 'papaya-shared-{}-{}-ingress'.format(key, index)
+
+
+    def add(self, body, namespace):
+        """
+        Add or update the rule of an application's ingress, blocks until the batch is applied
+        :param body: application's ingress object, see K8s.create_ingress_object
+        :param namespace: namespace
+        :return: one of created, patched or unchanged
+        """
+        tls = (body.spec.tls or [None])[0]
+        change = {
+            'op': 'add',
+            'name': body.metadata.name,
+            'rule': body.spec.rules[0],
+            'secret': tls.secret_name if tls else None,
+            'annotations': dict(body.metadata.annotations or {})
+        }
+        return self._batcher.submit(namespace, change).result()
+
+
+    def remove(self, names: list, namespace):
+        """
+        Remove the rules of the applications' ingresses, blocks until the batch is applied
+        :param names: names of the applications' ingresses
+        :param namespace: namespace
+        :return: list of deleted or missing, one per name
+        """
+        futures = [self._batcher.submit(namespace, {'op': 'remove', 'name': name}) for name in names]
+        return [f.result() for f in futures]
+
+
+    def rules(self, shards: list):
+        """
+        :param shards: listed shared ingresses
+        :return: dictionary of the applications' ingress names to a placeholder object with the shared ingress'
+                labels and the rule's adding date as the creation timestamp
+        """
+        rules = {}
+        for shard in shards:
+            for name, entry in self._entries(shard).items():
+                created = datetime.strptime(entry['since'], DATE_FORMAT).replace(tzinfo=timezone.utc)
+                rules[name] = client.NetworkingV1beta1Ingress(metadata=client.V1ObjectMeta(
+                    name=name, labels=shard.metadata.labels, creation_timestamp=created))
+        return rules
+
+
+    def _flush(self, namespace, changes: list):
+        """
+        Apply the changes to the shared ingresses, they're listed and applied again after a conflict
+        :return: list of the changes' results
+        """
+        selector = ','.join('{}={}'.format(k, v) for k, v in self.labels.items())
+        attempt = 0
+        while True:
+            shards = {i.metadata.name: i for i in self._call(self._api.list_namespaced_ingress, namespace,
+                                                             label_selector=selector).items}
+            try:
+                return self._apply(namespace, shards, changes)
+
+            except ApiException as e:
+                if e.status != 409 or attempt >= self.max_conflicts:
+                    raise
+                attempt += 1
+                logger.info("Shared ingresses were changed concurrently, applying {} changes again"
+                            .format(len(changes)))
+
+
+    def _apply(self, namespace, shards: dict, changes: list):
+        results = []
+        changed = set()
+        new = set()
+        for change in changes:
+            name = change['name']
+            if change['op'] == 'remove':
+                dropped = [s for s in shards.values() if self._drop(s, name)]
+                changed.update(s.metadata.name for s in dropped)
+                results.append('deleted' if dropped else 'missing')
+                continue
+
+            target = self.shard_name(change['annotations'], change['rule'].host)
+            # the application moves when its annotations change
+            for s in shards.values():
+                if s.metadata.name != target and self._drop(s, name):
+                    changed.add(s.metadata.name)
+
+            if target not in shards:
+                shards[target] = self._new_shard(target, change['annotations'])
+                new.add(target)
+
+            result = self._put(shards[target], name, change['rule'], change['secret'])
+            if result != 'unchanged':
+                changed.add(target)
+            results.append(result)
+
+        for shard_name in sorted(changed):
+            self._write(namespace, shards[shard_name], shard_name in new)
+
+        return results
+
+
+    def _write(self, namespace, shard, new: bool):
+        """Create, update or delete the shared ingress, its resource version guards against concurrent updates"""
+        name = shard.metadata.name
+        if new:
+            if shard.spec.rules:
+                self._call_once(self._api.create_namespaced_ingress, namespace, shard)
+                logger.info("Shared ingress [{}] was created".format(name))
+
+        elif not shard.spec.rules:
+            options = client.V1DeleteOptions(
+                preconditions=client.V1Preconditions(resource_version=shard.metadata.resource_version))
+            self._call_once(self._api.delete_namespaced_ingress, name, namespace, body=options)
+            logger.info("Shared ingress [{}] was deleted".format(name))
+
+        else:
+            self._call_once(self._api.replace_namespaced_ingress, name, namespace, shard)
+            logger.info("Shared ingress [{}] was updated, it has {} rules".format(name, len(shard.spec.rules)))
+
+
+    def _new_shard(self, name, annotations: dict):
+        return client.NetworkingV1beta1Ingress(
+            api_version='networking.k8s.io/v1beta1',
+            kind='Ingress',
+            metadata=client.V1ObjectMeta(name=name, labels=dict(self.labels), annotations=dict(annotations)),
+            spec=client.NetworkingV1beta1IngressSpec(rules=[], tls=[]))
+
+
+    @staticmethod
+    def _entries(shard):
+        return json.loads((shard.metadata.annotations or {}).get(RULES_ANNOTATION) or '{}')
+
+
+    @staticmethod
+    def _set_entries(shard, entries: dict):
+        annotations = dict(shard.metadata.annotations or {})
+        annotations[RULES_ANNOTATION] = json.dumps(entries, sort_keys=True)
+        shard.metadata.annotations = annotations
+
+
+    def _put(self, shard, name, rule, secret):
+        """
+        :return: created if the application had no rule, patched if its rule was replaced, otherwise unchanged
+        """
+        entries = self._entries(shard)
+        entry = entries.get(name)
+        rules = shard.spec.rules or []
+        # the rules read back from the API server have defaulted fields, only their backends are compared
+        if entry and entry['host'] == rule.host and \
+                any(r.host == rule.host and self._backends(r) == self._backends(rule) for r in rules):
+            return 'unchanged'
+
+        if entry:
+            self._drop(shard, name)
+            entries = self._entries(shard)
+            rules = shard.spec.rules
+
+        entries[name] = {'host': rule.host, 'since': datetime.now(timezone.utc).strftime(DATE_FORMAT)}
+        self._set_entries(shard, entries)
+        shard.spec.rules = [r for r in rules if r.host != rule.host] + [rule]
+
+        if secret:
+            tls = [t for t in shard.spec.tls or [] if t.secret_name == secret]
+            if not tls:
+                tls = [client.NetworkingV1beta1IngressTLS(hosts=[], secret_name=secret)]
+                shard.spec.tls = (shard.spec.tls or []) + tls
+            if rule.host not in (tls[0].hosts or []):
+                tls[0].hosts = (tls[0].hosts or []) + [rule.host]
+
+        return 'patched' if entry else 'created'
+
+
+    @staticmethod
+    def _backends(rule):
+        """
+        :return: list of the rule's paths and their backend service and port
+        """
+        paths = rule.http.paths if rule.http else []
+        return [(p.path or '/', p.backend.service_name, str(p.backend.service_port)) for p in paths or []]
+
+
+    def _drop(self, shard, name):
+        """
+        :return: whether the shared ingress had a rule of the application's ingress
+        """
+        entries = self._entries(shard)
+        entry = entries.pop(name, None)
+        if entry is None:
+            return False
+
+        self._set_entries(shard, entries)
+        shard.spec.rules = [r for r in shard.spec.rules or [] if r.host != entry['host']]
+        for t in shard.spec.tls or []:
+            t.hosts = [h for h in t.hosts or [] if h != entry['host']]
+        shard.spec.tls = [t for t in shard.spec.tls or [] if t.hosts]
+        return True
@@ -19,23 +19,49 @@ TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR TH
 SOFTWARE.
 """
 
-import datetime
+from abc import ABC, abstractmethod
+import base64
+import binascii
+import calendar
+import json
+import threading
 import time
 import os
 import logging
 
 from flask import (
-    Blueprint, g, render_template
+    Blueprint, Response, g, render_template, request
 )
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, NotFoundError, TransportError
+from kubernetes.client.rest import ApiException
+import papaya_server.applications as applications
+from papaya_server import db
 from papaya_server.auth import login_required
 from papaya_server.config import Config
 from papaya_server.applications import get_app_by_user, get_app_name
+from papaya_server.exceptions import BadRequest, K8sError, NotFound
+from papaya_server.ttl_cache import TTLCache
 
 
 bp = Blueprint('k8s_logging', __name__, url_prefix='/k8s_logging')
 logger = logging.getLogger(__name__)
 
+# containers whose logs aren't the application's, e.g. the IAM gatekeeper sidecar
+EXCLUDED_CONTAINERS = ['gatekeeper']
+# whether the indexed logs carry the kubernetes metadata, unknown until a lookup by terms found some
+_kubernetes_metadata = None
+# newest first, the file offset orders the lines logged within the same millisecond, see log_sort for the tiebreaker
+LOG_SORT = [
+    {"@timestamp": {"order": "desc"}},
+    {"log.offset": {"order": "desc", "unmapped_type": "long"}}
+]
+PAGE_SIZE = 20
+# containers selectable on the logs page, None is the application's own container
+CONTAINERS = {'app': None, 'gatekeeper': 'gatekeeper'}
+LOG_SOURCES = ('auto', 'es', 'pods')
+# pages served to all the viewers of an application, keyed by the application, the page's cursor and filters
+page_cache = TTLCache(max_size=Config.logging['cache']['size'], ttl=Config.logging['cache']['head_ttl'])
+
 
 def _get_es_connection():
 
@@ -52,20 +78,82 @@ def _get_es_connection():
     return Elasticsearch([{'host': host, 'port': port}], timeout=30)
 
 
-es = _get_es_connection()
+_es = None
+_es_lock = threading.Lock()
 
 
-@bp.route('<int:id>/<int:page>', methods=('GET',))
-@login_required
-def index(id, page, allow_prev=True):
+def get_es():
+    """
+    :return: Elasticsearch client, created on the first use so that the dashboard runs without ES
+    """
+    global _es
 
-    """returns logging information"""
+    with _es_lock:
+        if _es is None:
+            _es = _get_es_connection()
+        return _es
+
+
+def _get_app(id):
     app = get_app_by_user(id, g.user['id'])
-    size = 20
-    start = page * size
-    logs, total = retrieve_logs(start=start, size=size, app_name=app.name.lower(), username=g.user['username'])
-    allow_prev = (page + 1) * size < total
-    return render_template('logging/index.html', logs=logs, id=id, page=page, allow_prev=allow_prev)
+    if app is None:
+        raise NotFound("Application id {0} doesn't exist.".format(id))
+    return app
+
+
+def _container_arg():
+    container = request.args.get('container', 'app')
+    if container not in CONTAINERS:
+        raise BadRequest("container should be one of {}".format(', '.join(CONTAINERS)))
+    return container
+
+
+@bp.route('<int:id>', methods=('GET',))
+@bp.route('<int:id>/<int:page>', methods=('GET',))
+@login_required
+def index(id, page=0):
+
+    """
+    returns logging information, a page of the newest logs or the page older/newer than the cursor,
+    the page number of the former links is ignored
+    """
+    app = _get_app(id)
+    direction = request.args.get('direction', 'older')
+    if direction not in ('older', 'newer'):
+        raise BadRequest("direction should be one of older or newer")
+    container = _container_arg()
+
+    result = retrieve_log_page(size=PAGE_SIZE, app_name=app.name.lower(), username=g.user['username'],
+                               cursor=request.args.get('cursor'), newer=direction == 'newer',
+                               container=CONTAINERS[container])
+    return render_template('logging/index.html', logs=result['logs'], id=id, older=result['older'],
+                           newer=result['newer'], head=result['head'], container=container,
+                           source=result['source'])
+
+
+@bp.route('<int:id>/tail', methods=('GET',))
+@login_required
+def tail(id):
+    """
+    follows the application's logs as server-sent events, from the cursor or from the newest line,
+    a reconnecting browser resumes after the last event it received
+    """
+    app = _get_app(id)
+    name = get_app_name(app.name.lower(), g.user['username'])
+    cursor = request.headers.get('Last-Event-ID') or request.args.get('cursor')
+    after = decode_cursor(cursor)[0] if cursor else None
+    container = CONTAINERS[_container_arg()]
+
+    tail_cfg = Config.logging['tail']
+    events = follow_logs(name, after, interval=tail_cfg['interval'], batch_size=tail_cfg['batch_size'],
+                         max_seconds=tail_cfg['max_seconds'], container=container)
+    # the stream outlives the request, it doesn't hold the session's database connection
+    db.session.remove()
+    response = Response(events, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # the events shouldn't be buffered by a proxy in front of the dashboard
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @bp.route('/admin_view', methods=('GET',))
@@ -86,38 +174,505 @@ def admin_view():
     return render_template('logging/kibana_logging.html', iframe=iframe)
 
 
-def flask_logger():
-    """creates logging information"""
-    for i in range(10):
-        current_time = datetime.datetime.now().strftime('%H:%M:%S') + "\n"
-        yield current_time.encode()
-        time.sleep(0.1)
+def follow_logs(name, after: list = None, interval: float = 2, batch_size: int = 200, max_seconds: int = 600,
+                container=None):
+    """
+    Poll the logs newer than the last sent line and send them as server-sent events. The lines found by a poll
+    are sent as a single event, and the next poll starts only after the event was written to the client,
+    so a slow client slows the polling down instead of piling the lines up
+    :param name: application's K8s name
+    :param after: sort values of the last line the client has, the newest line is looked up if not provided
+    :param interval: seconds between the polls which didn't fill a batch
+    :param batch_size: maximal number of lines per event
+    :param max_seconds: seconds after which the stream ends
+    :param container: container name, the application's container if not provided
+    :return: generator of the events, the event id is the cursor of its last line
+    """
+    if after is None:
+        lines = read_logs('newest', name, 1, container=container)
+        after = lines[0][0] if lines else None
+
+    deadline = time.monotonic() + max_seconds
+    # reconnection delay of the browser's EventSource
+    yield 'retry: {}\n\n'.format(int(interval * 1000))
+
+    while time.monotonic() < deadline:
+        # the source is picked on every poll, the tail moves to ES when the application's pods are gone
+        lines = read_logs('since', name, batch_size, after, container=container)
+
+        if lines:
+            after = lines[-1][0]
+            yield 'id: {}\ndata: {}\n\n'.format(encode_cursor(after), json.dumps([m for _, m in lines]))
+        else:
+            # detects a closed connection
+            yield ': keep-alive\n\n'
 
+        if len(lines) < batch_size:
+            time.sleep(interval)
+
+
+class LogSource(ABC):
+    """
+    Source of the application's logs, a line is a tuple of its sort values, see log_sort, and its message.
+    The sort values of the sources are compatible, the first one is the line's timestamp in epoch millis,
+    so a cursor of one source continues on another
+    """
+
+    name = None
+
+
+    def available(self, name):
+        """
+        :param name: application's K8s name
+        :return: whether the source has the application's logs
+        """
+        return True
+
+
+    @abstractmethod
+    def newest(self, name, size, container=None):
+        """
+        :param name: application's K8s name
+        :param size: maximal number of lines
+        :param container: container name, the application's container if not provided
+        :return: the newest lines, oldest first
+        """
+        pass
+
+
+    @abstractmethod
+    def since(self, name, size, after: list = None, container=None):
+        """
+        :param name: application's K8s name
+        :param size: maximal number of lines
+        :param after: sort values of the last known line, the oldest lines are returned if not provided
+        :param container: container name, the application's container if not provided
+        :return: the lines newer than after, oldest first
+        """
+        pass
+
+
+class ElasticsearchSource(LogSource):
+    """
+    The indexed logs, the whole history including the deleted pods, behind the pods by the ingestion lag
+    """
+
+    name = 'es'
+
+
+    def newest(self, name, size, container=None):
+        body = {'size': size, 'sort': log_sort(), 'track_total_hits': False}
+        hits = _search(body, name, container=container)['hits']['hits']
+        return [(h['sort'], h['_source']['message']) for h in reversed(hits)]
 
-def retrieve_logs(start, size, app_name=None, username=None):
 
-    logfile_name = get_app_name(app_name, username)
-    logging.info("Looking for file {}".format(logfile_name))
+    def since(self, name, size, after: list = None, container=None):
+        body = {'size': size, 'sort': log_sort(order='asc'), 'track_total_hits': False}
+        if after is not None:
+            body['search_after'] = search_after(after)
+        hits = _search(body, name, container=container)['hits']['hits']
+        return [(h['sort'], h['_source']['message']) for h in hits]
+
+
+class PodLogSource(LogSource):
+    """
+    The logs read from the application's running pods through the API server, without any lag
+    but only the current containers' logs. The kubelet has no log cursor, so a poll reads the period
+    since the cursor with since_seconds and drops the lines the client already has
+    """
+
+    name = 'pods'
+
+
+    def __init__(self, k8s, cluster_state, namespace):
+        """
+        :param k8s: K8s client
+        :param cluster_state: cluster state cache, the application's pods are looked up in it
+        :param namespace: applications namespace
+        """
+        self._k8s = k8s
+        self._cluster_state = cluster_state
+        self._namespace = namespace
+
+
+    def _pods(self, name):
+        if self._cluster_state is None or not self._cluster_state.pods.synced:
+            return []
+        return [p for p in self._cluster_state.pods.by_label(name) if p.status and p.status.phase == 'Running']
 
+
+    def available(self, name):
+        return bool(self._pods(name))
+
+
+    def _read(self, name, container=None, since_seconds: int = None, tail_lines: int = None):
+        """
+        :return: lines of all the application's pods, oldest first
+        """
+        stamped = []
+        for pod in self._pods(name):
+            for c in pod.spec.containers:
+                if (container is None and c.name in EXCLUDED_CONTAINERS) or (container and c.name != container):
+                    continue
+                try:
+                    text = self._k8s.read_pod_logs(pod.metadata.name, self._namespace, c.name,
+                                                   since_seconds=since_seconds, tail_lines=tail_lines)
+                except (ApiException, K8sError) as e:
+                    logger.info("Logs of {}/{} aren't readable: {}".format(pod.metadata.name, c.name, e))
+                    continue
+
+                for line in (text or '').splitlines():
+                    stamp, _, message = line.partition(' ')
+                    # the fixed width RFC3339 timestamps sort as strings
+                    stamped.append((stamp, message))
+
+        stamped.sort(key=lambda line: line[0])
+        return [([parse_timestamp(stamp), 0], message) for stamp, message in stamped]
+
+
+    def newest(self, name, size, container=None):
+        return self._read(name, container, tail_lines=size)[-size:]
+
+
+    def since(self, name, size, after: list = None, container=None):
+        if after is None:
+            return self._read(name, container)[:size]
+
+        since_seconds = max(1, int(time.time() - after[0] / 1000) + 1)
+        lines = [line for line in self._read(name, container, since_seconds=since_seconds) if line[0][0] > after[0]]
+        if len(lines) <= size:
+            return lines
+
+        # the cursor has the millisecond only, so a batch doesn't end within one
+        last = lines[size - 1][0][0]
+        return [line for line in lines if line[0][0] <= last]
+
+
+def parse_timestamp(stamp: str):
+    """
+    :param stamp: RFC3339 UTC timestamp of the kubelet, e.g. 2021-05-01T12:00:00.123456789Z
+    :return: epoch millis, 0 if the timestamp isn't parseable
+    """
+    try:
+        seconds = calendar.timegm(time.strptime(stamp[:19], '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return 0
+
+    fraction = stamp[20:].rstrip('Z') if stamp[19:20] == '.' else ''
+    return seconds * 1000 + int((fraction + '000')[:3] or 0)
+
+
+_sources = {}
+
+
+def get_source(name):
+    """
+    :param name: es or pods
+    :return: log source
+    """
+    if name not in _sources:
+        if name == 'es':
+            _sources[name] = ElasticsearchSource()
+        else:
+            _sources[name] = PodLogSource(getattr(applications, 'kubernetes', None),
+                                          getattr(applications, 'cluster_state', None), Config.k8s['namespace'])
+    return _sources[name]
+
+
+def select_source(name, fresh: bool):
+    """
+    Pick the cheapest source which has the logs as fresh as needed, the newest logs and the live tail
+    are read from the pods, a kubelet read per container, and the history from ES
+    :param name: application's K8s name
+    :param fresh: whether the logs are needed without the ingestion lag
+    :return: log source
+    """
+    mode = Config.logging['source']
+    if mode not in LOG_SOURCES:
+        raise ValueError("Unknown log source {}, should be one of {}".format(mode, ', '.join(LOG_SOURCES)))
+
+    if mode != 'auto':
+        return get_source(mode)
+
+    pods = get_source('pods')
+    return pods if fresh and pods.available(name) else get_source('es')
+
+
+def read_logs(method, name, size, after: list = None, container=None):
+    """
+    Read the newest lines or the lines since the cursor from the selected source,
+    the pods are read if ES doesn't respond
+    :param method: newest or since
+    :param name: application's K8s name
+    :param size: maximal number of lines
+    :param after: sort values of the last known line, for since only
+    :param container: container name, the application's container if not provided
+    :return: lines, oldest first
+    """
+    source = select_source(name, fresh=True)
+    args = (name, size, after) if method == 'since' else (name, size)
+    try:
+        return getattr(source, method)(*args, container=container)
+
+    except TransportError as e:
+        pods = get_source('pods')
+        if source is pods or not pods.available(name):
+            raise
+        logger.warning("Elasticsearch failed, reading {} logs from the pods: {}".format(name, e))
+        return getattr(pods, method)(*args, container=container)
+
+
+def build_log_filter(name, namespace=None, fields: dict = None, container=None):
+    """
+    Exact term filters on the kubernetes metadata keyword fields, they run in filter context
+    so they aren't scored and ES caches them
+    :param name: application's K8s name, the pods' app label
+    :param namespace: applications namespace
+    :param fields: metadata field names, see Config.logging['es']['fields']
+    :param container: container name, the application's containers if not provided
+    :return: bool query
+    """
+    fields = fields or Config.logging['es']['fields']
+    namespace = namespace or Config.k8s['namespace']
     query = {
-        ""
-        "from": start,
-        "size": size,
-        "sort": [{"@timestamp": {"order": "desc"}}],
-        "query": {
-            "wildcard": {
-                "log.file.path": {
-                    "value": "/var/data/kubeletlogs/*/{}/*.log".format(logfile_name)
-                }
-            }
+        "bool": {
+            "filter": [
+                {"term": {fields['namespace']: namespace}},
+                {"term": {fields['app']: name}}
+            ]
+        }
+    }
+    if container:
+        query['bool']['filter'].append({"term": {fields['container']: container}})
+    else:
+        query['bool']['must_not'] = [{"terms": {fields['container']: EXCLUDED_CONTAINERS}}]
+    return query
+
+
+def build_path_filter(name):
+    """
+    Fallback for logs without the kubernetes metadata, the wildcard with an inner '*' scans the path terms
+    :param name: application's K8s name, the application's container name
+    :return: bool query
+    """
+    return {
+        "bool": {
+            "filter": [
+                {"wildcard": {"log.file.path": {"value": "/var/data/kubeletlogs/*/{}/*.log".format(name)}}}
+            ]
         }
     }
-    data = es.search(index='filebeat*', body=query)
-    print(len(data))
 
-    if len(data) == 0:
-        return [], data['hits']['total']['value']
 
-    logs = [d['_source']['message'] for d in data['hits']['hits']]
-    logs.reverse()
-    return logs, data['hits']['total']['value']
+def log_sort(pit: bool = False, order='desc'):
+    """
+    The lines of two pods can share the timestamp and the file offset, so the sort ends with a unique tiebreaker,
+    otherwise search_after skips one of them at a page boundary
+    :param pit: whether a point in time is searched, its _shard_doc is the tiebreaker,
+            otherwise the Config.logging['es']['tiebreaker'] keyword field
+    :param order: desc for the newest lines first, asc for the oldest
+    :return: search sort
+    """
+    if pit:
+        tiebreaker = {"_shard_doc": {"order": order}}
+    else:
+        tiebreaker = {Config.logging['es']['tiebreaker']: {"order": order, "unmapped_type": "keyword"}}
+    return [{k: dict(v, order=order)} for s in LOG_SORT for k, v in s.items()] + [tiebreaker]
+
+
+def search_after(after: list, pit: bool = False):
+    """
+    Fit the sort values of a cursor to the search, the cursors of the pods and of the other kind of search
+    have no tiebreaker of the search's type
+    :param after: sort values of the cursor, see log_sort
+    :param pit: whether a point in time is searched
+    :return: search_after values
+    """
+    values = list(after[:len(LOG_SORT)])
+    tiebreaker = after[len(LOG_SORT)] if len(after) > len(LOG_SORT) else None
+    if pit:
+        values.append(tiebreaker if isinstance(tiebreaker, int) else 0)
+    else:
+        values.append(tiebreaker if isinstance(tiebreaker, str) else '')
+    return values
+
+
+def close_point_in_time(pit: str):
+    """
+    :param pit: point in time id, which no further page searches
+    :return:
+    """
+    try:
+        get_es().close_point_in_time(body={'id': pit})
+    except TransportError as e:
+        # it expires after the keep alive anyway
+        logger.info("Point in time wasn't closed: {}".format(e))
+
+
+def encode_cursor(sort_values: list, pit: str = None):
+    """
+    :param sort_values: sort values of the page's boundary hit
+    :param pit: point in time id
+    :return: url safe cursor
+    """
+    payload = json.dumps({'after': sort_values, 'pit': pit}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str):
+    """
+    :param cursor: see encode_cursor
+    :return: sort values and point in time id
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return list(payload['after']), payload.get('pit')
+
+    except (binascii.Error, UnicodeError, ValueError, KeyError, TypeError):
+        raise BadRequest("Invalid logs cursor")
+
+
+def _search(body: dict, name, pit: str = None, container=None):
+    """
+    Search the application's logs by the metadata terms, or by the file path if the logs have no metadata
+    :param body: search body without the query
+    :param name: application's K8s name
+    :param pit: point in time id, the index is searched if not provided
+    :param container: container name, the application's container if not provided
+    :return: search response
+    """
+    global _kubernetes_metadata
+
+    es_cfg = Config.logging['es']
+    kwargs = {}
+    if pit:
+        body['pit'] = {'id': pit, 'keep_alive': es_cfg['point_in_time_keep_alive']}
+    else:
+        kwargs['index'] = es_cfg['index']
+
+    es = get_es()
+    body['query'] = build_log_filter(name, container=container)
+    data = es.search(body=body, **kwargs)
+
+    if data['hits']['hits'] or data['hits'].get('total', {}).get('value'):
+        _kubernetes_metadata = True
+
+    # the path has the application's container only
+    elif es_cfg['path_fallback'] and not _kubernetes_metadata and not container:
+        body['query'] = build_path_filter(name)
+        data = es.search(body=body, **kwargs)
+
+    return data
+
+
+def retrieve_log_page(size, app_name=None, username=None, cursor: str = None, newer=False, container=None):
+    """
+    Page through the logs with search_after, a page costs the same at any depth and new logs don't shift the pages.
+    The newest page comes from the pods if the selected source has no lag, the older pages come from ES
+    :param size: page size
+    :param app_name: application name
+    :param username: user name of the application owner
+    :param cursor: boundary of the previous page, the newest logs are returned without it
+    :param newer: whether the page newer than the cursor is returned, otherwise the older one
+    :param container: container name, the application's container if not provided
+    :return: dictionary of the logs, oldest first, the cursors of the older and newer pages or None,
+            the cursor of the page's newest line, which the live tail follows, and the source name
+    """
+    name = get_app_name(app_name, username)
+    key = ('page', name, container, cursor, newer, size)
+    result = page_cache.get(key)
+    if result is None:
+        result = _log_page(name, size, cursor, newer, container)
+        page_cache.put(key, result, ttl=_page_ttl(result))
+    return result
+
+
+def _page_ttl(page: dict):
+    """
+    A page followed by newer lines doesn't change once its lines were ingested, the newest page
+    and the pages within the ingestion lag change with every new or late line
+    :param page: see retrieve_log_page
+    :return: seconds the page is cached for
+    """
+    cache_cfg = Config.logging['cache']
+    if page['newer'] and page['head']:
+        newest = decode_cursor(page['head'])[0][0]
+        if time.time() * 1000 - newest > cache_cfg['ingestion_lag'] * 1000:
+            return cache_cfg['page_ttl']
+    return cache_cfg['head_ttl']
+
+
+def _log_page(name, size, cursor: str = None, newer=False, container=None):
+    """
+    see retrieve_log_page
+    """
+    if cursor is None:
+        source = select_source(name, fresh=True)
+        if source.name == 'pods':
+            lines = source.newest(name, size, container=container)
+            return {
+                'logs': [m for _, m in lines],
+                'head': encode_cursor(lines[-1][0]) if lines else None,
+                # the older lines may be in ES only
+                'older': encode_cursor(lines[0][0]) if lines and Config.logging['source'] == 'auto' else None,
+                'newer': None,
+                'source': source.name
+            }
+    elif Config.logging['source'] == 'pods':
+        raise BadRequest("Older logs are available with Elasticsearch only")
+
+    es = get_es()
+    es_cfg = Config.logging['es']
+    after, pit = decode_cursor(cursor) if cursor else (None, None)
+    # the first page and a page continuing from the pods open the point in time
+    if pit is None and es_cfg['point_in_time']:
+        pit = es.open_point_in_time(index=es_cfg['index'], keep_alive=es_cfg['point_in_time_keep_alive'])['id']
+
+    order = 'asc' if newer else 'desc'
+    # one more hit tells whether there is a further page
+    body = {
+        'size': size + 1,
+        'sort': log_sort(bool(pit), order),
+        'track_total_hits': False
+    }
+    if after is not None:
+        body['search_after'] = search_after(after, bool(pit))
+
+    try:
+        data = _search(body, name, pit, container=container)
+    except NotFoundError:
+        if not pit:
+            raise
+        # the point in time expired, the pages continue on the live index
+        logger.info("Point in time of {} logs expired".format(name))
+        pit = None
+        body.pop('pit', None)
+        body['sort'] = log_sort(order=order)
+        if after is not None:
+            body['search_after'] = search_after(after)
+        data = _search(body, name, container=container)
+
+    pit = data.get('pit_id', pit)
+    hits = data['hits']['hits']
+    more = len(hits) > size
+    hits = hits[:size]
+    if not newer:
+        hits.reverse()
+
+    # the last page in its direction closes the point in time, the pages back continue on the live index
+    if pit and not more:
+        close_point_in_time(pit)
+        pit = None
+
+    if not hits:
+        return {'logs': [], 'older': cursor if newer else None, 'newer': cursor if not newer and cursor else None,
+                'head': cursor, 'source': 'es'}
+
+    return {
+        'logs': [h['_source']['message'] for h in hits],
+        'head': encode_cursor(hits[-1]['sort']),
+        'older': encode_cursor(hits[0]['sort'], pit) if more or newer else None,
+        'newer': encode_cursor(hits[-1]['sort'], pit) if (more and newer) or (cursor and not newer) else None,
+        'source': 'es'
+    }
+
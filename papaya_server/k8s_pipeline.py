@@ -0,0 +1,154 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+This package provide a pipeline which runs the independent steps of an application deployment concurrently.
+"""
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Callable, Iterable
+
+from flask import current_app, has_app_context
+
+logger = logging.getLogger(__name__)
+
+
+class DeploymentPipeline:
+    """
+    Runs deployment steps on a shared executor, a step is submitted as soon as all the steps it depends on
+    have finished. If a step fails no further steps are submitted, the pipeline waits for the running steps
+    and re-raises the first error, so the caller can safely roll back afterwards.
+    """
+
+    def __init__(self, executor, name: str):
+        """
+        :param executor: concurrent.futures executor that runs the steps
+        :param name: pipeline name used in the report, usually the application name
+        """
+        self._executor = executor
+        self.name = name
+        self._steps = {}
+        self.timings = {}
+
+
+    def add(self, name: str, fn: Callable, depends: Iterable[str] = ()):
+        """
+        :param name: step name
+        :param fn: callable without arguments
+        :param depends: names of the steps that should finish before this step starts
+        :return: the pipeline
+        """
+        self._steps[name] = {'fn': fn, 'depends': set(depends)}
+        return self
+
+
+    def _wrap(self, name, fn, t0):
+        """Run the step within the caller's application context and record its timing"""
+        app = current_app._get_current_object() if has_app_context() else None
+
+        def step():
+            start = time.monotonic() - t0
+            try:
+                if app is None:
+                    return fn()
+                with app.app_context():
+                    return fn()
+            finally:
+                end = time.monotonic() - t0
+                self.timings[name] = {'start': start, 'end': end, 'duration': end - start}
+
+        return step
+
+
+    def run(self):
+        """
+        Run all the steps
+        :return: dictionary of step results
+        """
+        for name, step in self._steps.items():
+            unknown = step['depends'] - set(self._steps)
+            if unknown:
+                raise ValueError("Step [{}] depends on unknown steps {}".format(name, sorted(unknown)))
+
+        t0 = time.monotonic()
+        results = {}
+        running = {}
+        started = set()
+        error = None
+
+        while True:
+            if error is None:
+                for name, step in self._steps.items():
+                    if name not in started and step['depends'] <= set(results):
+                        started.add(name)
+                        running[self._executor.submit(self._wrap(name, step['fn'], t0))] = name
+
+            if not running:
+                break
+
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for f in finished:
+                name = running.pop(f)
+                try:
+                    results[name] = f.result()
+                except Exception as e:
+                    logger.error("Step [{}] of [{}] deployment failed".format(name, self.name))
+                    error = error or e
+
+        self.report(time.monotonic() - t0)
+
+        if error is not None:
+            raise error
+
+        if len(results) != len(self._steps):
+            raise ValueError("Circular dependency between steps {}".format(sorted(set(self._steps) - started)))
+
+        return results
+
+
+    def critical_path(self):
+        """
+        :return: chain of finished steps that determined the pipeline duration
+        """
+        if not self.timings:
+            return []
+
+        path = [max(self.timings, key=lambda n: self.timings[n]['end'])]
+        while True:
+            deps = [d for d in self._steps[path[-1]]['depends'] if d in self.timings]
+            if not deps:
+                break
+            path.append(max(deps, key=lambda n: self.timings[n]['end']))
+
+        path.reverse()
+        return path
+
+
+    def report(self, total):
+        """Log the steps' timings and the critical path"""
+        for name in sorted(self.timings, key=lambda n: self.timings[n]['start']):
+            t = self.timings[name]
+            logger.info("Deployment [{}] step [{}] started at {:.3f}s and took {:.3f}s"
+                        .format(self.name, name, t['start'], t['duration']))
+
+        path = " -> ".join("{} ({:.3f}s)".format(n, self.timings[n]['duration']) for n in self.critical_path())
+        logger.info("Deployment [{}] took {:.3f}s, critical path: {}".format(self.name, total, path))
@@ -0,0 +1,289 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+This package protects the K8s API server and the dashboard from each other: a token bucket limits the calls rate,
+throttled and failed calls are retried with jittered exponential backoff and a circuit breaker fails fast
+while the API server is unhealthy.
+"""
+import json
+import logging
+import random
+import threading
+import time
+
+from kubernetes.client.rest import ApiException
+from urllib3.exceptions import HTTPError
+
+from papaya_server.exceptions import K8sError
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Thread safe token bucket, callers block until a token is available"""
+
+    def __init__(self, rate: float, burst: int):
+        """
+        :param rate: tokens added per second
+        :param burst: bucket capacity
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+
+    def acquire(self):
+        """Take a token, waiting for it if the bucket is empty"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+                self.waited += wait
+
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and rejects the calls for reset_timeout seconds,
+    then lets a single probe call through and closes again if it succeeds
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+
+    def allow(self):
+        """:return: whether a call may be performed"""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._probing = False
+
+            if self.state == self.CLOSED:
+                return True
+
+            if self.state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+
+            self.rejected += 1
+            return False
+
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("K8s API circuit breaker is closed")
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                    logger.warning("K8s API circuit breaker is open after {} failures".format(self.failures))
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+
+class ApiGuard:
+    """Performs K8s api calls through the rate limiter, the retries and the circuit breaker"""
+
+    def __init__(self, rate: float = 20, burst: int = 40, max_retries: int = 4, backoff_base: float = 0.5,
+                 backoff_max: float = 30, failure_threshold: int = 5, reset_timeout: float = 30):
+        """
+        :param rate: calls per second
+        :param burst: calls that may be performed at once after an idle period
+        :param max_retries: retries of a failed call
+        :param backoff_base: seconds, delay before the first retry
+        :param backoff_max: seconds, maximal delay between retries
+        :param failure_threshold: consecutive failures that open the circuit
+        :param reset_timeout: seconds the circuit stays open
+        """
+        self.limiter = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.errors = 0
+
+
+    def _count(self, **counters):
+        with self._lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+
+    @staticmethod
+    def is_retryable(e: Exception):
+        """
+        :param e: error raised by the api call
+        :return: whether the call may succeed if it's repeated
+        """
+        if isinstance(e, ApiException):
+            if e.status in RETRYABLE_STATUSES:
+                return True
+            if e.status == 409:
+                # optimistic concurrency conflicts are retryable, AlreadyExists isn't
+                try:
+                    return json.loads(e.body).get('reason') == 'Conflict'
+                except (TypeError, ValueError, AttributeError):
+                    return False
+            return False
+
+        return isinstance(e, HTTPError)
+
+
+    @staticmethod
+    def is_server_failure(e: Exception):
+        """:return: whether the error indicates that the API server is unhealthy"""
+        if isinstance(e, ApiException):
+            return e.status is not None and e.status >= 500
+        return isinstance(e, HTTPError)
+
+
+    @staticmethod
+    def retry_after(e: Exception):
+        """:return: seconds requested by the server's Retry-After header or None"""
+        headers = getattr(e, 'headers', None)
+        if not headers:
+            return None
+        try:
+            return float(headers.get('Retry-After'))
+        except (TypeError, ValueError):
+            return None
+
+
+    def backoff(self, attempt: int, e: Exception):
+        """
+        :param attempt: number of the failed attempt, starting from 0
+        :param e: error of the failed attempt
+        :return: seconds to wait before the next attempt, full jitter unless the server asked for more
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        requested = self.retry_after(e)
+        if requested is not None:
+            delay = max(delay, min(requested, self.backoff_max))
+        return delay
+
+
+    def call(self, fn, *args, **kwargs):
+        """
+        :param fn: api function
+        :return: api function result
+        :raise K8sError: if the circuit is open
+        """
+        return self._call(fn, args, kwargs, self.max_retries)
+
+
+    def call_once(self, fn, *args, **kwargs):
+        """
+        Perform the call through the rate limiter and the circuit breaker without retrying it,
+        for callers which handle the failures themselves, e.g. the conflicts of their optimistic updates
+        :param fn: api function
+        :return: api function result
+        :raise K8sError: if the circuit is open
+        """
+        return self._call(fn, args, kwargs, 0)
+
+
+    def _call(self, fn, args, kwargs, max_retries: int):
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise K8sError("K8s API server is unavailable", status_code=503)
+
+            self.limiter.acquire()
+            self._count(calls=1)
+            try:
+                result = fn(*args, **kwargs)
+
+            except Exception as e:
+                self._count(errors=1)
+                if self.is_server_failure(e):
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+
+                if attempt >= max_retries or not self.is_retryable(e):
+                    raise
+
+                delay = self.backoff(attempt, e)
+                logger.info("K8s api call {} failed ({}), retrying in {:.2f}s"
+                            .format(getattr(fn, '__name__', fn), getattr(e, 'status', e.__class__.__name__), delay))
+                self._count(retries=1)
+                attempt += 1
+                time.sleep(delay)
+                continue
+
+            self.breaker.record_success()
+            return result
+
+
+    def snapshot(self):
+        """
+        :return: counters and the circuit state
+        """
+        return {
+            'circuit_state': self.breaker.state,
+            'circuit_failures': self.breaker.failures,
+            'circuit_opened_total': self.breaker.opened,
+            'circuit_rejected_total': self.breaker.rejected,
+            'calls_total': self.calls,
+            'retries_total': self.retries,
+            'errors_total': self.errors,
+            'rate_limit_wait_seconds_total': self.limiter.waited
+        }
@@ -0,0 +1,83 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Leader election of the background loops which should run in a single dashboard process, e.g. the warm pool refill,
+the leader holds the loop's lease row and renews it on every iteration.
+"""
+import logging
+import os
+import platform
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+from papaya_server import db
+from papaya_server.models import LoopLease
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderLease:
+    """
+    Lease of a background loop backed by the loop_leases table
+
+    The primary key on the loop's name makes the first claim atomic across processes, the lease is renewed
+    by its holder and taken over by another process once it expired, e.g. after its holder died.
+    """
+
+    def __init__(self, name: str, ttl: int = 90):
+        """
+        :param name: loop name
+        :param ttl: seconds the lease is valid for unless renewed, should exceed the loop's period
+        """
+        self.name = name
+        self.ttl = ttl
+        self.holder = '{}:{}'.format(platform.node(), os.getpid())
+
+
+    def acquire(self):
+        """
+        Renew the lease or take it over if it expired, the lease is committed on a dedicated connection
+        :return: whether this process leads the loop
+        """
+        table = LoopLease.__table__
+        now = datetime.utcnow()
+        values = dict(holder=self.holder, expires_at=now + timedelta(seconds=self.ttl))
+
+        with db.engine.begin() as conn:
+            updated = conn.execute(table.update()
+                                   .where(and_(table.c.name == self.name,
+                                               or_(table.c.holder == self.holder, table.c.expires_at <= now)))
+                                   .values(**values)).rowcount
+        if updated:
+            return True
+
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(table.insert().values(name=self.name, **values))
+            logger.info("{} leads the {} loop".format(self.holder, self.name))
+            return True
+
+        except IntegrityError:
+            return False
@@ -0,0 +1,83 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+This package exposes the platform's operational metrics in Prometheus text format, to the scrapes which present
+the METRICS_TOKEN bearer token or to the logged in users.
+"""
+import hmac
+import os
+
+from flask import Blueprint, Response, g, request
+
+from papaya_server.config import Config
+from papaya_server.exceptions import Forbidden
+
+bp = Blueprint('metrics', __name__, url_prefix='/metrics')
+
+CIRCUIT_STATES = ('closed', 'open', 'half_open')
+
+
+def format_metrics(prefix: str, values: dict):
+    """
+    :param prefix: metrics name prefix
+    :param values: dictionary of metric name to number
+    :return: lines in Prometheus text format
+    """
+    lines = []
+    for name, value in values.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        metric = prefix + name
+        lines.append('# TYPE {} {}'.format(metric, 'counter' if name.endswith('_total') else 'gauge'))
+        lines.append('{} {}'.format(metric, value))
+    return lines
+
+
+def authorized():
+    """
+    :return: whether the request presents the scrape token, or a logged in user's session if no token is configured
+    """
+    token = Config.metrics['token']
+    if token:
+        return hmac.compare_digest(request.headers.get('Authorization', ''), 'Bearer ' + token)
+    return g.user is not None
+
+
+@bp.route('', methods=('GET',))
+def index():
+    if not authorized():
+        raise Forbidden("The metrics require the scrape token")
+
+    lines = []
+
+    if os.getenv('NOT_BUILDING', False):
+        from papaya_server.applications import kubernetes
+
+        api = kubernetes.api_guard.snapshot()
+        lines.append('# TYPE papaya_k8s_api_circuit_state gauge')
+        for state in CIRCUIT_STATES:
+            lines.append('papaya_k8s_api_circuit_state{{state="{}"}} {}'
+                         .format(state, int(api['circuit_state'] == state)))
+        lines += format_metrics('papaya_k8s_api_', api)
+        lines += format_metrics('papaya_node_ports_', kubernetes.open_ports.snapshot())
+
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
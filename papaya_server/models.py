@@ -48,6 +48,16 @@ class Application(db.Model):
     node_port = db.Column(db.Integer, nullable=True)
     status = db.Column(db.Integer, nullable=False)
     iam = db.Column(db.BOOLEAN, nullable=False, server_default='0')
+    # IAM mode the application was activated with, 'sidecar' or 'ingress', see Config.k8s['iam_mode']
+    iam_mode = db.Column(db.String(MAX_STR_LENGTH), nullable=True)
+    activation_date = db.Column(db.DateTime(), nullable=True)
+    ready_date = db.Column(db.DateTime(), nullable=True)
+    # seconds between the activation and the deployment becoming available
+    time_to_ready = db.Column(db.Float, nullable=True)
+    # the idle monitor leaves a resumed application alone for a while, its new pods didn't log anything yet
+    resume_date = db.Column(db.DateTime(), nullable=True)
+    # name of the standby deployment claimed from the service's warm pool, None for a deployment of its own
+    workload_name = db.Column(db.String(MAX_STR_LENGTH), nullable=True)
 
     db.UniqueConstraint('name', 'user_id', name='app_unq')
 
@@ -94,9 +104,80 @@ class Service(db.Model):
     agent_container = db.Column(db.String(MAX_STR_LENGTH), nullable=False)
     agent_tcp_port = db.Column(db.Integer)
     agent_http_port = db.Column(db.Integer)
+    # number of standby deployments kept running for fast activations
+    warm_pool_size = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # resource profile of the server deployment, K8s quantities e.g. 250m cpu or 512Mi memory
+    cpu_request = db.Column(db.String(32))
+    cpu_limit = db.Column(db.String(32))
+    memory_request = db.Column(db.String(32))
+    memory_limit = db.Column(db.String(32))
+    min_replicas = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # a HorizontalPodAutoscaler is created when max_replicas is above min_replicas
+    max_replicas = db.Column(db.Integer)
+    target_cpu_utilization = db.Column(db.Integer)
+    # ingress profile of the server's http endpoint, empty values fall back to ingress_profiles.DEFAULT_PROFILE
+    ingress_body_size = db.Column(db.String(16))
+    ingress_connect_timeout = db.Column(db.Integer)
+    ingress_read_timeout = db.Column(db.Integer)
+    ingress_keepalive_timeout = db.Column(db.Integer)
+    ingress_buffering = db.Column(db.Boolean, nullable=False, default=True, server_default='1')
+    # one of HTTP, HTTPS, GRPC or GRPCS, as supported by the ingress controller
+    ingress_backend_protocol = db.Column(db.String(8))
 
     db.UniqueConstraint('name', 'author_id', name='service_unq')
     applications = db.relationship('Application', backref='service_apps', lazy='dynamic')
 
     def __repr__(self):
         return '<Service {0} with id {1}>'.format(self.name, self.id)
+
+
+# Define LoopLease data-model
+class LoopLease(db.Model):
+    __tablename__ = 'loop_leases'
+    # the primary key guarantees that a background loop has a single leader
+    name = db.Column(db.String(MAX_STR_LENGTH), primary_key=True)
+    holder = db.Column(db.String(MAX_STR_LENGTH), nullable=False)
+    expires_at = db.Column(db.DateTime(), nullable=False)
+
+    def __repr__(self):
+        return '<LoopLease {0} held by {1}>'.format(self.name, self.holder)
+
+
+# Define PortLease data-model
+class PortLease(db.Model):
+    __tablename__ = 'port_leases'
+    # the primary key guarantees that a NodePort is leased at most once
+    port = db.Column(db.Integer(), primary_key=True, autoincrement=False)
+    application_id = db.Column(db.Integer, db.ForeignKey('applications.id', ondelete='SET NULL'), nullable=True,
+                               unique=True)
+    holder = db.Column(db.String(MAX_STR_LENGTH), nullable=False)
+    leased_at = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+    # pending leases expire unless they are confirmed, confirmed leases have no expiration date
+    expires_at = db.Column(db.DateTime(), nullable=True)
+
+    def __repr__(self):
+        return '<PortLease {0} held by {1}>'.format(self.port, self.holder)
+
+
+# Define Job data-model
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    id = db.Column(db.Integer(), primary_key=True)
+    application_id = db.Column(db.Integer, db.ForeignKey('applications.id', ondelete='CASCADE'), nullable=False,
+                               index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    action = db.Column(db.String(MAX_STR_LENGTH), nullable=False)
+    status = db.Column(db.Integer, nullable=False, index=True)
+    # the application id while the job is pending or running, the unique constraint allows
+    # a single active job per application across the workers
+    active_application_id = db.Column(db.Integer, nullable=True, unique=True)
+    # process that runs the job, it refreshes the heartbeat while the job runs
+    worker = db.Column(db.String(MAX_STR_LENGTH), nullable=True)
+    heartbeat_date = db.Column(db.DateTime(), nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    creation_date = db.Column(db.DateTime(), nullable=False, default=datetime.utcnow)
+    start_date = db.Column(db.DateTime(), nullable=True)
+    end_date = db.Column(db.DateTime(), nullable=True)
+
+    def __repr__(self):
+        return '<Job {0} {1} of application {2}>'.format(self.id, self.action, self.application_id)
@@ -0,0 +1,206 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+NodePort allocator that persists the allocated ports as leases in the database,
+so several dashboard workers or replicas can allocate ports concurrently.
+"""
+import logging
+import os
+import platform
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from papaya_server import db
+from papaya_server.exceptions import K8sError
+from papaya_server.k8s_client import PortAllocator
+from papaya_server.models import PortLease
+
+logger = logging.getLogger(__name__)
+
+
+class PortLeases(PortAllocator):
+    """
+    NodePort Manager backed by the port_leases table
+
+    A port is claimed by inserting its lease row, the primary key on the port makes the claim atomic across
+    processes. Claimed leases expire after ttl seconds unless they are confirmed together with the application
+    that uses them, so ports held by a worker that died in the middle of a deployment are eventually reclaimed.
+    """
+
+    def __init__(self, start: int = None, end: int = None, ttl: int = 300, max_attempts: int = 5):
+        self.start = start
+        self.end = end
+        self.ttl = ttl
+        self.max_attempts = max_attempts
+        self.holder = '{}:{}'.format(platform.node(), os.getpid())
+
+
+    @staticmethod
+    def _live(now):
+        """:return: filter of the leases which are still valid at now"""
+        return or_(PortLease.expires_at.is_(None), PortLease.expires_at > now)
+
+
+    def _leased_ports(self, now, ports: list = None):
+        """
+        The leases are read on a dedicated connection, so the request's session isn't affected
+        :return: set of ports in the range (or in ports list) which have a valid lease
+        """
+        table = PortLease.__table__
+        cond = table.c.port.in_(ports) if ports is not None else table.c.port.between(self.start, self.end)
+        if now is not None:
+            cond = and_(cond, or_(table.c.expires_at.is_(None), table.c.expires_at > now))
+
+        with db.engine.connect() as conn:
+            return {r.port for r in conn.execute(select([table.c.port]).where(cond))}
+
+
+    def _claim(self, ports: list, now):
+        """
+        Claim all the ports in a single transaction, an expired lease is taken over, otherwise a new lease is inserted
+        :raise IntegrityError: if one of the ports was claimed by another worker
+        """
+        table = PortLease.__table__
+        expires_at = now + timedelta(seconds=self.ttl)
+
+        with db.engine.begin() as conn:
+            for port in ports:
+                values = dict(holder=self.holder, application_id=None, leased_at=now, expires_at=expires_at)
+                res = conn.execute(table.update()
+                                   .where(and_(table.c.port == port,
+                                               table.c.expires_at.isnot(None),
+                                               table.c.expires_at <= now))
+                                   .values(**values))
+                if res.rowcount == 0:
+                    conn.execute(table.insert().values(port=port, **values))
+
+
+    def get_available_ports(self, count: int):
+        """
+        Lease several ports at once, either all of them are leased or none
+        :param count: number of ports to allocate
+        :return: list of allocated ports
+        """
+        for attempt in range(self.max_attempts):
+            now = datetime.utcnow()
+            leased = self._leased_ports(now)
+
+            free = [p for p in range(self.start, self.end + 1) if p not in leased]
+            if len(free) < count:
+                logger.error("Error occurred in get_available_ports, requested {} ports while only {} are free"
+                             .format(count, len(free)))
+                raise K8sError("No available ports")
+
+            # random candidates reduce the collisions between workers which allocate at the same time
+            ports = random.sample(free, count)
+            try:
+                self._claim(ports, now)
+                logger.debug("Leasing ports {}".format(ports))
+                return ports
+
+            except IntegrityError:
+                logger.debug("Ports {} were leased by another worker, attempt {}".format(ports, attempt + 1))
+
+        raise K8sError("Wasn't able to lease {} ports".format(count))
+
+
+    def release_ports(self, ports: list):
+        """
+        Delete the leases of the ports
+        :param ports: list of allocated ports
+        :return:
+        """
+        table = PortLease.__table__
+        with db.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.port.in_(list(ports))))
+
+        logger.debug("Releasing ports {}".format(ports))
+
+
+    def reserve_ports(self, ports: list):
+        """
+        Create confirmed leases for ports which are already in use, ports which have a lease are skipped
+        :param ports: list of ports
+        :return:
+        """
+        ports = [p for p in ports if self.start <= p <= self.end]
+        if not ports:
+            return
+
+        table = PortLease.__table__
+        existing = self._leased_ports(None, ports)
+
+        for port in ports:
+            if port in existing:
+                continue
+            try:
+                with db.engine.begin() as conn:
+                    conn.execute(table.insert().values(port=port, holder=self.holder, leased_at=datetime.utcnow(),
+                                                       expires_at=None))
+            except IntegrityError:
+                logger.debug("Port [{}] was reserved by another worker".format(port))
+
+
+    def confirm_port(self, port: int, application_id: int = None):
+        """
+        Bind the lease to the application and make it permanent, the lease is committed right away
+        on a dedicated connection, so it's confirmed before the application's objects are created
+        and can't expire during a slow deployment
+        :param port: allocated port
+        :param application_id: application id
+        :return:
+        """
+        table = PortLease.__table__
+        now = datetime.utcnow()
+        with db.engine.begin() as conn:
+            updated = conn.execute(table.update()
+                                   .where(and_(table.c.port == port,
+                                               table.c.holder == self.holder,
+                                               or_(table.c.expires_at.is_(None), table.c.expires_at > now)))
+                                   .values(application_id=application_id, expires_at=None)).rowcount
+
+        if updated == 0:
+            raise K8sError("The lease of port [{}] has expired".format(port))
+
+
+    def snapshot(self):
+        """
+        :return: utilization of the ports range
+        """
+        now = datetime.utcnow()
+        used = db.session.query(PortLease).filter(PortLease.port.between(self.start, self.end),
+                                                  self._live(now)).count()
+        pending = db.session.query(PortLease).filter(PortLease.port.between(self.start, self.end),
+                                                     PortLease.expires_at > now).count()
+        total = self.end - self.start + 1
+        return {
+            'start': self.start,
+            'end': self.end,
+            'total': total,
+            'used': used,
+            'pending': pending,
+            'free': total - used,
+            'utilization': float(used) / total if total else 0.0
+        }
@@ -0,0 +1,148 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+This package moves deployed applications between PROVISIONING, READY and FAILED statuses,
+driven by the deployment and pod events of the cluster state cache.
+"""
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Callable
+
+from papaya_server import db
+from papaya_server.constants import AppStatus
+from papaya_server.models import Application, User
+
+logger = logging.getLogger(__name__)
+
+TRACKED_STATUSES = (AppStatus.PROVISIONING.value, AppStatus.READY.value, AppStatus.FAILED.value)
+
+
+class ReadinessTracker:
+    """Listens to the cluster state cache and updates the applications' statuses when their readiness changes"""
+
+    def __init__(self, cache, name_fn: Callable[[str, str], str], refresh_interval: int = 5):
+        """
+        :param cache: ClusterStateCache
+        :param name_fn: function that builds the K8s application name from application name and username
+        :param refresh_interval: minimal seconds between reloads of the application names from the DB
+        """
+        self._cache = cache
+        self._name_fn = name_fn
+        self._refresh_interval = refresh_interval
+        self._app = None
+        self._lock = threading.Lock()
+        self._names = {}
+        self._refreshed_at = 0
+
+
+    def init_app(self, app):
+        """
+        Start listening to the cluster events
+        :param app: flask app, the DB is updated within its context
+        :return:
+        """
+        self._app = app
+        self._cache.add_listener(self.on_event)
+
+
+    def on_event(self, kind, event_type, obj):
+        if kind == 'deployment' and (obj.metadata.labels or {}).get('app'):
+            app_name = obj.metadata.labels['app']
+        elif kind == 'deployment' and obj.metadata.name.endswith('-deployment'):
+            app_name = obj.metadata.name[:-len('-deployment')]
+        elif kind == 'pod':
+            app_name = (obj.metadata.labels or {}).get('app')
+        else:
+            return
+
+        if app_name:
+            with self._app.app_context():
+                self.check(app_name)
+
+
+    def _resolve(self, app_name: str):
+        """
+        :param app_name: K8s application name
+        :return: id of the tracked application with this name or None
+        """
+        with self._lock:
+            if app_name not in self._names and time.monotonic() - self._refreshed_at > self._refresh_interval:
+                rows = db.session.query(Application.id, Application.name, User.username) \
+                    .join(User, Application.user_id == User.id) \
+                    .filter(Application.status.in_(TRACKED_STATUSES)).all()
+                db.session.rollback()
+                self._names = {self._name_fn(r.name, r.username): r.id for r in rows}
+                self._refreshed_at = time.monotonic()
+
+            return self._names.get(app_name)
+
+
+    def track(self, app_name: str, application_id: int):
+        """
+        Register an application that has just been deployed and check its readiness immediately,
+        it might have become available before its status was committed
+        :param app_name: K8s application name
+        :param application_id: application id
+        :return:
+        """
+        with self._lock:
+            self._names[app_name] = application_id
+
+        self.check(app_name)
+
+
+    def check(self, app_name: str):
+        """
+        Update the application's status according to the cached readiness, should run within app context
+        :param app_name: K8s application name
+        :return:
+        """
+        application_id = self._resolve(app_name)
+        if application_id is None:
+            return
+
+        summary = self._cache.readiness(app_name)
+        if summary is None:
+            return
+
+        a = Application.query.get(application_id)
+        if a is None or a.status not in TRACKED_STATUSES:
+            with self._lock:
+                self._names.pop(app_name, None)
+            db.session.rollback()
+            return
+
+        now = datetime.utcnow()
+        if summary['available'] and a.status != AppStatus.READY.value:
+            if a.ready_date is None and a.activation_date is not None:
+                a.ready_date = now
+                a.time_to_ready = (now - a.activation_date).total_seconds()
+            a.status = AppStatus.READY.value
+            logger.info("{} is ready, time to ready {}s".format(a, a.time_to_ready))
+
+        elif summary['failed'] and a.status != AppStatus.FAILED.value:
+            a.status = AppStatus.FAILED.value
+            logger.info("{} failed, reason {}".format(a, summary['reason']))
+
+        db.session.commit()
@@ -0,0 +1,256 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+This package periodically reconciles the applications table with the cluster: objects created by the platform
+which don't belong to a deployed application are deleted and missing objects of deployed applications are
+recreated. The cluster is read with a single labelled list call per kind, the diff is computed in memory.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+from papaya_server.k8s_client import APPLICATION_LABEL, INSTANCE_LABEL, WARM_POOL_LABEL, autoscaled, owner_labels
+
+logger = logging.getLogger(__name__)
+
+
+def expected_objects(spec: dict, gatekeeper: bool = None):
+    """
+    :param spec: deployment specification of a deployed application, see applications.get_deploy_spec
+    :param gatekeeper: whether an IAM application runs the gatekeeper sidecar, see K8s.gatekeeper,
+            otherwise it has an admin ingress instead of the sidecar's configuration map
+    :return: dictionary of (kind, object name) to the object's recreation arguments
+    """
+    name = spec['app_name']
+    objects = {('deployment', spec.get('workload_name') or name + '-deployment'): {}}
+    # the autoscaler of a suspended application stays, it doesn't scale a deployment with no replicas
+    if autoscaled(spec.get('profile')):
+        objects[('hpa', name + '-hpa')] = {}
+    if gatekeeper is None:
+        gatekeeper = spec['iam']
+
+    if spec['server_url'] and spec['http_port']:
+        objects[('service', name + '-service')] = {}
+        objects[('ingress', name + '-ingress')] = {}
+        if spec['iam'] and gatekeeper:
+            objects[('configmap', name + '-configmap')] = {}
+        elif spec['iam']:
+            objects[('ingress', name + '-admin-ingress')] = {}
+
+    if spec['node_port'] and spec['tcp_port']:
+        objects[('service', name + '-tcp-service')] = {}
+
+    return objects
+
+
+class Reconciler:
+    """Runs the reconciliation every interval seconds in a background thread"""
+
+    def __init__(self, k8s, namespace: str, specs_fn: Callable[[], list], host: str, interval: int = 60,
+                 grace_period: int = 300, batch_size: int = 20, workers: int = 4):
+        """
+        :param k8s: K8s client
+        :param namespace: applications namespace
+        :param specs_fn: returns the deployment specifications of the deployed applications,
+                the ones with an operation in progress are marked as busy
+        :param host: the ingress base host
+        :param interval: seconds between reconciliations
+        :param grace_period: seconds, objects and applications younger than that are left alone,
+                they might belong to an activation in progress
+        :param batch_size: maximal number of fixes per reconciliation
+        :param workers: number of fixes applied concurrently
+        """
+        self._k8s = k8s
+        self._namespace = namespace
+        self._specs_fn = specs_fn
+        self._host = host
+        self.interval = interval
+        self.grace_period = grace_period
+        self.batch_size = batch_size
+        self._workers = workers
+        self._app = None
+        self._stop = threading.Event()
+        self.last_report = None
+
+
+    def init_app(self, app):
+        self._app = app
+
+
+    def start(self):
+        if self.interval <= 0:
+            logger.info("Reconciliation is disabled")
+            return
+
+        threading.Thread(target=self._run, name='reconciler', daemon=True).start()
+
+
+    def stop(self):
+        self._stop.set()
+
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with self._app.app_context():
+                    self.reconcile()
+            except Exception as e:
+                logger.error("Error occurred in reconciliation")
+                logger.exception(e)
+
+
+    def reconcile(self):
+        """
+        Compare the cluster with the DB and fix the differences, should run within app context
+        :return: report dictionary
+        """
+        t0 = time.monotonic()
+        observed = self._k8s.list_managed(self._namespace)
+        specs = self._specs_fn()
+
+        now = datetime.now(timezone.utc)
+        grace = timedelta(seconds=self.grace_period)
+
+        expected = {}
+        busy = set()
+        for spec in specs:
+            activated = spec.get('activation_date')
+            if spec.get('busy') or (activated is not None and datetime.utcnow() - activated < grace):
+                # an operation or the activation might still be changing the objects, they're neither deleted
+                # nor recreated
+                busy.add(str(spec['id']))
+                for key in expected_objects(spec, self._k8s.gatekeeper(spec['iam'], spec['iam_mode'])):
+                    expected[key] = None
+                continue
+            for key in expected_objects(spec, self._k8s.gatekeeper(spec['iam'], spec['iam_mode'])):
+                expected[key] = spec
+
+        orphans = []
+        for kind, objects in observed.items():
+            for name, obj in objects.items():
+                labels = obj.metadata.labels or {}
+                if WARM_POOL_LABEL in labels or labels.get(APPLICATION_LABEL) in busy:
+                    # standby deployments are managed by the warm pool, the objects of a busy application
+                    # may not be expected yet
+                    continue
+                created = obj.metadata.creation_timestamp
+                if (kind, name) not in expected and (created is None or now - created > grace):
+                    orphans.append((kind, name))
+
+        missing = [(key, spec) for key, spec in expected.items()
+                   if spec is not None and key[1] not in observed.get(key[0], {})]
+
+        fixes = [(self._delete, kind, name) for kind, name in orphans] + \
+                [(self._recreate, key[0], key[1], spec) for key, spec in missing]
+        if len(fixes) > self.batch_size:
+            logger.info("Reconciliation found {} differences, fixing the first {}".format(len(fixes),
+                                                                                       self.batch_size))
+            fixes = fixes[:self.batch_size]
+
+        app = self._app
+
+        def run(fix):
+            with app.app_context():
+                return fix[0](*fix[1:])
+
+        results = []
+        if fixes:
+            with ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='reconciler') as executor:
+                results = list(executor.map(run, fixes))
+
+        self.last_report = {
+            'date': datetime.utcnow().isoformat(),
+            'duration': time.monotonic() - t0,
+            'observed': sum(len(objects) for objects in observed.values()),
+            'applications': len(specs),
+            'orphans': len(orphans),
+            'missing': len(missing),
+            'fixed': sum(1 for r in results if r),
+            'failed': sum(1 for r in results if not r)
+        }
+        if orphans or missing:
+            logger.info("Reconciliation report {}".format(self.last_report))
+
+        return self.last_report
+
+
+    def _delete(self, kind, name):
+        logger.info("Deleting orphan {} [{}]".format(kind, name))
+        try:
+            self._k8s.delete_object(kind, name, self._namespace)
+            return True
+        except Exception as e:
+            logger.error("Error occurred in deletion of orphan {} [{}]".format(kind, name))
+            logger.exception(e)
+            return False
+
+
+    def _recreate(self, kind, name, spec):
+        """Recreate missing object of a deployed application with the same parameters as its activation"""
+        logger.info("Recreating missing {} [{}]".format(kind, name))
+        app_name = spec['app_name']
+        ns = self._namespace
+        labels = owner_labels(app_name, user_id=spec['user_id'], application_id=spec['id'])
+        # an application running on a claimed standby deployment keeps its name and its pods selector
+        instance = spec['workload_name'][:-len('-deployment')] if spec.get('workload_name') else None
+        selector = {INSTANCE_LABEL: instance} if instance else None
+        gatekeeper = self._k8s.gatekeeper(spec['iam'], spec['iam_mode'])
+
+        try:
+            if kind == 'deployment':
+                ports = [p for p in (spec['http_port'], spec['tcp_port']) if p]
+                self._k8s.create_deployment(name=instance or app_name, image=spec['image'], namespace=ns,
+                                            ports=ports, iam=spec['iam'], labels=labels,
+                                            replicas=0 if spec.get('suspended') else spec['profile']['min_replicas'],
+                                            selector=selector, resources=spec['profile'],
+                                            iam_mode=spec['iam_mode'])
+            elif kind == 'service' and name.endswith('-tcp-service'):
+                self._k8s.create_node_port_service(name=app_name, namespace=ns, node_port=spec['node_port'],
+                                                   ports={'source': spec['tcp_port'], 'target': None},
+                                                   labels=labels, selector=selector)
+            elif kind == 'service':
+                self._k8s.create_service(name=app_name, namespace=ns, port=spec['http_port'],
+                                         target_port=3000 if gatekeeper else None,
+                                         labels=labels, selector=selector)
+            elif kind == 'ingress':
+                # the sub domain is kept, so the agents' configuration stays valid
+                unique = spec['server_url'].split('://', 1)[-1].split('.', 1)[0]
+                self._k8s.create_ingress(name=app_name, uuid=unique, service_name=app_name + '-service',
+                                         service_port=spec['http_port'], host=self._host, labels=labels,
+                                         namespace=ns, profile=spec['ingress_profile'], iam=spec['iam'],
+                                         admin=name.endswith('-admin-ingress'), iam_mode=spec['iam_mode'])
+            elif kind == 'configmap':
+                self._k8s.create_iam_configmap(name=app_name, ingress_url=spec['server_url'],
+                                               app_port=spec['http_port'], namespace=ns, labels=labels)
+            elif kind == 'hpa':
+                hpa = self._k8s.create_hpa_object(app_name, spec.get('workload_name') or app_name + '-deployment',
+                                                  spec['profile'], labels=labels)
+                self._k8s.apply('hpa', hpa, ns)
+            return True
+
+        except Exception as e:
+            logger.error("Error occurred in recreation of missing {} [{}]".format(kind, name))
+            logger.exception(e)
+            return False
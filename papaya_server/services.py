@@ -19,13 +19,19 @@ TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR TH
 SOFTWARE.
 """
 
+import os
+
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for, current_app
+    Blueprint, flash, g, jsonify, redirect, render_template, request, url_for, current_app
 )
 from .auth import login_required
 from papaya_server import db
+from papaya_server.config import Config
+from papaya_server.ingress_profiles import get_renderer
+from papaya_server.k8s_cache import summarize_prepull
 from papaya_server.models import Service, User
-from .validator import StrValidator, IntValidator, get_invalid_error, ServiceValidator
+from .validator import StrValidator, IntValidator, get_invalid_error, ServiceValidator, cpu_cores, memory_bytes
+from papaya_server.exceptions import K8sError, NotFound
 
 bp = Blueprint('service', __name__, url_prefix='/services')
 
@@ -35,8 +41,9 @@ bp = Blueprint('service', __name__, url_prefix='/services')
 def index():
 
     services = get_services()
+    prepull = {s.id: get_prepull_status(s.id) for s in services}
 
-    return render_template('service/index.html', services=services)
+    return render_template('service/index.html', services=services, prepull=prepull)
 
 
 @bp.route('/create', methods=('GET', 'POST'))
@@ -60,12 +67,16 @@ def create():
                 s = Service(name=form['name'], author_id= g.user['id'], description=form['description'],
                             server_container=form['server_container'], server_http_port=form['server_http_port'],
                             server_tcp_port=form['server_tcp_port'], agent_container=form['agent_container'],
-                            agent_http_port=form['agent_http_port'], agent_tcp_port=form['agent_tcp_port'])
+                            agent_http_port=form['agent_http_port'], agent_tcp_port=form['agent_tcp_port'],
+                            warm_pool_size=form['warm_pool_size'] or 0)
+                set_resource_profile(s, form)
+                set_ingress_profile(s, form)
 
                 db.session.add(s)
                 db.session.commit()
 
                 current_app.logger.info('{0} was created'.format(s))
+                prepull(s)
 
                 response = redirect(url_for('service.index'))
                 response.autocorrect_location_header = False
@@ -93,6 +104,7 @@ def update(id):
                 flash(err)
 
             else:
+                image_changed = service.server_container != form['server_container']
                 service.name = form['name']
                 service.description = form['description']
                 service.server_container = form['server_container']
@@ -101,15 +113,20 @@ def update(id):
                 service.agent_container = form['agent_container']
                 service.agent_tcp_port = form['agent_tcp_port']
                 service.agent_http_port = form['agent_http_port']
+                service.warm_pool_size = form['warm_pool_size'] or 0
+                set_resource_profile(service, form)
+                set_ingress_profile(service, form)
 
                 db.session.commit()
                 current_app.logger.info('{} was updated'.format(service))
+                if image_changed:
+                    prepull(service)
 
                 response = redirect(url_for('service.index'))
                 response.autocorrect_location_header = False
                 return response
 
-    return render_template('service/update.html', service=service)
+    return render_template('service/update.html', service=service, prepull=get_prepull_status(service.id))
 
 
 @bp.route('/<int:id>/delete', methods=('POST',))
@@ -119,6 +136,7 @@ def delete(id):
     service = get_service(id, g.user['id'])
     db.session.delete(service)
     db.session.commit()
+    delete_prepull(id)
 
     current_app.logger.info("Service {} with id {} was deleted".format(service.name, id))
 
@@ -127,6 +145,65 @@ def delete(id):
     return response
 
 
+@bp.route('/<int:id>/prepull', methods=('GET',))
+@login_required
+def prepull_status(id):
+    """Per node pull state of the service's server image"""
+    service = get_service(id)
+    if service is None:
+        raise NotFound("Service id {0} doesn't exist.".format(id))
+
+    return jsonify(dict(get_prepull_status(id) or {}, image=service.server_container))
+
+
+def prepull(s: Service):
+    """
+    Pull the service's server image on all the nodes, the agent images run outside of the cluster
+    :param s: service
+    :return:
+    """
+    if not os.getenv('NOT_BUILDING', False) or not Config.k8s['prepull_images']:
+        return
+
+    from papaya_server.applications import prepull_service
+    try:
+        prepull_service(s)
+    except K8sError:
+        flash("Pre-pull of {0} failed, the first activation will pull it".format(s.server_container))
+
+
+def delete_prepull(id: int):
+    """
+    Delete the service's pre-pull daemon set
+    :param id: service id
+    :return:
+    """
+    if not os.getenv('NOT_BUILDING', False) or not Config.k8s['prepull_images']:
+        return
+
+    from papaya_server.applications import kubernetes
+    try:
+        kubernetes.delete_prepull(id, Config.k8s['namespace'])
+    except K8sError:
+        current_app.logger.error("Pre-pull daemon set of service {} wasn't deleted".format(id))
+
+
+def get_prepull_status(id: int):
+    """
+    Pull state of the service's server image, read from the cluster state cache
+    :param id: service id
+    :return: see summarize_prepull, None if unknown
+    """
+    if not os.getenv('NOT_BUILDING', False) or not Config.k8s['prepull_images']:
+        return None
+
+    from papaya_server.applications import cluster_state
+    if not cluster_state.synced:
+        return None
+
+    return summarize_prepull(cluster_state.pods.by_label('prepull-{}'.format(id)))
+
+
 def get_services():
     """
     Retrieve all services
@@ -164,9 +241,92 @@ def validate_post_form(form: dict) -> str:
         err = "At least one of the agent's communication ports should be defined"
         return err
 
+    if form['max_replicas'] and form['max_replicas'] < (form['min_replicas'] or 1):
+        err = "The service's max_replicas should be greater or equal to min_replicas"
+        return err
+
+    # the API server would reject the deployment only at the activation
+    if form['cpu_request'] and form['cpu_limit'] and cpu_cores(form['cpu_limit']) < cpu_cores(form['cpu_request']):
+        err = "The service's cpu_limit should be greater or equal to cpu_request"
+        return err
+
+    if form['memory_request'] and form['memory_limit'] and \
+            memory_bytes(form['memory_limit']) < memory_bytes(form['memory_request']):
+        err = "The service's memory_limit should be greater or equal to memory_request"
+        return err
+
+    if form['target_cpu_utilization'] and not (form['cpu_request'] and form['max_replicas']):
+        err = "The service's target_cpu_utilization requires cpu_request and max_replicas"
+        return err
+
+    protocols = get_renderer(Config.k8s['ingress_controller']).protocols
+    if form['ingress_backend_protocol'] and form['ingress_backend_protocol'] not in protocols:
+        err = "The ingress controller supports the backend protocols {}".format(', '.join(protocols))
+        return err
+
     return err
 
 
+def set_resource_profile(s: Service, form: dict):
+    """
+    Update the service's resource profile from a validated form
+    :param s: service
+    :param form: validated request form
+    :return:
+    """
+    s.cpu_request = form['cpu_request'] or None
+    s.cpu_limit = form['cpu_limit'] or None
+    s.memory_request = form['memory_request'] or None
+    s.memory_limit = form['memory_limit'] or None
+    s.min_replicas = form['min_replicas'] or 1
+    s.max_replicas = form['max_replicas'] or None
+    s.target_cpu_utilization = form['target_cpu_utilization'] or None
+
+
+def get_resource_profile(s: Service):
+    """
+    :param s: service
+    :return: resource profile dictionary of the service's server deployment
+    """
+    return {
+        'requests': {k: v for k, v in (('cpu', s.cpu_request), ('memory', s.memory_request)) if v},
+        'limits': {k: v for k, v in (('cpu', s.cpu_limit), ('memory', s.memory_limit)) if v},
+        'min_replicas': s.min_replicas or 1,
+        'max_replicas': s.max_replicas,
+        'target_cpu_utilization': s.target_cpu_utilization
+    }
+
+
+def set_ingress_profile(s: Service, form: dict):
+    """
+    Update the service's ingress profile from a validated form
+    :param s: service
+    :param form: validated request form
+    :return:
+    """
+    s.ingress_body_size = form['ingress_body_size'] or None
+    s.ingress_connect_timeout = form['ingress_connect_timeout'] or None
+    s.ingress_read_timeout = form['ingress_read_timeout'] or None
+    s.ingress_keepalive_timeout = form['ingress_keepalive_timeout'] or None
+    s.ingress_buffering = form['ingress_buffering'] != 'off'
+    s.ingress_backend_protocol = form['ingress_backend_protocol'] or None
+
+
+def get_ingress_profile(s: Service):
+    """
+    :param s: service
+    :return: ingress profile dictionary of the service's http endpoint, see ingress_profiles.render_annotations
+    """
+    return {
+        'body_size': s.ingress_body_size,
+        'connect_timeout': s.ingress_connect_timeout,
+        'read_timeout': s.ingress_read_timeout,
+        'keepalive_timeout': s.ingress_keepalive_timeout,
+        'buffering': s.ingress_buffering is not False,
+        'backend_protocol': s.ingress_backend_protocol
+    }
+
+
 def get_service_by_id(id):
     """
     Retrieve service by service id
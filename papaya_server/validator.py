@@ -19,9 +19,20 @@ TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR TH
 SOFTWARE.
 """
 
+import re
 from typing import Callable
 
 MAX_STR_LENGTH = 255
+MAX_WARM_POOL_SIZE = 10
+MAX_REPLICAS = 20
+CPU_QUANTITY = re.compile(r'^\d+(\.\d+)?m?$')
+MEMORY_QUANTITY = re.compile(r'^\d+(\.\d+)?(Ki|Mi|Gi|Ti|k|M|G|T)?$')
+# proxy size, e.g. 300m or 0 for unlimited
+SIZE = re.compile(r'^\d+[kKmMgG]?$')
+MAX_INGRESS_TIMEOUT = 3600
+BACKEND_PROTOCOLS = ('HTTP', 'HTTPS', 'GRPC', 'GRPCS')
+MEMORY_UNITS = {'': 1, 'k': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3, 'T': 1000 ** 4,
+                'Ki': 1024, 'Mi': 1024 ** 2, 'Gi': 1024 ** 3, 'Ti': 1024 ** 4}
 
 
 class Validator:
@@ -124,6 +135,50 @@ class StrValidator(Validator):
 
         return str(arg.strip())
 
+    @staticmethod
+    def validate_cpu(arg: str):
+        """
+        Validate if arg is empty or a K8s cpu quantity, e.g. 0.5 or 500m
+        :param arg:
+        :return: boolean
+        """
+        return not arg or (StrValidator.validate(arg) and CPU_QUANTITY.match(arg) is not None)
+
+    @staticmethod
+    def validate_memory(arg: str):
+        """
+        Validate if arg is empty or a K8s memory quantity, e.g. 512Mi or 1Gi
+        :param arg:
+        :return: boolean
+        """
+        return not arg or (StrValidator.validate(arg) and MEMORY_QUANTITY.match(arg) is not None)
+
+    @staticmethod
+    def validate_size(arg: str):
+        """
+        Validate if arg is empty or a proxy size, e.g. 300m
+        :param arg:
+        :return: boolean
+        """
+        return not arg or (StrValidator.validate(arg) and SIZE.match(arg) is not None)
+
+
+def cpu_cores(arg: str) -> float:
+    """
+    :param arg: valid K8s cpu quantity, see StrValidator.validate_cpu
+    :return: number of cores
+    """
+    return float(arg[:-1]) / 1000 if arg.endswith('m') else float(arg)
+
+
+def memory_bytes(arg: str) -> float:
+    """
+    :param arg: valid K8s memory quantity, see StrValidator.validate_memory
+    :return: number of bytes
+    """
+    m = MEMORY_QUANTITY.match(arg)
+    return float(arg[:len(arg) - len(m.group(2) or '')]) * MEMORY_UNITS[m.group(2) or '']
+
 
 def get_invalid_error(name: str):
     """
@@ -190,3 +245,27 @@ ServiceValidator.add(name='server_http_port', type=int, cf=IntValidator.strip_an
 ServiceValidator.add(name='server_tcp_port', type=int, cf=IntValidator.strip_and_cast, vf=IntValidator.validate)
 ServiceValidator.add(name='agent_http_port', type=int, cf=IntValidator.strip_and_cast, vf=IntValidator.validate)
 ServiceValidator.add(name='agent_tcp_port', type=int, cf=IntValidator.strip_and_cast, vf=IntValidator.validate)
+ServiceValidator.add(name='warm_pool_size', type=int, cf=IntValidator.strip_and_cast,
+                     vf=lambda arg: not arg or IntValidator.validate_range(arg, 0, MAX_WARM_POOL_SIZE))
+ServiceValidator.add(name='cpu_request', type=str, cf=StrValidator.strip_and_cast, vf=StrValidator.validate_cpu)
+ServiceValidator.add(name='cpu_limit', type=str, cf=StrValidator.strip_and_cast, vf=StrValidator.validate_cpu)
+ServiceValidator.add(name='memory_request', type=str, cf=StrValidator.strip_and_cast,
+                     vf=StrValidator.validate_memory)
+ServiceValidator.add(name='memory_limit', type=str, cf=StrValidator.strip_and_cast, vf=StrValidator.validate_memory)
+ServiceValidator.add(name='min_replicas', type=int, cf=IntValidator.strip_and_cast,
+                     vf=lambda arg: not arg or IntValidator.validate_range(arg, 1, MAX_REPLICAS))
+ServiceValidator.add(name='max_replicas', type=int, cf=IntValidator.strip_and_cast,
+                     vf=lambda arg: not arg or IntValidator.validate_range(arg, 1, MAX_REPLICAS))
+ServiceValidator.add(name='target_cpu_utilization', type=int, cf=IntValidator.strip_and_cast,
+                     vf=lambda arg: not arg or IntValidator.validate_range(arg, 1, 100))
+ServiceValidator.add(name='ingress_body_size', type=str, cf=StrValidator.strip_and_cast, vf=StrValidator.validate_size)
+ServiceValidator.add(name='ingress_connect_timeout', type=int, cf=IntValidator.strip_and_cast,
+                     vf=lambda arg: not arg or IntValidator.validate_range(arg, 1, MAX_INGRESS_TIMEOUT))
+ServiceValidator.add(name='ingress_read_timeout', type=int, cf=IntValidator.strip_and_cast,
+                     vf=lambda arg: not arg or IntValidator.validate_range(arg, 1, MAX_INGRESS_TIMEOUT))
+ServiceValidator.add(name='ingress_keepalive_timeout', type=int, cf=IntValidator.strip_and_cast,
+                     vf=lambda arg: not arg or IntValidator.validate_range(arg, 1, MAX_INGRESS_TIMEOUT))
+ServiceValidator.add(name='ingress_buffering', type=str, cf=StrValidator.strip_and_cast,
+                     vf=lambda arg: arg in ('', 'on', 'off'))
+ServiceValidator.add(name='ingress_backend_protocol', type=str, cf=StrValidator.strip_and_cast,
+                     vf=lambda arg: not arg or arg in BACKEND_PROTOCOLS)
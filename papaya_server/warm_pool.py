@@ -0,0 +1,176 @@
+# -*- encoding: utf-8 -*-
+"""
+MIT License
+
+Copyright (C)  PAPAYA EU Project 2021
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated
+documentation files (the "Software"), to deal in the Software without restriction, including without limitation the
+rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit
+persons to whom the Software is furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the
+Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT,
+TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+"""
+This package keeps the services' warm pools topped up: each service with a warm_pool_size keeps that many standby
+deployments running its server image, an activation claims one instead of waiting for the image to be pulled
+and the container to start. The services' pre-pull daemon sets are backfilled by the same loop, which runs
+in the dashboard process that holds the loop's lease only.
+"""
+import logging
+import threading
+from typing import Callable
+
+from papaya_server.k8s_client import PREPULL_CONTAINERS, PREPULL_LABEL, WARM_POOL_LABEL
+from papaya_server.leader_lease import LeaderLease
+from papaya_server.models import Service
+from papaya_server.services import get_resource_profile
+
+logger = logging.getLogger(__name__)
+
+# seconds between the pre-pull backfills when the warm pools are disabled
+PREPULL_INTERVAL = 300
+
+
+class WarmPool:
+    """Refills the warm pools every interval seconds, or as soon as a standby was claimed, in a background thread"""
+
+    def __init__(self, k8s, namespace: str, interval: int = 30, prepull_fn: Callable[[Service], None] = None,
+                 single_leader: bool = True):
+        """
+        :param k8s: K8s client
+        :param namespace: applications namespace
+        :param interval: seconds between the refills, 0 disables the warm pools
+        :param prepull_fn: schedules the pre-pull of a service's image, None if the images aren't pre-pulled
+        :param single_leader: whether the refills run in the process which holds the loop's lease only,
+                otherwise each process tops the pools up and they create redundant standby deployments
+        """
+        self._k8s = k8s
+        self._namespace = namespace
+        self.interval = interval
+        self._prepull_fn = prepull_fn
+        self._period = interval if interval > 0 else PREPULL_INTERVAL
+        # the lease outlives a few missed iterations of its holder
+        self._lease = LeaderLease('warm-pool', ttl=3 * self._period) if single_leader else None
+        self._app = None
+        self._wake = threading.Event()
+        self._stopped = False
+
+
+    def init_app(self, app):
+        self._app = app
+
+
+    def start(self):
+        if self.interval <= 0:
+            logger.info("Warm pools are disabled")
+            if self._prepull_fn is None:
+                return
+
+        threading.Thread(target=self._run, name='warm-pool', daemon=True).start()
+
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+
+    def wake(self):
+        """Refill the pools without waiting for the interval, e.g. after a standby was claimed"""
+        self._wake.set()
+
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                with self._app.app_context():
+                    # a claim in another process wakes the leader at its next iteration only
+                    if self._lease is None or self._lease.acquire():
+                        self.backfill_prepull()
+                        self.refill()
+            except Exception as e:
+                logger.error("Error occurred in warm pools refill")
+                logger.exception(e)
+
+            self._wake.wait(self._period)
+            self._wake.clear()
+
+
+    def refill(self):
+        """
+        Create the missing standby deployments and delete the redundant ones, standby deployments running an
+        outdated image are replaced. Should run within app context
+        :return: dictionary of service id to the number of standby deployments
+        """
+        if self.interval <= 0:
+            return {}
+
+        standby = {}
+        for d in self._k8s.list_standby(self._namespace):
+            standby.setdefault(d.metadata.labels[WARM_POOL_LABEL], []).append(d)
+
+        services = {str(s.id): s for s in Service.query.filter(Service.warm_pool_size > 0).all()}
+
+        pools = {}
+        for service_id in set(standby) | set(services):
+            s = services.get(service_id)
+            size = s.warm_pool_size if s is not None else 0
+            image = s.server_container if s is not None else None
+
+            current = []
+            for d in standby.get(service_id, []):
+                if d.spec.template.spec.containers[0].image == image and len(current) < size:
+                    current.append(d)
+                else:
+                    self._delete(d.metadata.name)
+
+            for _ in range(size - len(current)):
+                ports = [p for p in (s.server_http_port, s.server_tcp_port) if p]
+                self._k8s.create_standby(s.id, image, ports, self._namespace, resources=get_resource_profile(s))
+
+            pools[service_id] = size
+
+        return pools
+
+
+    def backfill_prepull(self):
+        """
+        Schedule the pre-pull of the services whose daemon set is missing or outdated, e.g. the services
+        registered before the images were pre-pulled. Should run within app context
+        :return: list of the ids of the services whose pre-pull was scheduled
+        """
+        if self._prepull_fn is None:
+            return []
+
+        current = {d.metadata.labels.get(PREPULL_LABEL): d for d in self._k8s.list_prepull(self._namespace)}
+        scheduled = []
+        for s in Service.query.all():
+            d = current.get(str(s.id))
+            inits = (d.spec.template.spec.init_containers or []) if d is not None else []
+            if [c.name for c in inits] == PREPULL_CONTAINERS and inits[-1].image == s.server_container:
+                continue
+            try:
+                self._prepull_fn(s)
+                scheduled.append(s.id)
+            except Exception as e:
+                logger.error("Error occurred in pre-pull backfill of service [{}]".format(s.id))
+                logger.exception(e)
+
+        return scheduled
+
+
+    def _delete(self, name):
+        logger.info("Deleting redundant standby deployment [{}]".format(name))
+        try:
+            self._k8s.delete_object('deployment', name, self._namespace)
+        except Exception as e:
+            logger.error("Error occurred in deletion of standby deployment [{}]".format(name))
+            logger.exception(e)